@@ -0,0 +1,6 @@
+"""
+Modules shared by the preprocess, roi, filtered-func-reg and randomise pipelines.
+
+Each pipeline's main.py appends the repository root to sys.path so these can be
+imported (also from inside nipype Function nodes, which run in worker processes).
+"""
@@ -0,0 +1,319 @@
+"""
+Chunked store of the voxel values of the ROIs of a labelled atlas (ex:
+roi/grantmask_labeled.nii), per image: the voxel-level ROI values of roi/
+(--no-avg, one volume per zfstat) and the ROI timeseries of filtered-func-reg/
+(4D filtered_func). Instead of one long-format row per voxel and timepoint, each
+image is stored as one array per ROI (ROI voxels x time), split into compressed
+chunks of TIME_CHUNK timepoints, so "ROI 3 of subject X" or a time window only
+reads and decompresses those chunks.
+
+Layout of a store directory (one atlas per store):
+    store.json              atlas file, shape, affine and hash of the atlas, ROI numbers, time chunk
+    coords.npz              roiNN: voxel coordinates (voxels x 3, C order of the volume) of each ROI
+    arrays/<key>.npz        roiNN_tNNNNN: float32 ROI voxels x timepoints [t, t + time_chunk) (zip, deflate)
+    index/<key>.json        index row of an image: key, n_timepoints, in_file, mtime and its metadata
+                            (subject_id, session, run, image_name, registration, ...)
+    index.parquet           the index rows merged, rebuilt when index/ changed since
+
+Images are written in parallel by the extraction nodes: the arrays of an image are
+written to a temporary file and moved into place, then its index row (also moved
+into place), so readers only see complete images. A write only touches its own
+files, the rows are merged when the index is read (under the index's file lock,
+common/locking.py).
+
+Usage:
+    store = ArrayStore(opj(datasink_dir, "roi_array_store"), atlas_file=MASK_FILE_PATH)
+    store.write("sub-X_ses-baselineYear1Arm1_run-01_corGo_NL", zfstat_NL_file, subject_id="X", session="baselineYear1Arm1", run=1, image_name="corGo")
+    values = store.read("sub-X_ses-baselineYear1Arm1_run-01_corGo_NL", roi_num=3)          # ROI voxels x 1
+    window = store.read(key, roi_num=3, time=slice(100, 200))                               # ROI voxels x 100
+    entries, arrays = store.read_many(roi_num=3, subject_id="X")                             # every image of subject X
+"""
+import hashlib
+import json
+import os
+from os.path import join as opj
+
+import numpy as np
+
+from common.locking import file_lock
+
+STORE_FILE = "store.json"
+COORDS_FILE = "coords.npz"
+INDEX_FILE = "index.parquet"
+INDEX_DIR = "index"
+ARRAYS_DIR = "arrays"
+
+# timepoints per chunk (a 123 voxel ROI: 123 x 64 float32 = 31 KB before compression)
+TIME_CHUNK = 64
+
+
+def _atlas_hash(atlas: np.ndarray, affine: np.ndarray) -> str:
+    sha = hashlib.sha256()
+    sha.update(str(atlas.shape).encode())
+    sha.update(atlas.astype(np.int32).tobytes())
+    sha.update(np.round(affine, 4).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def _write_json(path: str, content: dict):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        json.dump(content, file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _roi_name(roi_num: int) -> str:
+    return f"roi{roi_num:02d}"
+
+
+def _chunk_name(roi_num: int, start: int) -> str:
+    return f"{_roi_name(roi_num)}_t{start:05d}"
+
+
+class ArrayStore:
+    """
+    Store of the ROI voxel arrays of one atlas (see the module docstring).
+    """
+
+    def __init__(self, store_dir: str, atlas_file: str = None, roi_nums: list = None, time_chunk: int = TIME_CHUNK):
+        """
+        atlas_file: required to create the store, must be the store's atlas (same labels and affine) if given
+        roi_nums: ROIs of the store (default: every label > 0 of the atlas)
+        """
+        import nibabel as nib
+
+        self.store_dir = store_dir
+        store_path = opj(store_dir, STORE_FILE)
+
+        if not os.path.exists(store_path):
+            if atlas_file is None:
+                raise FileNotFoundError(f"No array store in {store_dir}, an atlas_file is needed to create it")
+
+            os.makedirs(opj(store_dir, ARRAYS_DIR), exist_ok=True)
+            # the extraction nodes open the store in parallel, one of them creates it
+            with file_lock(store_path):
+                if not os.path.exists(store_path):
+                    self._create(store_path, atlas_file, roi_nums, time_chunk)
+
+        with open(store_path, "r") as file:
+            self.info = json.load(file)
+
+        atlas_img = nib.load(atlas_file or self.info["atlas_file"])
+        atlas = np.rint(np.asanyarray(atlas_img.dataobj)).astype(np.int64)
+        if _atlas_hash(atlas, atlas_img.affine) != self.info["atlas_hash"]:
+            raise ValueError(f"{atlas_file} is not the atlas of the array store {store_dir} ({self.info['atlas_file']})")
+
+        self.shape = tuple(self.info["shape"])
+        self.affine = atlas_img.affine
+        self.roi_nums = self.info["roi_nums"]
+        self.time_chunk = self.info["time_chunk"]
+
+        # voxel indices (C order) of each ROI, index the volumes without flattening them
+        self.voxels = {roi_num: np.nonzero(atlas == roi_num) for roi_num in self.roi_nums}
+
+    def _create(self, store_path: str, atlas_file: str, roi_nums: list, time_chunk: int):
+        import nibabel as nib
+
+        atlas_img = nib.load(atlas_file)
+        atlas = np.rint(np.asanyarray(atlas_img.dataobj)).astype(np.int64)
+        roi_nums = sorted([int(roi_num) for roi_num in np.unique(atlas) if roi_num > 0]) if roi_nums is None else list(roi_nums)
+
+        coords = {_roi_name(roi_num): np.argwhere(atlas == roi_num).astype(np.int16) for roi_num in roi_nums}
+        np.savez(opj(self.store_dir, COORDS_FILE), **coords)
+
+        _write_json(store_path, {
+            "atlas_file": os.path.abspath(atlas_file),
+            "atlas_hash": _atlas_hash(atlas, atlas_img.affine),
+            "shape": list(atlas.shape[:3]),
+            "affine": atlas_img.affine.tolist(),
+            "roi_nums": roi_nums,
+            "time_chunk": time_chunk,
+        })
+
+    def array_path(self, key: str) -> str:
+        return opj(self.store_dir, ARRAYS_DIR, f"{key}.npz")
+
+    def coords(self, roi_num: int) -> np.ndarray:
+        """
+        Returns the voxel coordinates (ROI voxels x 3) of a ROI, the row order of its arrays.
+        """
+        with np.load(opj(self.store_dir, COORDS_FILE)) as coords:
+            return coords[_roi_name(roi_num)]
+
+    def _index_dir(self) -> str:
+        index_dir = opj(self.store_dir, INDEX_DIR)
+        index_path = opj(self.store_dir, INDEX_FILE)
+
+        # stores written before the index rows: one row file per row of their index.parquet
+        if not os.path.isdir(index_dir) and os.path.exists(index_path):
+            import pandas as pd
+
+            with file_lock(index_path):
+                if not os.path.isdir(index_dir):
+                    tmp_dir = f"{index_dir}.tmp-{os.getpid()}"
+                    os.makedirs(tmp_dir, exist_ok=True)
+                    for row in pd.read_parquet(index_path).to_dict("records"):
+                        _write_json(opj(tmp_dir, f"{row['key']}.json"), {column: value.item() if isinstance(value, np.generic) else value for column, value in row.items()})
+                    os.replace(tmp_dir, index_dir)
+
+        return index_dir
+
+    def index(self):
+        """
+        Returns the index of the stored images (one row per key).
+        """
+        import pandas as pd
+
+        index_dir = self._index_dir()
+        index_path = opj(self.store_dir, INDEX_FILE)
+        if not os.path.isdir(index_dir):
+            return pd.DataFrame(columns=["key", "n_timepoints", "in_file", "mtime"])
+
+        # index.parquet carries the modification time of index/ it was merged from
+        if os.path.exists(index_path) and os.stat(index_path).st_mtime_ns == os.stat(index_dir).st_mtime_ns:
+            return pd.read_parquet(index_path)
+
+        with file_lock(index_path):
+            # rows written from now on change it again, the next read merges them
+            dir_mtime = os.stat(index_dir).st_mtime_ns
+            rows = [_read_json(opj(index_dir, name)) for name in sorted(os.listdir(index_dir)) if name.endswith(".json")]
+            rows = [row for row in rows if row is not None]
+            index = pd.DataFrame(rows) if rows else pd.DataFrame(columns=["key", "n_timepoints", "in_file", "mtime"])
+
+            tmp_index_path = f"{index_path}.tmp-{os.getpid()}"
+            index.to_parquet(tmp_index_path, index=False)
+            os.utime(tmp_index_path, ns=(dir_mtime, dir_mtime))
+            os.replace(tmp_index_path, index_path)
+
+        return index
+
+    def entries(self, **filters):
+        """
+        Returns the index rows matching the metadata filters, ex: entries(subject_id="X", session="baselineYear1Arm1").
+        A list value matches any of its values.
+        """
+        index = self.index()
+        for column, value in filters.items():
+            if column not in index.columns:
+                raise KeyError(f"No {column} in the index of {self.store_dir}, columns: {list(index.columns)}")
+            index = index[index[column].isin(value if isinstance(value, (list, tuple, set)) else [value])]
+
+        return index
+
+    def _chunks(self, img):
+        """
+        Yields (start, {roi_num: ROI voxels x timepoints}) per time chunk of an image (3D: one timepoint).
+        """
+        n_timepoints = img.shape[3] if len(img.shape) == 4 else 1
+
+        for start in range(0, n_timepoints, self.time_chunk):
+            stop = min(start + self.time_chunk, n_timepoints)
+            # only this chunk of the volumes in memory
+            data = np.asarray(img.dataobj[..., start:stop] if len(img.shape) == 4 else img.dataobj, dtype=np.float32)
+            data = data.reshape(tuple(self.shape) + (stop - start,))
+
+            yield start, {roi_num: data[voxels] for roi_num, voxels in self.voxels.items()}
+
+    def write(self, key: str, in_file: str, force: bool = False, **metadata) -> bool:
+        """
+        Stores the ROI voxel values of in_file (3D, or 4D timeseries) under key, with metadata
+        (ex: subject_id, session, run, image_name, registration) in the index. Skipped if key
+        was already stored from the same unmodified in_file (unless force).
+
+        Returns True if the image was written.
+        """
+        from common.nifti_io import load_nifti
+
+        mtime = os.path.getmtime(in_file)
+
+        row_path = opj(self._index_dir(), f"{key}.json")
+        stored = _read_json(row_path)
+        if not force and stored is not None and stored["in_file"] == in_file and stored["mtime"] == mtime:
+            return False
+
+        # seekable gzip (or the decompressed copy of the cache), each chunk only reads its volumes
+        img = load_nifti(in_file)
+        if tuple(img.shape[:3]) != tuple(self.shape):
+            raise ValueError(f"{in_file} has shape {img.shape}, the store's atlas {tuple(self.shape)}")
+        if not np.allclose(img.affine, self.affine, atol=1e-4):
+            raise ValueError(f"{in_file} is not in the space of the store's atlas")
+
+        path = self.array_path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+
+        arrays = {}
+        for start, roi_values in self._chunks(img):
+            for roi_num, values in roi_values.items():
+                arrays[_chunk_name(roi_num, start)] = values
+
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+        row = {"key": key, "n_timepoints": img.shape[3] if len(img.shape) == 4 else 1, "in_file": in_file, "mtime": mtime, **metadata}
+
+        # the row last, the image is complete once it exists
+        os.makedirs(os.path.dirname(row_path), exist_ok=True)
+        _write_json(row_path, {column: value.item() if isinstance(value, np.generic) else value for column, value in row.items()})
+
+        return True
+
+    def read(self, key: str, roi_num: int, time: slice = None) -> np.ndarray:
+        """
+        Returns the values (float32, ROI voxels x timepoints) of one ROI of a stored image,
+        only of the timepoints of time (ex: slice(100, 200)), decompressing only their chunks.
+        """
+        if roi_num not in self.voxels:
+            raise KeyError(f"No ROI {roi_num} in the array store {self.store_dir}, ROIs: {self.roi_nums}")
+
+        with np.load(self.array_path(key)) as arrays:
+            starts = sorted([int(name.split("_t")[1]) for name in arrays.files if name.startswith(f"{_roi_name(roi_num)}_t")])
+            n_timepoints = starts[-1] + arrays[_chunk_name(roi_num, starts[-1])].shape[1] if starts else 0
+
+            start, stop, step = (time or slice(None)).indices(n_timepoints)
+            if step != 1:
+                raise ValueError("Only contiguous time windows (step 1) are supported")
+
+            chunks = [arrays[_chunk_name(roi_num, chunk_start)] for chunk_start in starts
+                      if chunk_start < stop and chunk_start + self.time_chunk > start]
+
+        if not chunks:
+            return np.zeros((len(self.voxels[roi_num][0]), 0), dtype=np.float32)
+
+        first = max(chunk_start for chunk_start in starts if chunk_start <= start)
+        return np.concatenate(chunks, axis=1)[:, start - first:stop - first]
+
+    def read_many(self, roi_num: int, time: slice = None, **filters):
+        """
+        Returns (index rows, [ROI voxels x timepoints of each row]) of the images matching the filters (entries).
+        """
+        entries = self.entries(**filters)
+
+        return entries, [self.read(key, roi_num, time) for key in entries["key"]]
+
+
+def store_index_node_func(keys: list, store_dir: str):
+    """
+    Join node function, checks that every image was stored. Returns (store_dir, index path).
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    from common.array_store import INDEX_FILE, ArrayStore
+
+    store = ArrayStore(store_dir)
+    stored = set(store.index()["key"])
+
+    missing = [key for key in keys if key not in stored]
+    if missing:
+        raise ValueError(f"{len(missing)} images are not in the array store {store_dir}, ex: {missing[:3]}")
+
+    print(f"ARRAY_STORE: {len(keys)} images in {store_dir} ({len(stored)} in total)")
+
+    return store_dir, os.path.join(store_dir, INDEX_FILE)
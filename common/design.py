@@ -0,0 +1,350 @@
+"""
+Group designs (design matrix, contrasts, exchangeability blocks) from a subjects
+table and a formula, instead of FSL design files made in the FEAT GUI (ex:
+randomise/base_design_hla_stuff), plus a GLM fitting all contrasts at once.
+
+Formula: terms separated by "+"
+    "1 + cbcl_scr_syn_anxdep_t + cbcl_scr_syn_somatic_t"      intercept and two covariates
+    "0 + C(group)"                                              one column per level of group, no intercept
+    "1 + age + C(sex) + age:C(sex)"                             interactions with ":"
+The intercept is included unless the formula has a "0" term. Numeric columns are
+demeaned (as "demean EVs" in the GUI) unless demean=False. Categorical terms
+(C(column), or non numeric columns) are one-hot coded, without their first level
+when the design already spans it (intercept or an earlier categorical term).
+
+Contrasts: linear combinations of design column names
+    "cbcl_scr_syn_anxdep_t", "-cbcl_scr_syn_anxdep_t", "C(group)[patient] - C(group)[control]", "0.5*a + 0.5*b"
+
+The rows of the design are the subjects in the order given (ex: the merged 4D
+image's subject order sidecar, or a group store's rows); subjects missing from the
+table or with missing values are left out (Design.subject_ids are the rows kept).
+
+Usage:
+    table = read_subjects_table("subjects/tsv/pilot_anx_cases.tsv")
+    design = build_design(table, "1 + cbcl_scr_syn_anxdep_t", {"anx_pos": "cbcl_scr_syn_anxdep_t", "anx_neg": "-cbcl_scr_syn_anxdep_t"}, subject_ids)
+    write_fsl_design(design, "designs/anx")     # anx.mat, anx.con, anx.grp, anx_subjects.txt
+    fit = fit_glm(Y, design)                    # Y: subjects (design.subject_ids) x voxels
+"""
+import os
+import re
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+# voxels per GLM chunk (subjects x chunk float64 residuals in memory)
+VOXEL_CHUNK_SIZE = 65536
+
+CATEGORICAL_REGEX = re.compile(r"^C\((.+)\)$")
+
+
+class Design(NamedTuple):
+    X: np.ndarray
+    columns: list
+    contrasts: np.ndarray
+    contrast_names: list
+    # exchangeability block of each row (1..n_blocks)
+    groups: np.ndarray
+    subject_ids: list
+    formula: str
+
+
+def normalize_subject_id(subject_id: str) -> str:
+    """
+    Ex: sub-NDARINV003RTV85 -> NDARINV003RTV85
+    """
+    subject_id = str(subject_id).strip()
+    return subject_id[len("sub-"):] if subject_id.startswith("sub-") else subject_id
+
+
+def read_subjects_table(path: str, id_column: str = "src_subject_id") -> pd.DataFrame:
+    """
+    Returns a subjects table (.tsv or .csv) indexed by subject id (without sub-).
+    """
+    table = pd.read_csv(path, sep="\t" if path.endswith(".tsv") else ",")
+    if id_column not in table.columns:
+        raise ValueError(f"{path} has no {id_column} column, columns: {list(table.columns)}")
+
+    table.index = [normalize_subject_id(subject_id) for subject_id in table.pop(id_column)]
+    table.index.name = "subject_id"
+
+    duplicated = table.index.duplicated()
+    if duplicated.any():
+        raise ValueError(f"{path} has {duplicated.sum()} duplicated subject ids, ex: {list(table.index[duplicated][:3])}")
+
+    return table
+
+
+def _split_top_level(expression: str, separators: str) -> list:
+    """
+    Splits at the separators outside of brackets, keeping each separator with the part it starts.
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(expression):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char in separators and depth == 0 and i > start and expression[start:i].strip():
+            parts.append(expression[start:i])
+            start = i
+
+    parts.append(expression[start:])
+
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _variable_names(formula: str) -> list:
+    names = []
+    for term in _split_top_level(formula, "+"):
+        term = term.lstrip("+").strip()
+        if term in ["0", "1"]:
+            continue
+        for factor in term.split(":"):
+            match = CATEGORICAL_REGEX.match(factor.strip())
+            names.append(match.group(1).strip() if match else factor.strip())
+
+    return list(dict.fromkeys(names))
+
+
+def _code_factor(table: pd.DataFrame, factor: str, drop_first: bool, demean: bool):
+    """
+    Returns (column names, n x columns values) of one factor of a term.
+    """
+    match = CATEGORICAL_REGEX.match(factor)
+    name = match.group(1).strip() if match else factor
+
+    values = table[name]
+    if match is None and pd.api.types.is_numeric_dtype(values):
+        values = values.to_numpy(dtype=np.float64)
+        return [name], (values - values.mean() if demean else values)[:, None]
+
+    levels = sorted(values.astype(str).unique())
+    if drop_first:
+        levels = levels[1:]
+
+    label = f"C({name})"
+    return [f"{label}[{level}]" for level in levels], np.stack([(values.astype(str) == level).to_numpy(dtype=np.float64) for level in levels], axis=1)
+
+
+def design_matrix(table: pd.DataFrame, formula: str, demean: bool = True):
+    """
+    Returns (X, column names) of a formula over the rows of table (no missing values).
+    """
+    terms = [term.lstrip("+").strip() for term in _split_top_level(formula, "+")]
+
+    intercept = "0" not in terms
+    columns = ["intercept"] if intercept else []
+    values = [np.ones((len(table), 1))] if intercept else []
+
+    # an intercept, or the first categorical term coded with all its levels, span the constant
+    spans_constant = intercept
+
+    for term in terms:
+        if term in ["0", "1"]:
+            continue
+
+        term_columns, term_values = [""], np.ones((len(table), 1))
+        for factor in [factor.strip() for factor in term.split(":")]:
+            is_categorical = CATEGORICAL_REGEX.match(factor) is not None or not pd.api.types.is_numeric_dtype(table[factor])
+
+            factor_columns, factor_values = _code_factor(table, factor, drop_first=spans_constant and is_categorical, demean=demean)
+            if is_categorical and ":" not in term:
+                spans_constant = True
+
+            term_columns = [f"{a}:{b}" if a else b for a in term_columns for b in factor_columns]
+            term_values = (term_values[:, :, None] * factor_values[:, None, :]).reshape(len(table), -1)
+
+        columns.extend(term_columns)
+        values.append(term_values)
+
+    X = np.concatenate(values, axis=1) if values else np.zeros((len(table), 0))
+
+    return X, columns
+
+
+def parse_contrast(expression: str, columns: list) -> np.ndarray:
+    """
+    Returns the weights (one per design column) of a contrast expression.
+    """
+    weights = np.zeros(len(columns))
+
+    for part in _split_top_level(expression.strip(), "+-"):
+        sign = -1.0 if part.startswith("-") else 1.0
+        part = part.lstrip("+-").strip()
+
+        coefficient = 1.0
+        factors = _split_top_level(part, "*")
+        if len(factors) == 2:
+            coefficient, part = float(factors[0]), factors[1].lstrip("*").strip()
+
+        if part not in columns:
+            raise ValueError(f"Unknown design column {part} in contrast {expression}, columns: {columns}")
+
+        weights[columns.index(part)] += sign * coefficient
+
+    return weights
+
+
+def parse_contrasts(specs: list) -> dict:
+    """
+    Contrasts of the command lines ([name=]expression, the expression is the name if there is none).
+
+    Ex: ["anx_pos=cbcl_scr_syn_anxdep_t", "-cbcl_scr_syn_anxdep_t"] -> {"anx_pos": "cbcl_scr_syn_anxdep_t", "-cbcl_scr_syn_anxdep_t": "-cbcl_scr_syn_anxdep_t"}
+    """
+    contrasts = {}
+    for spec in specs:
+        name, _, expression = spec.partition("=") if "=" in spec else (spec, "", spec)
+        contrasts[name.strip()] = expression.strip()
+    return contrasts
+
+
+def build_design(table: pd.DataFrame, formula: str, contrasts, subject_ids: list = None, blocks: str = None,
+                 demean: bool = True, verbose: bool = True) -> Design:
+    """
+    Builds a design from a subjects table (read_subjects_table) and a formula.
+
+    contrasts: {name: expression}, or a list of expressions (named by themselves)
+    subject_ids: rows of the design, in order (default: the table's subjects)
+    blocks: column of the exchangeability blocks (randomise -e), default: one block
+    """
+    if not isinstance(contrasts, dict):
+        contrasts = {expression: expression for expression in contrasts}
+
+    subject_ids = list(table.index) if subject_ids is None else [normalize_subject_id(subject_id) for subject_id in subject_ids]
+
+    variables = _variable_names(formula) + ([blocks] if blocks is not None else [])
+    missing_columns = [variable for variable in variables if variable not in table.columns]
+    if missing_columns:
+        raise ValueError(f"Columns {missing_columns} are not in the subjects table, columns: {list(table.columns)}")
+
+    not_in_table = [subject_id for subject_id in subject_ids if subject_id not in table.index]
+    rows = table.reindex([subject_id for subject_id in subject_ids if subject_id in table.index])[variables]
+    incomplete = rows.isna().any(axis=1)
+    rows = rows[~incomplete]
+
+    if verbose and (not_in_table or incomplete.any()):
+        print(f"WARN: {len(not_in_table)} subjects not in the subjects table and {incomplete.sum()} with missing values are left out of the design")
+
+    X, columns = design_matrix(rows, formula, demean=demean)
+
+    rank = np.linalg.matrix_rank(X) if X.size else 0
+    if rank < X.shape[1]:
+        raise ValueError(f"Design {formula} is rank deficient (rank {rank}, {X.shape[1]} columns: {columns})")
+    if X.shape[0] <= rank:
+        raise ValueError(f"Design {formula} has {X.shape[0]} subjects for {X.shape[1]} columns")
+
+    contrast_matrix = np.stack([parse_contrast(expression, columns) for expression in contrasts.values()])
+
+    if blocks is None:
+        groups = np.ones(len(rows), dtype=int)
+    else:
+        groups = pd.factorize(rows[blocks], sort=True)[0] + 1
+
+    return Design(X=X, columns=columns, contrasts=contrast_matrix, contrast_names=list(contrasts), groups=groups,
+                  subject_ids=list(rows.index), formula=formula)
+
+
+def _pp_heights(values: np.ndarray) -> str:
+    # peak-to-peak height of each column (a constant column: its value)
+    heights = np.where(np.ptp(values, axis=0) > 0, np.ptp(values, axis=0), np.abs(values).max(axis=0))
+    return "/PPheights\t\t" + "\t".join([f"{height:e}" for height in heights]) + "\n"
+
+
+def _vest_header(n_waves: int, n_points: int = None) -> str:
+    header = f"/NumWaves\t{n_waves}\n"
+    if n_points is not None:
+        header += f"/NumPoints\t{n_points}\n"
+    return header
+
+
+def write_fsl_design(design: Design, out_prefix: str) -> dict:
+    """
+    Writes the design as FSL files (<out_prefix>.mat, .con, .grp, as written by the
+    FEAT GUI) and the subject of each row (<out_prefix>_subjects.txt). Returns {name: path}.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(out_prefix)), exist_ok=True)
+
+    X = design.X
+    paths = {key: f"{out_prefix}.{key}" for key in ["mat", "con", "grp"]}
+    paths["subjects"] = f"{out_prefix}_subjects.txt"
+
+    with open(paths["mat"], "w") as file:
+        file.write(_vest_header(X.shape[1], X.shape[0]))
+        file.write(_pp_heights(X) + "\n/Matrix\n")
+        for row in X:
+            file.write("".join([f"{value:e}\t" for value in row]) + "\n")
+
+    with open(paths["con"], "w") as file:
+        for i, name in enumerate(design.contrast_names):
+            file.write(f"/ContrastName{i + 1}\t{name} \n")
+        file.write(_vest_header(X.shape[1]))
+        file.write(f"/NumContrasts\t{len(design.contrasts)}\n")
+        file.write(_pp_heights(X @ design.contrasts.T) + "\n/Matrix\n")
+        for row in design.contrasts:
+            file.write("".join([f"{value:e} " for value in row]) + "\n")
+
+    with open(paths["grp"], "w") as file:
+        file.write(_vest_header(1, len(design.groups)))
+        file.write("\n/Matrix\n")
+        for group in design.groups:
+            file.write(f"{group}\n")
+
+    with open(paths["subjects"], "w") as file:
+        file.write("\n".join(design.subject_ids) + "\n")
+
+    return paths
+
+
+def read_vest(path: str) -> np.ndarray:
+    """
+    Returns the /Matrix of an FSL VEST file (.mat, .con, .grp).
+    """
+    with open(path, "r") as file:
+        lines = file.read().splitlines()
+
+    start = lines.index("/Matrix") + 1
+    return np.array([[float(value) for value in line.split()] for line in lines[start:] if line.strip()])
+
+
+def fit_glm(Y, design: Design, chunk_size: int = VOXEL_CHUNK_SIZE) -> dict:
+    """
+    Fits the design to every column of Y (subjects x voxels, rows in design.subject_ids
+    order, may be memory-mapped) and computes all contrasts at once.
+
+    Returns {"beta": regressors x voxels, "cope": contrasts x voxels, "varcope",
+    "t": contrasts x voxels, "sigma2": voxels, "dof"}.
+    """
+    X = design.X
+    C = design.contrasts
+
+    if Y.shape[0] != X.shape[0]:
+        raise ValueError(f"Y has {Y.shape[0]} rows, the design {X.shape[0]} subjects")
+
+    pinv_X = np.linalg.pinv(X)
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+
+    # variance of each contrast per unit residual variance
+    contrast_scale = np.einsum("ij,jk,ik->i", C, np.linalg.pinv(X.T @ X), C)
+
+    n_voxels = Y.shape[1]
+    beta = np.empty((X.shape[1], n_voxels))
+    sigma2 = np.empty(n_voxels)
+
+    for start in range(0, n_voxels, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        Y_chunk = np.asarray(Y[:, chunk], dtype=np.float64)
+
+        beta[:, chunk] = pinv_X @ Y_chunk
+        residuals = Y_chunk - X @ beta[:, chunk]
+        sigma2[chunk] = np.einsum("ij,ij->j", residuals, residuals) / dof
+
+    cope = C @ beta
+    varcope = contrast_scale[:, None] * sigma2[None, :]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(varcope > 0, cope / np.sqrt(varcope), 0)
+
+    return {"beta": beta, "cope": cope, "varcope": varcope, "t": t, "sigma2": sigma2, "dof": dof}
@@ -0,0 +1,347 @@
+"""
+Masked subjects x voxels store of the registered images of the group analyses.
+
+The in-mask voxels (mask > 0, C order of the volume) of every registered image are
+extracted once into one float32 subjects x voxels matrix per group (ex: the merge
+group zfstat1_task-sst_ses-baselineYear1Arm1_run-01_flirt). Later steps read the
+matrix (memory-mapped) instead of decompressing the NIfTIs again: the native
+permutation engine, the group summaries (summary / write_summary) and the ROI means
+(roi_means).
+
+Layout of a store directory (one mask per store):
+    store.json              mask file, shape, affine and hash of the mask
+    <group>.npy             rows: subjects in append order, a regular .npy (np.load(..., mmap_mode="r"))
+    <group>.json            subject order, source of each row, group metadata (contrast, session, LN/NL, ...),
+                            generation (appends that wrote rows)
+
+Groups are appendable: append() adds the rows of new subjects at the end of the
+matrix (its .npy header has a fixed size and is rewritten in place) and replaces
+the rows of subjects whose source changed in a copy of the matrix that is renamed
+over it (a reader keeps the matrix it opened). Appends to a group take its file lock
+(common/locking.py), the sidecar is written last, so readers only see complete rows.
+
+Usage:
+    store = GroupStore(opj(working_dir, "group_store"), mask_file=MNI_template)
+    store.append("zfstat1_..._flirt", registered_files, subject_ids, sources=zfstat_files, contrast=1, session="baselineYear1Arm1", variant="LN")
+    Y, subject_ids = store.matrix("zfstat1_..._flirt")
+"""
+import hashlib
+import json
+import os
+import shutil
+import struct
+from os.path import join as opj
+
+import numpy as np
+
+from common.locking import file_lock
+
+STORE_FILE = "store.json"
+
+# fixed .npy header size, the header (row count) is rewritten in place on append
+HEADER_SIZE = 128
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+# rows per read of the summaries
+ROW_CHUNK_SIZE = 64
+
+
+def _npy_header(n_rows: int, n_voxels: int) -> bytes:
+    header = repr({"descr": "<f4", "fortran_order": False, "shape": (n_rows, n_voxels)})
+    header = header.ljust(HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + "\n"
+
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def _mask_hash(mask: np.ndarray, affine: np.ndarray) -> str:
+    sha = hashlib.sha256()
+    sha.update(str(mask.shape).encode())
+    sha.update(np.packbits(mask).tobytes())
+    sha.update(np.round(affine, 4).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def _write_json(path: str, content: dict):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        json.dump(content, file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _source_mtime(source: str):
+    try:
+        return os.path.getmtime(source)
+    except OSError:
+        return None
+
+
+class GroupStore:
+    """
+    Store of the masked group matrices of one mask (see the module docstring).
+    """
+
+    def __init__(self, store_dir: str, mask_file: str = None):
+        """
+        mask_file: required to create the store, must be the store's mask (same voxels and affine) if given
+        """
+        import nibabel as nib
+
+        self.store_dir = store_dir
+        store_path = opj(store_dir, STORE_FILE)
+
+        if os.path.exists(store_path):
+            with open(store_path, "r") as file:
+                self.info = json.load(file)
+            mask_file = mask_file or self.info["mask_file"]
+
+        elif mask_file is None:
+            raise FileNotFoundError(f"No group store in {store_dir}, a mask_file is needed to create it")
+
+        mask_img = nib.load(mask_file)
+        self.mask = np.asanyarray(mask_img.dataobj) > 0
+        self.affine = mask_img.affine
+        self.n_voxels = int(self.mask.sum())
+
+        info = {
+            "mask_file": os.path.abspath(mask_file),
+            "mask_hash": _mask_hash(self.mask, self.affine),
+            "shape": list(self.mask.shape),
+            "affine": self.affine.tolist(),
+            "n_voxels": self.n_voxels,
+        }
+
+        if not os.path.exists(store_path):
+            os.makedirs(store_dir, exist_ok=True)
+            _write_json(store_path, info)
+            self.info = info
+        elif self.info["mask_hash"] != info["mask_hash"]:
+            raise ValueError(f"{mask_file} is not the mask of the group store {store_dir} ({self.info['mask_file']})")
+
+    def matrix_path(self, name: str) -> str:
+        return opj(self.store_dir, f"{name}.npy")
+
+    def _sidecar_path(self, name: str) -> str:
+        return opj(self.store_dir, f"{name}.json")
+
+    def groups(self) -> list:
+        """
+        Returns the names of the stored groups.
+        """
+        return sorted([file[:-len(".json")] for file in os.listdir(self.store_dir) if file.endswith(".json") and file != STORE_FILE])
+
+    def metadata(self, name: str) -> dict:
+        """
+        Returns the sidecar of a group: metadata, "subjects" (subject_id, in_file, source, mtime of each row).
+        """
+        path = self._sidecar_path(name)
+        if not os.path.exists(path):
+            return {"name": name, "subjects": []}
+
+        with open(path, "r") as file:
+            return json.load(file)
+
+    def subject_ids(self, name: str) -> list:
+        return [row["subject_id"] for row in self.metadata(name)["subjects"]]
+
+    def generation(self, name: str) -> int:
+        """
+        Returns the number of appends that wrote rows of the group (changes whenever its matrix does).
+        """
+        return self.metadata(name).get("generation", 0)
+
+    def _extract(self, in_file: str) -> np.ndarray:
+        from common.nifti_io import load_nifti
+
+        img = load_nifti(in_file)
+
+        # FSL writes some 3D outputs as 4D with a single volume
+        shape = img.shape[:3] if len(img.shape) == 4 and img.shape[3] == 1 else img.shape
+        if shape != self.mask.shape:
+            raise ValueError(f"{in_file} has shape {shape}, the store's mask {self.mask.shape}")
+        if not np.allclose(img.affine, self.affine, atol=1e-4):
+            raise ValueError(f"{in_file} is not in the space of the store's mask")
+
+        return np.asarray(img.dataobj, dtype=np.float32).reshape(shape)[self.mask]
+
+    def append(self, name: str, in_files: list, subject_ids: list, sources: list = None, **metadata) -> int:
+        """
+        Adds the in-mask voxels of in_files (one per subject) to the group: new subjects are
+        appended, subjects whose source (default: the in_file) changed or was modified since
+        are replaced, the others are skipped. metadata (ex: contrast, session, task, run,
+        registration, variant) is recorded in the group's sidecar.
+
+        Returns the number of rows written.
+        """
+        sources = in_files if sources is None else sources
+        if not len(in_files) == len(subject_ids) == len(sources):
+            raise ValueError(f"{len(in_files)} files, {len(subject_ids)} subject ids and {len(sources)} sources")
+
+        matrix_path = self.matrix_path(name)
+        row_bytes = self.n_voxels * 4
+
+        with file_lock(matrix_path):
+            sidecar = self.metadata(name)
+            rows = sidecar["subjects"]
+            row_of = {row["subject_id"]: i for i, row in enumerate(rows)}
+
+            if not os.path.exists(matrix_path):
+                with open(matrix_path, "wb") as file:
+                    file.write(_npy_header(0, self.n_voxels))
+
+            # rows to write, {index: in_file}
+            n_rows = len(rows)
+            writes = {}
+            for in_file, subject_id, source in zip(in_files, subject_ids, sources):
+                row = {"subject_id": subject_id, "in_file": in_file, "source": source, "mtime": _source_mtime(source)}
+
+                index = row_of.get(subject_id)
+                if index is not None and rows[index]["source"] == row["source"] and rows[index]["mtime"] == row["mtime"]:
+                    continue
+
+                if index is None:
+                    index = len(rows)
+                    row_of[subject_id] = index
+                    rows.append(row)
+                else:
+                    rows[index] = row
+                writes[index] = in_file
+
+            # replaced rows are written to a copy of the matrix, new rows past the sidecar's rows
+            replaces = any([index < n_rows for index in writes])
+            target_path = f"{matrix_path}.tmp-{os.getpid()}" if replaces else matrix_path
+            if replaces:
+                shutil.copyfile(matrix_path, target_path)
+
+            try:
+                with open(target_path, "r+b") as file:
+                    # drop the rows of an append that crashed before its sidecar was written
+                    file.truncate(HEADER_SIZE + n_rows * row_bytes)
+
+                    for index, in_file in writes.items():
+                        file.seek(HEADER_SIZE + index * row_bytes)
+                        file.write(self._extract(in_file).tobytes())
+
+                    file.seek(0)
+                    file.write(_npy_header(len(rows), self.n_voxels))
+            except BaseException:
+                if replaces:
+                    os.remove(target_path)
+                raise
+
+            if replaces:
+                os.replace(target_path, matrix_path)
+            n_written = len(writes)
+
+            sidecar.update(metadata)
+            sidecar.update({"name": name, "n_voxels": self.n_voxels, "subjects": rows,
+                            "generation": sidecar.get("generation", 0) + (1 if n_written else 0)})
+            _write_json(self._sidecar_path(name), sidecar)
+
+        return n_written
+
+    def matrix(self, name: str, subject_ids: list = None, mmap: bool = True):
+        """
+        Returns (subjects x voxels matrix, subject ids) of a group, memory-mapped.
+        subject_ids: only these rows, in this order (a copy)
+        """
+        stored_ids = self.subject_ids(name)
+        if not stored_ids:
+            raise FileNotFoundError(f"No group {name} in the group store {self.store_dir}")
+
+        # the sidecar's rows, rows of an append in progress are not counted yet
+        matrix = np.memmap(self.matrix_path(name), dtype="<f4", mode="r", offset=HEADER_SIZE, shape=(len(stored_ids), self.n_voxels))
+        if not mmap:
+            matrix = np.array(matrix)
+
+        if subject_ids is None:
+            return matrix, stored_ids
+
+        row_of = {subject_id: i for i, subject_id in enumerate(stored_ids)}
+        missing = [subject_id for subject_id in subject_ids if subject_id not in row_of]
+        if missing:
+            raise KeyError(f"{len(missing)} subjects not in {name}, ex: {missing[:3]}")
+
+        return np.asarray(matrix[[row_of[subject_id] for subject_id in subject_ids]]), list(subject_ids)
+
+    def unmask(self, values: np.ndarray) -> np.ndarray:
+        """
+        Returns the volume of in-mask values (zeros outside the mask).
+        """
+        volume = np.zeros(self.mask.shape, dtype=np.float32)
+        volume[self.mask] = values
+        return volume
+
+    def summary(self, name: str) -> dict:
+        """
+        Returns {"n", "mean", "std"} (per voxel, std with ddof 1) of a group, read in chunks of rows.
+        """
+        matrix, subject_ids = self.matrix(name)
+
+        total = np.zeros(self.n_voxels)
+        total_squares = np.zeros(self.n_voxels)
+        for start in range(0, len(matrix), ROW_CHUNK_SIZE):
+            rows = np.asarray(matrix[start:start + ROW_CHUNK_SIZE], dtype=np.float64)
+            total += rows.sum(axis=0)
+            total_squares += (rows ** 2).sum(axis=0)
+
+        n = len(subject_ids)
+        mean = total / n
+        variance = (total_squares - n * mean ** 2) / max(n - 1, 1)
+
+        return {"n": n, "mean": mean, "std": np.sqrt(np.maximum(variance, 0))}
+
+    def write_summary(self, name: str, out_prefix: str) -> dict:
+        """
+        Writes the mean and std maps of a group (<out_prefix>_mean.nii.gz, _std.nii.gz). Returns {name: path}.
+        """
+        import nibabel as nib
+
+        summary = self.summary(name)
+
+        paths = {}
+        for key in ["mean", "std"]:
+            paths[key] = f"{out_prefix}_{key}.nii.gz"
+            nib.save(nib.Nifti1Image(self.unmask(summary[key]), self.affine), paths[key])
+
+        return paths
+
+    def roi_means(self, name: str, atlas_file: str, roi_nums: list = None):
+        """
+        Returns the mean of every ROI of a labelled atlas (on the mask's grid, ex: roi/grantmask_labeled.nii)
+        per subject of a group, as a DataFrame (subject_id, roi_num, avg, n_voxels + the group's metadata).
+        Only the ROI voxels inside the store's mask are averaged.
+        """
+        import nibabel as nib
+        import pandas as pd
+        from scipy.sparse import csr_matrix
+
+        atlas = np.asanyarray(nib.load(atlas_file).dataobj)
+        if atlas.shape[:3] != self.mask.shape:
+            raise ValueError(f"{atlas_file} has shape {atlas.shape}, the store's mask {self.mask.shape}")
+
+        labels = np.rint(atlas.reshape(self.mask.shape)[self.mask]).astype(np.int64)
+        roi_nums = sorted(set(np.unique(labels)) - {0}) if roi_nums is None else list(roi_nums)
+
+        # voxels x ROIs averaging matrix
+        in_roi = np.isin(labels, roi_nums)
+        columns = np.searchsorted(roi_nums, labels[in_roi])
+        n_voxels = np.bincount(columns, minlength=len(roi_nums))
+        weights = csr_matrix((1.0 / n_voxels[columns], (np.flatnonzero(in_roi), columns)), shape=(self.n_voxels, len(roi_nums)))
+
+        matrix, subject_ids = self.matrix(name)
+        means = np.asarray((weights.T @ np.asarray(matrix, dtype=np.float64).T).T)
+        means[:, n_voxels == 0] = np.nan
+
+        table = pd.DataFrame({
+            "subject_id": np.repeat(subject_ids, len(roi_nums)),
+            "roi_num": np.tile(roi_nums, len(subject_ids)),
+            "avg": means.ravel(),
+            "n_voxels": np.tile(n_voxels, len(subject_ids)),
+        })
+
+        for key, value in self.metadata(name).items():
+            if key not in ["name", "subjects", "n_voxels", "generation"]:
+                table[key] = value
+
+        return table
+
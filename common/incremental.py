@@ -0,0 +1,315 @@
+"""
+Incremental extension of the aggregate outputs (roi/ roi_activations table,
+filtered-func-reg/ roi_timeseries.csv) when subjects are added to the cohort.
+
+An aggregate output is made of units (ex: subject, session, run, image, LN/NL for
+the ROI table), each computed from one source file. Next to the aggregate, a units
+manifest records the source of every unit and its modification time:
+    <dataset dir>/_units.parquet        (Parquet dataset, ignored by the dataset readers)
+    <name>_units.parquet                (next to a .csv)
+
+plan_units compares the candidate units of a run with the manifest: only new units
+and units whose source changed (other path or modified since) are computed.
+merge_rows then merges the rows of the computed units into the aggregate, under the
+aggregate's file lock (common/locking.py):
+    Parquet dataset     the new rows of each partition are added as a new file, the
+                        partitions holding replaced units are rewritten (one file)
+    csv                 rewritten with the replaced units' rows dropped
+every file is written to a temporary file and moved into place, the manifest last.
+So the cost of a run grows with the new subjects, not with the whole cohort.
+
+A Parquet merge is journaled: its units (_merge_units.parquet) and the partitions
+it touches (_merge.json) are written first. After a crash, the next merge rolls it
+back first: the rows of its units are dropped from those partitions (the rows of the
+other units copied by an interrupted rewrite are kept once) and the units from the
+manifest, so they are computed again. A csv merge drops the rows of all
+its units before adding theirs. A rerun never duplicates rows.
+
+Aggregates written before the manifest existed: their units are read from the
+table itself and kept as they are (their sources are unknown).
+
+Usage:
+    to_compute = plan_units(candidates, aggregate_path, ROI_UNIT_COLUMNS)      # candidates: unit columns + source
+    ... compute the rows of to_compute ...
+    merge_rows(aggregate_path, rows, to_compute, ROI_UNIT_COLUMNS, partition_cols=["session", "image_name"])
+"""
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from common.locking import file_lock
+
+UNITS_FILE = "_units.parquet"
+
+# journal of a Parquet merge, removed once its manifest is in place
+MERGE_JOURNAL_FILE = "_merge.json"
+MERGE_UNITS_FILE = "_merge_units.parquet"
+
+# units of the roi/ activation table and of the filtered-func-reg/ timeseries csv
+ROI_UNIT_COLUMNS = ["subject_id", "session", "run", "image_name", "is_nonlinear"]
+TIMESERIES_UNIT_COLUMNS = ["subject_id", "session", "run"]
+
+
+def units_path(aggregate_path: str) -> str:
+    """
+    Returns the units manifest path of an aggregate (Parquet dataset directory or .csv).
+    """
+    if aggregate_path.endswith(".csv"):
+        return f"{aggregate_path[:-len('.csv')]}_units.parquet"
+
+    return os.path.join(aggregate_path, UNITS_FILE)
+
+
+def _keys(table: pd.DataFrame, unit_columns: list) -> pd.MultiIndex:
+    # compare as strings, the dtypes differ between the manifest, the table and the candidates
+    return pd.MultiIndex.from_arrays([table[column].astype(str).to_numpy() for column in unit_columns], names=unit_columns)
+
+
+def _mtime(path: str):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return np.nan
+
+
+def _write_parquet(table: pd.DataFrame, path: str):
+    # hidden temporary file, the dataset readers skip it
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp-{os.getpid()}")
+    table.to_parquet(tmp_path, index=False, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+def load_units(aggregate_path: str, unit_columns: list) -> pd.DataFrame:
+    """
+    Returns the units of an aggregate (unit columns, source, source_mtime), empty if it does not exist.
+    """
+    path = units_path(aggregate_path)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+
+    empty = pd.DataFrame(columns=unit_columns + ["source", "source_mtime"])
+    if not os.path.exists(aggregate_path):
+        return empty
+
+    # aggregate without a manifest: its units, sources unknown
+    if os.path.isdir(aggregate_path):
+        table = pd.read_parquet(aggregate_path, columns=unit_columns)
+    else:
+        table = pd.read_csv(aggregate_path, usecols=unit_columns)
+
+    units = table.drop_duplicates().reset_index(drop=True)
+    units["source"] = None
+    units["source_mtime"] = np.nan
+
+    print(f"WARN: {aggregate_path} has no units manifest, its {len(units)} units are kept as they are")
+
+    return units
+
+
+def plan_units(candidates: pd.DataFrame, aggregate_path: str, unit_columns: list, n_workers: int = 32) -> pd.DataFrame:
+    """
+    Returns the candidates (unit columns + source) to compute, with their source_mtime: units not in
+    the aggregate yet, and units whose source is another path or was modified since.
+    """
+    candidates = candidates.reset_index(drop=True).copy()
+
+    # stat in parallel, slow on NFS
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        candidates["source_mtime"] = list(executor.map(_mtime, candidates["source"]))
+
+    units = load_units(aggregate_path, unit_columns)
+    units = units.set_index(_keys(units, unit_columns))
+    units = units[~units.index.duplicated(keep="last")]
+
+    keys = _keys(candidates, unit_columns)
+    existing = units.reindex(keys)
+
+    is_new = ~keys.isin(units.index)
+    # units without a recorded source (aggregate without a manifest) are kept
+    changed = ~is_new & existing["source"].notna().to_numpy() & ((existing["source"].to_numpy() != candidates["source"].to_numpy()) |
+                                                                 (existing["source_mtime"].to_numpy() != candidates["source_mtime"].to_numpy()))
+
+    to_compute = candidates[is_new | changed].reset_index(drop=True)
+
+    print(f"{len(candidates)} units: {len(candidates) - len(to_compute)} already in {aggregate_path}, "
+          f"{is_new.sum()} new, {changed.sum()} with changed sources to compute")
+
+    return to_compute
+
+
+def _concat_rows(existing: pd.DataFrame, rows: pd.DataFrame) -> pd.DataFrame:
+    # dtypes of the new rows, categorical columns get the categories of both (casting the existing
+    # rows to the new rows' categories would turn their other values into NaN)
+    categorical = [column for column, dtype in rows.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    merged = pd.concat([existing.astype({column: object for column in categorical if column in existing.columns}),
+                        rows.astype({column: object for column in categorical})], ignore_index=True)
+
+    dtypes = rows.dtypes.to_dict()
+    for column in categorical:
+        dtypes[column] = "category"
+
+    return merged.astype(dtypes)
+
+
+def _parquet_files(partition_dir: str) -> list:
+    return sorted([os.path.join(partition_dir, file) for file in os.listdir(partition_dir) if file.endswith(".parquet") and not file.startswith((".", "_"))])
+
+
+def _recover_dataset(aggregate_path: str, unit_columns: list):
+    """
+    Rolls back a merge that crashed before its manifest was written (see the module docstring).
+    """
+    journal_path = os.path.join(aggregate_path, MERGE_JOURNAL_FILE)
+    if not os.path.exists(journal_path):
+        return
+
+    with open(journal_path, "r") as file:
+        journal = json.load(file)
+    merge_units = _keys(pd.read_parquet(os.path.join(aggregate_path, MERGE_UNITS_FILE)), unit_columns)
+
+    print(f"WARN: {aggregate_path}: rolling back an interrupted merge ({len(merge_units)} units, computed again by the next run)")
+
+    partition_cols = journal["partition_cols"]
+    file_columns = [column for column in unit_columns if column not in partition_cols]
+
+    for partition_dir, partition in journal["partitions"]:
+        files = _parquet_files(partition_dir) if os.path.isdir(partition_dir) else []
+        if not files:
+            continue
+
+        in_partition = np.ones(len(merge_units), dtype=bool)
+        for column, value in zip(partition_cols, partition):
+            if column in unit_columns:
+                in_partition &= merge_units.get_level_values(column) == str(value)
+        units_here = pd.MultiIndex.from_arrays([merge_units.get_level_values(column)[in_partition] for column in file_columns], names=file_columns)
+
+        # a rewrite interrupted before it removed the other files copied their units: the rows of
+        # a unit are kept from the newest file holding it (a unit's rows are written to one file)
+        files = sorted(files, key=lambda path: os.stat(path).st_mtime_ns, reverse=True)
+        tables = []
+        seen = units_here
+        for file in files:
+            table = pd.read_parquet(file)
+            keys = _keys(table, file_columns)
+            tables.append(table[~keys.isin(seen)])
+            seen = seen.append(keys.unique())
+
+        # rerun from the start if this crashes, the rows are dropped again
+        _write_parquet(pd.concat(tables[::-1], ignore_index=True), files[0])
+        for file in files[1:]:
+            os.remove(file)
+
+    stored_units = load_units(aggregate_path, unit_columns)
+    _write_parquet(stored_units[~_keys(stored_units, unit_columns).isin(merge_units)].reset_index(drop=True), units_path(aggregate_path))
+
+    os.remove(os.path.join(aggregate_path, MERGE_UNITS_FILE))
+    os.remove(journal_path)
+
+
+def _merge_dataset(aggregate_path: str, rows: pd.DataFrame, units: pd.DataFrame, replaced: pd.MultiIndex, unit_columns: list,
+                   partition_cols: list, merged_units: pd.DataFrame):
+    batch = uuid.uuid4().hex[:8]
+
+    # unit columns stored in the files, the partition columns are in the directory names
+    file_columns = [column for column in unit_columns if column not in partition_cols]
+
+    partitions = []
+    for partition, partition_rows in rows.groupby(partition_cols, sort=True, observed=True):
+        partition = partition if isinstance(partition, tuple) else (partition,)
+        partitions.append((os.path.join(aggregate_path, *[f"{column}={value}" for column, value in zip(partition_cols, partition)]), partition, partition_rows))
+
+    # journal first: the units of this merge and the partitions about to change
+    _write_parquet(units[unit_columns].reset_index(drop=True), os.path.join(aggregate_path, MERGE_UNITS_FILE))
+    journal_path = os.path.join(aggregate_path, MERGE_JOURNAL_FILE)
+    with open(f"{journal_path}.tmp-{os.getpid()}", "w") as file:
+        json.dump({"batch": batch, "partition_cols": partition_cols,
+                   "partitions": [(partition_dir, [str(value) for value in partition]) for partition_dir, partition, _ in partitions]}, file)
+    os.replace(f"{journal_path}.tmp-{os.getpid()}", journal_path)
+
+    for partition_dir, partition, partition_rows in partitions:
+        os.makedirs(partition_dir, exist_ok=True)
+
+        partition_rows = partition_rows.drop(columns=partition_cols)
+        files = _parquet_files(partition_dir)
+
+        # replaced units of this partition
+        in_partition = np.ones(len(replaced), dtype=bool)
+        for column, value in zip(partition_cols, partition):
+            if column in unit_columns:
+                in_partition &= replaced.get_level_values(column) == str(value)
+        replaced_here = pd.MultiIndex.from_arrays([replaced.get_level_values(column)[in_partition] for column in file_columns], names=file_columns)
+
+        if files and len(replaced_here):
+            # rewrite the partition as one file without the replaced (and merged) units' rows
+            existing = pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+            existing_keys = _keys(existing, file_columns)
+            existing = existing[~existing_keys.isin(replaced_here) & ~existing_keys.isin(_keys(partition_rows, file_columns))]
+            merged = _concat_rows(existing, partition_rows)
+
+            _write_parquet(merged, files[0])
+            for file in files[1:]:
+                os.remove(file)
+        else:
+            # only new units: one more file in the partition
+            _write_parquet(partition_rows, os.path.join(partition_dir, f"part-{batch}.parquet"))
+
+    # the manifest, then the end of the journal
+    _write_parquet(merged_units, units_path(aggregate_path))
+    os.remove(os.path.join(aggregate_path, MERGE_UNITS_FILE))
+    os.remove(journal_path)
+
+
+def merge_rows(aggregate_path: str, rows: pd.DataFrame, units: pd.DataFrame, unit_columns: list, partition_cols: list = None) -> str:
+    """
+    Merges the rows of the computed units (plan_units) into the aggregate: rows of units already in it are
+    replaced, the others appended. A Parquet dataset (partitioned by partition_cols) if the aggregate is
+    not a .csv. Returns aggregate_path.
+    """
+    rows = rows[_keys(rows, unit_columns).isin(_keys(units, unit_columns))]
+
+    is_csv = aggregate_path.endswith(".csv")
+    if not is_csv:
+        if partition_cols is None:
+            raise ValueError(f"partition_cols are needed to merge into the Parquet dataset {aggregate_path}")
+        if os.path.exists(aggregate_path) and not os.path.isdir(aggregate_path):
+            raise ValueError(f"{aggregate_path} is not a Parquet dataset directory")
+
+    with file_lock(aggregate_path):
+        if not is_csv and os.path.isdir(aggregate_path):
+            _recover_dataset(aggregate_path, unit_columns)
+
+        stored_units = load_units(aggregate_path, unit_columns)
+        replaced = _keys(units, unit_columns)
+        replaced = replaced[replaced.isin(_keys(stored_units, unit_columns))]
+
+        # the manifest after this merge
+        stored_units = stored_units[~_keys(stored_units, unit_columns).isin(_keys(units, unit_columns))]
+        units = units[unit_columns + ["source", "source_mtime"]]
+        merged_units = pd.concat([stored_units.astype({"source": object}), units], ignore_index=True) if len(stored_units) else units
+        merged_units = merged_units.reset_index(drop=True)
+
+        if is_csv:
+            table = rows
+            if os.path.exists(aggregate_path):
+                # all the merged units' rows are dropped, rows of a merge that crashed before its manifest included
+                existing = pd.read_csv(aggregate_path)
+                table = pd.concat([existing[~_keys(existing, unit_columns).isin(_keys(units, unit_columns))], rows], ignore_index=True)
+
+            tmp_path = f"{aggregate_path}.tmp-{os.getpid()}"
+            table.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, aggregate_path)
+
+            # manifest last, a crash before it recomputes the units of this merge
+            _write_parquet(merged_units, units_path(aggregate_path))
+        else:
+            os.makedirs(aggregate_path, exist_ok=True)
+            _merge_dataset(aggregate_path, rows, units, replaced, unit_columns, partition_cols, merged_units)
+
+    print(f"MERGE: {len(units)} units ({len(replaced)} replaced) merged into {aggregate_path}")
+
+    return aggregate_path
+
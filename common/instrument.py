@@ -0,0 +1,318 @@
+"""
+Structured timing and memory events of the pipeline nodes, written to a per-run
+event log (JSON lines), and a summary of the log.
+
+    start_run           creates the event log of a run (EVENT_LOG, inherited by the node processes)
+    measure             context of a Function node or FSL wrapper: wall and CPU time (with the FSL
+                        child processes), peak RSS, bytes read and written, cache hit or miss
+    status_callback     nipype status callback (plugin_args["status_callback"]): one event per node
+                        of the workflow, also the nodes without measure (FEAT, DataSink, ...)
+    summarize           p50/p95/max per node type and the slowest units of an event log
+
+start_run also samples the machine (CPU and memory utilization, load) every
+SAMPLE_INTERVAL seconds into the event log, for the timeline (common/timeline.py).
+
+An event:
+    {"time": "2024-05-02T10:31:07", "source": "node", "node_type": "flirt", "status": "ok",
+     "subject_id": "NDARINV00CY2MDM", "session": "baselineYear1Arm1", "run": 1, "image_name": "corGo",
+     "wall_s": 41.2, "cpu_s": 40.7, "peak_rss_mb": 612.0, "read_bytes": 73400320, "write_bytes": 4120000,
+     "cache": "miss", "host": "...", "pid": 1234, "start": 1714645867.1, "end": 1714645908.3}
+
+CPU time, peak RSS and bytes include the child processes the node waited for (FSL
+tools). The peak RSS is the peak of the worker process so far (workers run several nodes).
+
+Usage:
+    with measure("flirt", subject_id=subject_id, in_file=in_file) as event:
+        ...
+        event["cache"] = "hit"
+
+    python -m common.instrument roi/workingdir/event_logs/roi_2024-05-02_10-30-00.jsonl [--top 20]
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+SAMPLE_INTERVAL = 5.0 # seconds between the machine samples of a run
+
+# unit entities taken from the inputs of a node (status_callback)
+ENTITY_KEYS = ["subject_id", "session", "task", "run", "image_name", "is_nonlinear", "nonlinear",
+               "zfstat_path", "input_nifti", "input_nifti_path", "in_file", "feat_dir", "path", "group_name", "out_name", "chunk"]
+
+
+def event_log() -> str:
+    """
+    Returns the event log of this run (None if events are not recorded).
+    """
+    return os.getenv("EVENT_LOG") or None
+
+
+def _sample(interval: float, system_snapshot):
+    previous = system_snapshot()
+    while True:
+        time.sleep(interval)
+        snapshot = system_snapshot()
+        total_time = snapshot["cpu_total_time"] - previous["cpu_total_time"]
+        idle_time = snapshot["cpu_idle_time"] - previous["cpu_idle_time"]
+
+        emit({
+            "source": "sample",
+            "node_type": "machine",
+            "start": snapshot["time"],
+            "cpu_percent": round(100 * (1 - idle_time / total_time), 1) if total_time > 0 else None,
+            "mem_used_gb": round(snapshot["mem_total_gb"] - snapshot["mem_available_gb"], 2),
+            "mem_total_gb": round(snapshot["mem_total_gb"], 2),
+            "load_1min": snapshot["load_1min"],
+            "cpus": snapshot["cpus"],
+        })
+        previous = snapshot
+
+
+def start_run(log_dir: str, name: str, sample_interval: float = SAMPLE_INTERVAL) -> str:
+    """
+    Creates the event log <log_dir>/<name>_<timestamp>.jsonl of a run and sets EVENT_LOG for the nodes
+    (started after this), then samples the machine in a background thread until the process exits
+    (no samples if sample_interval is None). Returns its path.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    path = os.path.join(log_dir, f"{name}_{time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime())}.jsonl")
+    open(path, "a").close()
+
+    os.environ["EVENT_LOG"] = path
+    # nodes ended before this come from the nipype cache
+    os.environ["EVENT_LOG_START"] = str(time.time())
+    print(f"EVENTS: {path}")
+
+    if sample_interval is not None:
+        # imported here, not in the thread: the workers are forked while it runs
+        from common.scheduler import system_snapshot
+
+        threading.Thread(target=_sample, args=(sample_interval, system_snapshot), daemon=True).start()
+
+    return path
+
+
+def emit(event: dict):
+    """
+    Appends the event to the event log (one line, a single append write, so the processes do not interleave).
+    """
+    path = event_log()
+    if path is None:
+        return
+
+    line = json.dumps(event, default=str) + "\n"
+
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def _io_bytes() -> tuple:
+    # bytes read and written by this process and its waited for children (syscall level, page cache included)
+    try:
+        with open("/proc/self/io", "r") as file:
+            counters = dict([line.split(":") for line in file.read().splitlines()])
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _cpu_seconds() -> float:
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+@contextmanager
+def measure(node_type: str, **entities):
+    """
+    Measures the enclosed code and emits its event (see the module docstring). Yields the event,
+    the caller can add fields (ex: event["cache"] = "hit").
+    """
+    event = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+        "source": "node",
+        "node_type": node_type,
+        **entities,
+    }
+
+    event["start"] = time.time()
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_seconds()
+    start_read, start_write = _io_bytes()
+
+    status = "ok"
+    try:
+        yield event
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        end_read, end_write = _io_bytes()
+
+        event.update({
+            "status": status,
+            "wall_s": round(time.perf_counter() - start_wall, 3),
+            "cpu_s": round(_cpu_seconds() - start_cpu, 3),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "read_bytes": None if start_read is None else end_read - start_read,
+            "write_bytes": None if start_write is None else end_write - start_write,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+        })
+        event["end"] = event["start"] + event["wall_s"]
+        event.setdefault("cache", None)
+
+        emit(event)
+
+
+def status_callback(node, status: str):
+    """
+    nipype status callback, emits an event when a node ends (or fails) with its runtime and unit entities.
+    A node whose result comes from the nipype cache is a cache hit (no wall time).
+    """
+    if status not in ["end", "exception"]:
+        return
+
+    from datetime import datetime
+    from nipype.interfaces.base import isdefined
+
+    event = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+        "source": "workflow",
+        "node_type": node.name,
+        # the node in the execution graph (timeline critical path)
+        "node_id": getattr(node, "itername", node.name),
+        "status": "ok" if status == "end" else "error",
+    }
+
+    # entities of the unit, from the node's inputs and its iterables
+    try:
+        inputs = node.inputs.get()
+    except Exception:
+        inputs = {}
+    for key in ENTITY_KEYS:
+        if isdefined(inputs.get(key)) and isinstance(inputs.get(key), (str, int, float, bool)):
+            event[key] = inputs[key]
+
+    parameterization = getattr(node, "parameterization", None)
+    if parameterization:
+        event["unit"] = "/".join([str(value) for value in parameterization])
+
+    # the result file of the node (none if it failed early)
+    try:
+        runtime = node.result.runtime
+    except Exception:
+        runtime = None
+
+    if runtime is not None and not isinstance(runtime, list):
+        try:
+            start = datetime.fromisoformat(runtime.startTime).timestamp()
+            end = datetime.fromisoformat(runtime.endTime).timestamp()
+            is_cached = end < float(os.getenv("EVENT_LOG_START", "0"))
+        except (AttributeError, TypeError, ValueError):
+            start, end, is_cached = None, None, False
+
+        if not is_cached:
+            event["start"], event["end"] = start, end
+
+        event["cache"] = "hit" if is_cached else "miss"
+        event["wall_s"] = 0.0 if is_cached else getattr(runtime, "duration", None)
+        # only with the nipype resource monitor
+        event["peak_rss_mb"] = getattr(runtime, "mem_peak_gb", None) and runtime.mem_peak_gb * 1024
+        event["cpu_percent"] = getattr(runtime, "cpu_percent", None)
+        event["host"] = getattr(runtime, "hostname", None)
+
+    emit(event)
+
+
+def read_events(path: str):
+    """
+    Returns the events of an event log as a DataFrame.
+    """
+    import pandas as pd
+
+    with open(path, "r") as file:
+        events = [json.loads(line) for line in file if line.strip()]
+
+    return pd.DataFrame(events)
+
+
+def summarize(events, top: int = 10):
+    """
+    Returns (per node type summary, slowest units) of the events (read_events): count, errors,
+    wall time p50/p95/max/total, CPU time, peak RSS, bytes read and written, cache hit rate.
+    """
+    import numpy as np
+    import pandas as pd
+
+    events = events[events["source"] != "sample"].copy()
+    for column in ["wall_s", "cpu_s", "peak_rss_mb", "read_bytes", "write_bytes"]:
+        events[column] = pd.to_numeric(events[column], errors="coerce") if column in events.columns else np.nan
+    if "cache" not in events.columns:
+        events["cache"] = None
+
+    rows = []
+    for (source, node_type), group in events.groupby(["source", "node_type"], sort=False):
+        wall = group["wall_s"].dropna()
+        cached = group["cache"].dropna()
+        rows.append({
+            "source": source,
+            "node_type": node_type,
+            "n": len(group),
+            "errors": int((group["status"] == "error").sum()),
+            "wall_p50_s": wall.quantile(0.5) if len(wall) else np.nan,
+            "wall_p95_s": wall.quantile(0.95) if len(wall) else np.nan,
+            "wall_max_s": wall.max() if len(wall) else np.nan,
+            "wall_total_h": wall.sum() / 3600,
+            "cpu_total_h": group["cpu_s"].sum() / 3600,
+            "peak_rss_max_mb": group["peak_rss_mb"].max(),
+            "read_gb": group["read_bytes"].sum() / 1024 ** 3,
+            "write_gb": group["write_bytes"].sum() / 1024 ** 3,
+            "cache_hit_rate": (cached == "hit").mean() if len(cached) else np.nan,
+        })
+
+    summary = pd.DataFrame(rows).sort_values("wall_total_h", ascending=False).reset_index(drop=True)
+
+    entity_columns = [column for column in ENTITY_KEYS + ["unit"] if column in events.columns]
+    slowest = events.sort_values("wall_s", ascending=False).head(top)[["source", "node_type", "status", "wall_s", "cpu_s", "peak_rss_mb"] + entity_columns]
+
+    return summary, slowest.reset_index(drop=True)
+
+
+def print_summary(path: str, top: int = 10):
+    import pandas as pd
+
+    events = read_events(path)
+    if not len(events) or not (events["source"] != "sample").any():
+        print(f"No node events in {path}")
+        return
+
+    summary, slowest = summarize(events, top=top)
+
+    with pd.option_context("display.width", 250, "display.max_columns", None, "display.float_format", "{:.2f}".format):
+        print(f"Node types ({path}):")
+        print(summary.to_string(index=False))
+        print()
+        print(f"Slowest {top} units:")
+        print(slowest.dropna(axis=1, how="all").to_string(index=False))
+
+
+parser = argparse.ArgumentParser(description="Summary of a pipeline run's event log: p50/p95/max per node type and the slowest units")
+parser.add_argument("event_log", type=str, help="Event log (.jsonl) written by a run")
+parser.add_argument("--top", type=int, default=10, help="Number of slowest units")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print_summary(args.event_log, top=args.top)
@@ -0,0 +1,191 @@
+"""
+Persistent completion ledger for restartable pipelines.
+
+A unit of work (ex: one FEAT run: subject, session, task, run, LN/NL) is recorded
+together with the hash of the design it was computed with, but only once its
+outputs were verified to be complete. On restart the completed units are pruned
+from the iterables before the nipype graph is built, so nipype never has to walk
+or rehash them and only the unfinished work is run again. A changed design (new
+hash) makes every unit count as not completed. A unit is recorded per output path, so
+the units completed in one output directory (ex: a datasink) do not count for another.
+
+The ledger is a SQLite database, keep it on a local disk (ex: the working
+directory) rather than on NFS.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+UNITS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    stage TEXT NOT NULL,
+    unit_key TEXT NOT NULL,
+    design_hash TEXT NOT NULL,
+    output_path TEXT NOT NULL DEFAULT '',
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (stage, unit_key, design_hash, output_path)
+);
+"""
+
+RUNS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    stage TEXT NOT NULL,
+    output_dir TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    argv TEXT
+);
+"""
+
+SCHEMA = UNITS_SCHEMA + RUNS_SCHEMA
+
+
+def design_hash(*parts) -> str:
+    """
+    Returns a short hash of everything that changes a unit's outputs (design file
+    contents, variant, method, ...).
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+
+class Ledger:
+    """
+    Usage:
+        ledger = Ledger(opj(working_dir, "ledger.sqlite"))
+        done = ledger.completed("feat", design_hash)
+        ...
+        ledger.record("feat", ("NDARINV003RTV85", "baselineYear1Arm1", "sst", 1, "LN"), design_hash, feat_dir)
+    """
+
+    def __init__(self, path: str, timeout: float = 60.0, read_only: bool = False):
+        self.path = path
+        self.timeout = timeout
+        self.read_only = read_only
+
+        # read_only: never creates or changes anything (ex: --plan), the ledger must exist
+        if read_only:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        connection = self._connect()
+        try:
+            self._migrate(connection)
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _migrate(connection):
+        # ledgers written before the output path was part of a unit's key (one row per unit)
+        columns = connection.execute("PRAGMA table_info(units)").fetchall()
+        if not columns or any([name == "output_path" and pk > 0 for _, name, _, _, _, pk in columns]):
+            return
+
+        with connection:
+            connection.execute("ALTER TABLE units RENAME TO units_v1")
+            connection.execute(UNITS_SCHEMA)
+            connection.execute("INSERT INTO units SELECT stage, unit_key, design_hash, COALESCE(output_path, ''), completed_at FROM units_v1")
+            connection.execute("DROP TABLE units_v1")
+
+    def _connect(self):
+        if self.read_only:
+            return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=self.timeout)
+
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        # readers do not block the nodes recording their completion
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    @staticmethod
+    def _encode_key(key) -> str:
+        return json.dumps(list(key))
+
+    @staticmethod
+    def _decode_key(unit_key: str) -> tuple:
+        return tuple(json.loads(unit_key))
+
+    def record(self, stage: str, key, design_hash: str, output_path: str = None):
+        """
+        Marks a unit as completed. Only call this after its outputs were verified.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?)",
+                                   (stage, self._encode_key(key), design_hash, output_path or "", time.time()))
+        finally:
+            connection.close()
+
+    def forget(self, stage: str, key, design_hash: str = None):
+        """
+        Marks a unit as not completed (all designs if design_hash is None), ex: after
+        its outputs were deleted.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                if design_hash is None:
+                    connection.execute("DELETE FROM units WHERE stage = ? AND unit_key = ?", (stage, self._encode_key(key)))
+                else:
+                    connection.execute("DELETE FROM units WHERE stage = ? AND unit_key = ? AND design_hash = ?",
+                                       (stage, self._encode_key(key), design_hash))
+        finally:
+            connection.close()
+
+    def completed(self, stage: str, design_hash: str, output_dir: str = None, check_exists: bool = False) -> dict:
+        """
+        Returns {unit key tuple: output path} of the units completed with design_hash.
+
+        output_dir: only the units whose output is in output_dir (ex: the datasink of this run,
+            the ledger records the units of every output directory)
+        check_exists: only the units whose output still exists (one stat per unit)
+        """
+        connection = self._connect()
+        try:
+            # the most recent output of a unit last (a unit completed in several output directories)
+            rows = connection.execute("SELECT unit_key, output_path FROM units WHERE stage = ? AND design_hash = ? ORDER BY completed_at",
+                                      (stage, design_hash)).fetchall()
+        finally:
+            connection.close()
+
+        rows = [(unit_key, output_path or None) for unit_key, output_path in rows]
+
+        if output_dir is not None:
+            output_dir = os.path.realpath(output_dir)
+            rows = [(unit_key, output_path) for unit_key, output_path in rows
+                    if output_path is not None and os.path.dirname(os.path.realpath(output_path)) == output_dir]
+        if check_exists:
+            rows = [(unit_key, output_path) for unit_key, output_path in rows if output_path is not None and os.path.exists(output_path)]
+
+        return {self._decode_key(unit_key): output_path for unit_key, output_path in rows}
+
+    def record_run(self, stage: str, output_dir: str, argv: list = None):
+        """
+        Remembers the output directory of a (re)started run.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("INSERT INTO runs VALUES (?, ?, ?, ?)",
+                                   (stage, output_dir, time.time(), json.dumps(argv) if argv is not None else None))
+        finally:
+            connection.close()
+
+    def last_output_dir(self, stage: str):
+        """
+        Returns the output directory of the most recent run of stage (None if there is none).
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT output_dir FROM runs WHERE stage = ? ORDER BY started_at DESC LIMIT 1",
+                                     (stage,)).fetchone()
+        finally:
+            connection.close()
+
+        return row[0] if row else None
@@ -0,0 +1,194 @@
+"""
+File locks for nodes that write into shared storage.
+
+Many nodes follow the pattern "if the output exists return, otherwise compute
+it". Under MultiProc several nodes can ask for the same output at once (e.g. BET
+of a subject's T1w), so they all recompute it and some read half-written files.
+single_flight() makes one process compute while the others wait for it and then
+reuse the result.
+
+Locks are plain files created with O_EXCL next to the output (this also works on
+the NFS mounted /mnt/storage). The holder keeps touching the lock file, so a lock
+whose holder crashed is detected (dead pid on the same host, or no heartbeat for
+`stale_after` seconds) and broken. Outputs left behind by a crashed holder are
+recomputed.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+POLL_INTERVAL = 2.0 # seconds between checks while waiting for a lock
+HEARTBEAT_INTERVAL = 30.0 # seconds between touches of a held lock
+STALE_AFTER = 300.0 # a lock without heartbeat for this long is considered stale
+
+
+def lock_path_for(path: str) -> str:
+    """
+    Returns the lock file path used for `path`.
+    """
+    return f"{path}.lock"
+
+
+def _read_owner(lock_path: str):
+    try:
+        with open(lock_path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _is_stale(lock_path: str, owner, stale_after: float) -> bool:
+    try:
+        mtime = os.stat(lock_path).st_mtime
+    except FileNotFoundError:
+        return False
+
+    # the holder crashed on this machine
+    if owner is not None and owner.get("host") == socket.gethostname() and not _pid_alive(owner.get("pid", -1)):
+        return True
+
+    # no heartbeat (holder crashed on another machine or was killed -9 and its pid reused)
+    return time.time() - mtime > stale_after
+
+
+def _try_create(lock_path: str, token: str) -> bool:
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, "w") as file:
+        json.dump({"host": socket.gethostname(), "pid": os.getpid(), "token": token, "created": time.time()}, file)
+
+    return True
+
+
+def _break_lock(lock_path: str, stale_owner) -> bool:
+    """
+    Removes a stale lock. Returns False if the lock changed owner in the meantime.
+    """
+    stale_token = stale_owner.get("token") if stale_owner else None
+
+    moved_path = f"{lock_path}.stale-{uuid.uuid4().hex}"
+    try:
+        os.rename(lock_path, moved_path)
+    except FileNotFoundError:
+        return False
+
+    moved_owner = _read_owner(moved_path)
+
+    # someone else broke the stale lock and took a new one between our checks, put it back
+    if moved_owner is not None and moved_owner.get("token") != stale_token:
+        os.rename(moved_path, lock_path)
+        return False
+
+    os.remove(moved_path)
+    return True
+
+
+class _Heartbeat(threading.Thread):
+    def __init__(self, lock_path: str, interval: float):
+        super().__init__(daemon=True)
+        self.lock_path = lock_path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lock_path)
+            except FileNotFoundError:
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+
+@contextmanager
+def file_lock(path: str, timeout: float = None, poll_interval: float = POLL_INTERVAL,
+              stale_after: float = STALE_AFTER, heartbeat_interval: float = HEARTBEAT_INTERVAL):
+    """
+    Exclusive lock for `path` (the lock file is `path`.lock).
+
+    Yields True if a stale lock (crashed holder) was broken to get the lock, so the
+    caller knows `path` may be incomplete.
+
+    Raises TimeoutError if the lock can not be acquired within `timeout` seconds.
+    """
+    lock_path = lock_path_for(path)
+    token = uuid.uuid4().hex
+    recovered = False
+    start_time = time.time()
+
+    while not _try_create(lock_path, token):
+        owner = _read_owner(lock_path)
+
+        if _is_stale(lock_path, owner, stale_after):
+            print(f"LOCK: breaking stale lock {lock_path} (owner: {owner})")
+            recovered = _break_lock(lock_path, owner) or recovered
+            continue
+
+        if timeout is not None and time.time() - start_time > timeout:
+            raise TimeoutError(f"Could not acquire {lock_path} within {timeout} seconds (owner: {_read_owner(lock_path)})")
+
+        time.sleep(poll_interval)
+
+    heartbeat = _Heartbeat(lock_path, heartbeat_interval)
+    heartbeat.start()
+
+    try:
+        yield recovered
+    finally:
+        heartbeat.stop()
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def single_flight(out_paths, force: bool = False, **lock_kwargs):
+    """
+    Single-flight guard for "check-exists-then-compute" nodes.
+
+    Usage:
+        with single_flight([out_file]) as should_compute:
+            if should_compute:
+                ... write out_file ...
+
+    Yields False if all `out_paths` already exist and were completed (by another
+    process or an earlier run), True if the caller must compute them. While the
+    caller computes, every other process asking for the same outputs waits.
+
+    out_paths: str or list of output paths, the lock is taken on the first one
+    force: always compute (still one process at a time)
+    """
+    if isinstance(out_paths, str):
+        out_paths = [out_paths]
+
+    lock_path = lock_path_for(out_paths[0])
+
+    # fast path: outputs complete and nobody is writing them
+    if not force and all([os.path.exists(path) for path in out_paths]) and not os.path.exists(lock_path):
+        yield False
+        return
+
+    with file_lock(out_paths[0], **lock_kwargs) as recovered:
+        if recovered:
+            print(f"LOCK: previous holder of {lock_path} crashed, recomputing {out_paths[0]}")
+
+        yield force or recovered or not all([os.path.exists(path) for path in out_paths])
@@ -0,0 +1,200 @@
+"""
+Manifest of the FEAT datasink: one row per file of every .feat directory.
+
+Downstream stages (roi, randomise, filtered-func-reg) find their inputs by
+listing the datasink and probing paths on /mnt/storage, which is slow over NFS.
+The manifest is scanned once (in parallel) and stored as Parquet next to the FEAT
+directories, later lookups are a table filter.
+
+Columns: feat_dir, subject_id, session, task, run, variant (LN/NL), path
+(relative to feat_dir), size, mtime, is_link.
+
+Usage:
+    manifest = load_manifest(datasink_dir)
+    zfstats = manifest[manifest["path"].str.startswith("stats/zfstat")]
+"""
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as opj
+
+import pandas as pd
+
+from common.locking import file_lock
+
+MANIFEST_NAME = "manifest.parquet"
+
+# ex: sub-NDARINV003RTV85_ses-baselineYear1Arm1_task-sst_run-01LN.feat
+FEAT_DIR_REGEX = re.compile(r"^sub-([^_]+)_ses-([^_]+)_task-([^_]+)_run-(\d+)(LN|NL)\.feat$")
+
+COLUMNS = ["feat_dir", "subject_id", "session", "task", "run", "variant", "path", "size", "mtime", "is_link"]
+
+
+def manifest_path(datasink_dir: str) -> str:
+    """
+    Returns the manifest path of a FEAT datasink directory.
+    """
+    return opj(datasink_dir, MANIFEST_NAME)
+
+
+def parse_feat_dir_name(name: str):
+    """
+    Returns (subject_id, session, task, run, variant) of a FEAT directory name,
+    None if the name does not follow the preprocessing naming.
+    """
+    match = FEAT_DIR_REGEX.match(name)
+    if match is None:
+        return None
+
+    subject_id, session, task, run, variant = match.groups()
+    return subject_id, session, task, int(run), variant
+
+
+def scan_feat_dir(datasink_dir: str, feat_dir: str) -> list:
+    """
+    Returns the manifest rows of one FEAT directory (name relative to datasink_dir).
+    """
+    entities = parse_feat_dir_name(feat_dir)
+    if entities is None:
+        return []
+
+    root_path = opj(datasink_dir, feat_dir)
+    rows = []
+
+    for root, dirs, files in os.walk(root_path):
+        for file_name in files:
+            path = opj(root, file_name)
+            try:
+                # follow symlinks (derived NL runs link into their LN run)
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # dangling symlink
+                continue
+
+            rows.append((feat_dir, *entities, os.path.relpath(path, root_path), stat.st_size, stat.st_mtime, os.path.islink(path)))
+
+    return rows
+
+
+def _compact(manifest: pd.DataFrame) -> pd.DataFrame:
+    return manifest.astype({
+        "feat_dir": "category",
+        "subject_id": "category",
+        "session": "category",
+        "task": "category",
+        "run": "int8",
+        "variant": "category",
+        "path": "category",
+        "size": "int64",
+        "mtime": "float64",
+        "is_link": "bool",
+    })
+
+
+def _to_frame(rows: list) -> pd.DataFrame:
+    return _compact(pd.DataFrame(rows, columns=COLUMNS))
+
+
+def _save(manifest: pd.DataFrame, path: str):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    manifest.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def _scan(datasink_dir: str, feat_dirs: list, n_workers: int) -> list:
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return [row for rows in executor.map(lambda feat_dir: scan_feat_dir(datasink_dir, feat_dir), feat_dirs) for row in rows]
+
+
+def list_feat_dirs(datasink_dir: str) -> list:
+    """
+    Returns the names of all FEAT directories in the datasink.
+    """
+    return sorted([entry.name for entry in os.scandir(datasink_dir) if entry.is_dir() and parse_feat_dir_name(entry.name) is not None])
+
+
+def build_manifest(datasink_dir: str, n_workers: int = 32, save: bool = True) -> pd.DataFrame:
+    """
+    Scans every FEAT directory of the datasink and saves the manifest (unless
+    save is False, ex: dry runs).
+    """
+    start_time = time.time()
+
+    feat_dirs = list_feat_dirs(datasink_dir)
+    manifest = _to_frame(_scan(datasink_dir, feat_dirs, n_workers))
+
+    if save:
+        with file_lock(manifest_path(datasink_dir)):
+            _save(manifest, manifest_path(datasink_dir))
+
+    print(f"Scanned {len(feat_dirs)} FEAT directories ({len(manifest)} files) in {time.time() - start_time:.1f} seconds")
+
+    return manifest
+
+
+def load_manifest(datasink_dir: str, build: bool = True, n_workers: int = 32) -> pd.DataFrame:
+    """
+    Returns the manifest of the datasink, builds it first if it does not exist
+    (and build is True).
+    """
+    path = manifest_path(datasink_dir)
+
+    if not os.path.exists(path):
+        if not build:
+            raise FileNotFoundError(f"No manifest at {path}, build it with build_manifest")
+        return build_manifest(datasink_dir, n_workers=n_workers)
+
+    return pd.read_parquet(path)
+
+
+def update_manifest(datasink_dir: str, feat_dirs: list, n_workers: int = 32):
+    """
+    Rescans the given FEAT directories (ex: after they were written or slimmed)
+    and replaces their rows in the manifest. Directories that no longer exist are
+    removed. Does nothing if there is no manifest yet, it is built on first load.
+    """
+    path = manifest_path(datasink_dir)
+
+    if not os.path.exists(path):
+        return
+
+    rows = _scan(datasink_dir, [feat_dir for feat_dir in feat_dirs if os.path.isdir(opj(datasink_dir, feat_dir))], n_workers)
+
+    # several nodes update the manifest of the same datasink at once
+    with file_lock(path):
+        manifest = pd.read_parquet(path)
+        manifest = manifest[~manifest["feat_dir"].astype(str).isin(feat_dirs)]
+        new_rows = pd.DataFrame(rows, columns=COLUMNS)
+        manifest = _compact(pd.concat([frame for frame in [manifest.astype(object), new_rows] if len(frame) > 0] or [new_rows], ignore_index=True))
+        _save(manifest, path)
+
+
+def refresh_manifest(datasink_dir: str, n_workers: int = 32, save: bool = True) -> pd.DataFrame:
+    """
+    Scans the FEAT directories that are not in the manifest yet and drops the ones
+    that were removed, without rescanning the directories already in it. Builds the
+    manifest if it does not exist. Nothing is written if save is False (ex: dry runs).
+    """
+    if not os.path.exists(manifest_path(datasink_dir)):
+        return build_manifest(datasink_dir, n_workers=n_workers, save=save)
+
+    manifest = load_manifest(datasink_dir, n_workers=n_workers)
+
+    feat_dirs = set(list_feat_dirs(datasink_dir))
+    known_feat_dirs = set(manifest["feat_dir"].astype(str))
+
+    new_feat_dirs = sorted(feat_dirs - known_feat_dirs)
+    removed_feat_dirs = sorted(known_feat_dirs - feat_dirs)
+
+    if new_feat_dirs or removed_feat_dirs:
+        print(f"Manifest: {len(new_feat_dirs)} new and {len(removed_feat_dirs)} removed FEAT directories")
+        if not save:
+            new_rows = pd.DataFrame(_scan(datasink_dir, new_feat_dirs, n_workers), columns=COLUMNS)
+            manifest = manifest[~manifest["feat_dir"].astype(str).isin(removed_feat_dirs)]
+            return _compact(pd.concat([frame for frame in [manifest.astype(object), new_rows] if len(frame) > 0] or [new_rows], ignore_index=True))
+
+        update_manifest(datasink_dir, new_feat_dirs + removed_feat_dirs, n_workers=n_workers)
+        manifest = load_manifest(datasink_dir)
+
+    return manifest
@@ -0,0 +1,207 @@
+"""
+Shared NIfTI reading for the stages (roi/, filtered-func-reg/, randomise/, the
+array and group stores).
+
+A .nii.gz is a single gzip stream: plain nibabel decompresses it from the start
+for every read, even for one volume of a 4D filtered_func or a few voxels, and
+every stage reading the same FEAT outputs pays the whole decompression again.
+
+    load_nifti      the image of a path, with the fastest available access:
+                    1. the uncompressed copy in the local cache (memory mapped), if the cache is on
+                    2. an indexed_gzip file with a seek point index (random access into the stream),
+                       the index is saved in the cache directory and reused by the other processes
+                    3. nibabel's gzip reader (indexed_gzip not installed)
+    read_volumes    the volumes [start, stop) of a 4D image, only their part of the stream is read
+    cached_path     the uncompressed copy of a .nii.gz in the cache, made on first use
+
+The cache is a local directory (NIFTI_CACHE_DIR, ex: a scratch disk of the node)
+bounded to NIFTI_CACHE_GB: its copies are keyed by path, size and modification
+time (a rewritten file gets a new copy), and the least recently used copies are
+evicted when it is full. The cache is off if NIFTI_CACHE_DIR is not set.
+
+Usage:
+    img = load_nifti(zfstat_path)                               # as nib.load
+    volumes = read_volumes(filtered_func_path, 100, 200)        # float32, x y z 100
+"""
+import hashlib
+import os
+from os.path import join as opj
+
+import numpy as np
+
+from common.locking import file_lock
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+CACHE_DIR = os.getenv("NIFTI_CACHE_DIR") or None
+CACHE_BYTES = int(float(os.getenv("NIFTI_CACHE_GB", "50")) * 1024 ** 3)
+
+# distance between the seek points of the gzip indexes (memory: 32 KB per point)
+INDEX_SPACING = 4 * 1024 ** 2
+
+COPIES_DIR = "copies"
+INDEXES_DIR = "indexes"
+
+
+def _cache_key(path: str) -> str:
+    """
+    Ex: 3f2a9c0d1e4b5a6f-73400320-1714489200123456789 (hash of the absolute path, size, mtime in ns)
+    """
+    stat = os.stat(path)
+    return f"{hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]}-{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def _touch(path: str):
+    # the modification time of a copy is its last use (atime is often disabled)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _evict(cache_dir: str, max_bytes: int, keep: str = None):
+    """
+    Removes the least recently used copies (and their indexes) until the cache holds at most max_bytes.
+    """
+    with file_lock(opj(cache_dir, "evict")):
+        copies = []
+        for sub_dir in [COPIES_DIR, INDEXES_DIR]:
+            for file in os.listdir(opj(cache_dir, sub_dir)):
+                if ".tmp-" in file:
+                    continue
+                try:
+                    stat = os.stat(opj(cache_dir, sub_dir, file))
+                except FileNotFoundError:
+                    continue
+                copies.append((stat.st_mtime, stat.st_size, opj(cache_dir, sub_dir, file)))
+
+        total = sum([size for _, size, _ in copies])
+        for _, size, path in sorted(copies):
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+def cached_path(path: str, cache_dir: str = None, max_bytes: int = None) -> str:
+    """
+    Returns the uncompressed copy of the .nii.gz path in the cache (cache_dir, default NIFTI_CACHE_DIR),
+    decompressing it once (one process at a time, the others wait for it and reuse it).
+    """
+    import gzip
+    import shutil
+    from common.instrument import measure
+    from common.locking import single_flight
+
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = CACHE_BYTES if max_bytes is None else max_bytes
+    if cache_dir is None:
+        raise ValueError("No NIfTI cache directory, set NIFTI_CACHE_DIR or give cache_dir")
+
+    os.makedirs(opj(cache_dir, COPIES_DIR), exist_ok=True)
+    os.makedirs(opj(cache_dir, INDEXES_DIR), exist_ok=True)
+
+    copy_path = opj(cache_dir, COPIES_DIR, f"{_cache_key(path)}.nii")
+
+    with measure("nifti_decompress", path=path) as event, single_flight(copy_path, poll_interval=0.2) as should_compute:
+        event["cache"] = "miss" if should_compute else "hit"
+        if should_compute:
+            tmp_path = f"{copy_path}.tmp-{os.getpid()}"
+            with gzip.open(path, "rb") as in_file, open(tmp_path, "wb") as out_file:
+                shutil.copyfileobj(in_file, out_file, 16 * 1024 ** 2)
+            os.replace(tmp_path, copy_path)
+
+            _evict(cache_dir, max_bytes, keep=copy_path)
+        else:
+            _touch(copy_path)
+
+    return copy_path
+
+
+def _open_indexed(path: str, cache_dir: str):
+    """
+    Returns an indexed_gzip file of path, with the seek point index of the cache (built and saved on first use).
+    """
+    if cache_dir is None:
+        return indexed_gzip.IndexedGzipFile(path, spacing=INDEX_SPACING)
+
+    os.makedirs(opj(cache_dir, INDEXES_DIR), exist_ok=True)
+    index_path = opj(cache_dir, INDEXES_DIR, f"{_cache_key(path)}.gzidx")
+
+    if os.path.exists(index_path):
+        _touch(index_path)
+        return indexed_gzip.IndexedGzipFile(path, spacing=INDEX_SPACING, index_file=index_path)
+
+    from common.instrument import measure
+
+    # one pass over the stream, then every process seeks directly
+    with measure("nifti_index", path=path) as event:
+        event["cache"] = "miss"
+        gzip_file = indexed_gzip.IndexedGzipFile(path, spacing=INDEX_SPACING)
+        gzip_file.build_full_index()
+
+        tmp_path = f"{index_path}.tmp-{os.getpid()}"
+        gzip_file.export_index(tmp_path)
+        os.replace(tmp_path, index_path)
+
+    return gzip_file
+
+
+def load_nifti(path: str, cache: bool = None, cache_dir: str = None):
+    """
+    Returns the nibabel image of path (see the module docstring for the access used).
+    cache: use the uncompressed copies of the cache (default: if a cache directory is set)
+    """
+    import nibabel as nib
+
+    cache_dir = cache_dir or CACHE_DIR
+    cache = cache_dir is not None if cache is None else cache
+
+    if not path.endswith(".gz"):
+        return nib.load(path)
+
+    if cache:
+        return nib.load(cached_path(path, cache_dir))
+
+    if indexed_gzip is None:
+        # the gzip stream stays open between the reads of an image
+        return nib.load(path, keep_file_open=True)
+
+    gzip_file = _open_indexed(path, cache_dir)
+    image_class = nib.Nifti2Image if nib.Nifti2Header.may_contain_header(gzip_file.read(540)) else nib.Nifti1Image
+    gzip_file.seek(0)
+
+    file_map = image_class.make_file_map({"image": gzip_file, "header": gzip_file})
+    img = image_class.from_file_map(file_map)
+    img.set_filename(path)
+
+    return img
+
+
+def read_volumes(path: str, start: int = 0, stop: int = None, cache: bool = None) -> np.ndarray:
+    """
+    Returns the volumes [start, stop) of a 4D image as float32 (x y z time), a 3D image is one volume.
+    """
+    img = load_nifti(path, cache=cache)
+
+    if len(img.shape) == 3:
+        return np.asarray(img.dataobj, dtype=np.float32)[..., np.newaxis][..., start:stop]
+
+    return np.asarray(img.dataobj[..., start:stop], dtype=np.float32)
+
+
+def clear_cache(cache_dir: str = None):
+    """
+    Removes every copy and index of the cache.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    if cache_dir is not None:
+        _evict(cache_dir, 0)
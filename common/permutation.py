@@ -0,0 +1,309 @@
+"""
+Sign-flip permutation tests (one-sample and general GLM t contrasts) on a
+subjects x voxels matrix, an in-process alternative to FSL randomise.
+
+Under the null the (nuisance-adjusted) data are symmetric around zero, so each
+permutation flips the signs of whole subjects (Freedman-Lane: the residuals of
+the nuisance-only model are flipped, the nuisance fit is added back). For a
+batch of sign vectors S (batch x subjects) every statistic needs only matrix
+products with the data:
+
+    c'beta = (S * w) @ Rz + c'beta_nuisance          w = c' pinv(X)
+    RSS    = sum(Rz^2) - sum_k ((S * Q[:, k]) @ Rz)^2   Q = orthonormal basis of X
+
+so a batch of permutations costs rank(X) + 1 (batch x subjects) @ (subjects x
+voxels) products instead of one model fit per permutation. Permutation blocks are
+split across a process pool, each block draws its sign flips from its own seed so
+results do not depend on the number of workers. FWE correction uses the maximum
+statistic over voxels of each permutation (as randomise -x / --T2).
+
+Like randomise, the p-value maps are written as 1 - p (0.95 = p 0.05), and the
+unpermuted (identity) sign vector is always the first permutation.
+
+Usage:
+    result = permutation_test(Y, n_perm=5000)          # one-sample t test (randomise -1)
+    write_maps(result, mask_file, "out/zfstat1_flirt")  # out/zfstat1_flirt_tstat1.nii.gz, _vox_p_tstat1, _vox_corrp_tstat1
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+DEFAULT_N_PERM = 5000
+
+# permutations per matrix product, (batch x voxels) float32 arrays are held per contrast basis column
+DEFAULT_BATCH_SIZE = 64
+
+# permutations per process pool task
+DEFAULT_BLOCK_SIZE = 512
+
+# relative tolerance of the exceedance counts (float32 statistics of equal permutations can differ in the last bits)
+TIE_TOLERANCE = 1e-5
+
+
+def sign_flips(n_subjects: int, n_perm: int, seed: int = 0, block: int = 0, block_size: int = DEFAULT_BLOCK_SIZE) -> np.ndarray:
+    """
+    Returns the sign flips (n x n_subjects, +-1 float32) of one permutation block.
+    Block 0 starts with the identity. If n_perm covers all 2^n_subjects sign flips,
+    they are enumerated exhaustively instead.
+    """
+    start = block * block_size
+    stop = min(start + block_size, n_perm)
+
+    if n_subjects < 31 and n_perm >= 2 ** n_subjects:
+        # exhaustive, the identity (all +1) is the first one
+        flips = np.array(list(itertools.islice(itertools.product([1.0, -1.0], repeat=n_subjects), start, stop)), dtype=np.float32)
+        return flips.reshape(-1, n_subjects)
+
+    rng = np.random.default_rng([seed, block])
+    flips = rng.choice(np.array([1.0, -1.0], dtype=np.float32), size=(stop - start, n_subjects))
+
+    if block == 0:
+        flips[0] = 1.0
+
+    return flips
+
+
+def n_permutations(n_subjects: int, n_perm: int) -> int:
+    """
+    Returns the number of permutations actually run (capped at 2^n_subjects, all sign flips).
+    """
+    return min(n_perm, 2 ** n_subjects) if n_subjects < 31 else n_perm
+
+
+class Contrast:
+    """
+    Precomputed GLM terms of one t contrast (design X: subjects x regressors).
+    """
+
+    def __init__(self, X: np.ndarray, contrast: np.ndarray):
+        X = np.asarray(X, dtype=np.float64)
+        contrast = np.asarray(contrast, dtype=np.float64).ravel()
+
+        if X.shape[1] != contrast.shape[0]:
+            raise ValueError(f"Contrast has {contrast.shape[0]} elements, design has {X.shape[1]} regressors")
+
+        pinv_X = np.linalg.pinv(X)
+        self.rank = np.linalg.matrix_rank(X)
+        self.dof = X.shape[0] - self.rank
+        if self.dof < 1:
+            raise ValueError(f"No degrees of freedom left ({X.shape[0]} subjects, design rank {self.rank})")
+
+        # c' pinv(X): contrast of the parameter estimates as a weighting of the subjects
+        self.weights = (contrast @ pinv_X).astype(np.float32)
+
+        # orthonormal basis of the design space, for the residual sum of squares
+        U, singular_values, _ = np.linalg.svd(X, full_matrices=False)
+        tolerance = singular_values.max() * max(X.shape) * np.finfo(np.float64).eps
+        self.basis = U[:, singular_values > tolerance].astype(np.float32)
+
+        # variance of c'beta per unit residual variance
+        self.scale = float(contrast @ np.linalg.pinv(X.T @ X) @ contrast)
+
+        # nuisance space: the part of the design the contrast does not test (Freedman-Lane)
+        contrast_space = pinv_X.T @ contrast
+        nuisance = X - np.outer(contrast_space, contrast_space @ X) / max(contrast_space @ contrast_space, np.finfo(np.float64).tiny)
+        U_z, singular_values_z, _ = np.linalg.svd(nuisance, full_matrices=False)
+        self.nuisance_basis = U_z[:, singular_values_z > tolerance * 1e3]
+
+    def split(self, Y: np.ndarray):
+        """
+        Returns (nuisance residuals Rz, constant c'beta of the nuisance fit per voxel).
+        """
+        if self.nuisance_basis.shape[1] == 0:
+            return Y, np.zeros(Y.shape[1], dtype=np.float32)
+
+        Q_z = self.nuisance_basis.astype(np.float32)
+        fitted = Q_z @ (Q_z.T @ Y)
+        return (Y - fitted).astype(np.float32), (self.weights @ fitted).astype(np.float32)
+
+    def t_stats(self, flips: np.ndarray, Rz: np.ndarray, offset: np.ndarray, sum_squares: np.ndarray) -> np.ndarray:
+        """
+        Returns the t statistics (batch x voxels) of the sign flipped data.
+        """
+        effect = (flips * self.weights) @ Rz + offset
+
+        # Rz sign flipped keeps its sum of squares, only its projection onto the design changes
+        rss = np.array(sum_squares, dtype=np.float32, copy=True)[None, :].repeat(len(flips), axis=0)
+        for k in range(self.basis.shape[1]):
+            rss -= ((flips * self.basis[:, k]) @ Rz) ** 2
+        np.maximum(rss, 0, out=rss)
+
+        se = np.sqrt(rss / self.dof * self.scale)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(se > 0, effect / se, 0).astype(np.float32)
+
+        return t
+
+
+# set in every pool worker (or the main process) by _init_worker
+_worker_state = {}
+
+
+def _init_worker(Y, X, contrast, seed, n_perm, block_size, batch_size, stat_transform):
+    if isinstance(Y, str):
+        Y = np.load(Y, mmap_mode="r")
+
+    model = Contrast(X, contrast)
+    Rz, offset = model.split(np.asarray(Y, dtype=np.float32))
+
+    _worker_state.update({
+        "model": model,
+        "Rz": Rz,
+        "offset": offset,
+        "sum_squares": np.einsum("ij,ij->j", Rz, Rz),
+        "seed": seed,
+        "n_perm": n_perm,
+        "block_size": block_size,
+        "batch_size": batch_size,
+        "stat_transform": stat_transform,
+    })
+
+
+def _run_block(block: int, observed: np.ndarray):
+    """
+    Returns (exceedance counts per voxel, max statistic per permutation) of one block.
+    """
+    state = _worker_state
+    flips = sign_flips(state["Rz"].shape[0], state["n_perm"], state["seed"], block, state["block_size"])
+
+    tolerance = TIE_TOLERANCE * np.maximum(np.abs(observed), 1)
+    counts = np.zeros(observed.shape, dtype=np.int64)
+    max_stats = []
+
+    for start in range(0, len(flips), state["batch_size"]):
+        stats = state["model"].t_stats(flips[start:start + state["batch_size"]], state["Rz"], state["offset"], state["sum_squares"])
+        if state["stat_transform"] is not None:
+            stats = state["stat_transform"](stats)
+
+        counts += (stats >= observed - tolerance).sum(axis=0)
+        max_stats.append(stats.max(axis=1))
+
+    return counts, np.concatenate(max_stats)
+
+
+def permutation_test(Y, X: np.ndarray = None, contrast=None, n_perm: int = DEFAULT_N_PERM, seed: int = 0,
+                     n_procs: int = 1, block_size: int = DEFAULT_BLOCK_SIZE, batch_size: int = DEFAULT_BATCH_SIZE,
+                     stat_transform=None) -> dict:
+    """
+    Sign-flip permutation test of one t contrast.
+
+    Y: subjects x voxels matrix (or the path of a .npy, memory-mapped, ex: merge.merge_to_matrix)
+    X: design (subjects x regressors), default: one-sample (column of ones)
+    contrast: default [1, 0, ...]
+    n_perm: number of permutations, including the identity (all sign flips if there are fewer)
+    n_procs: processes the permutation blocks are split across
+    stat_transform: applied to every (permutations x voxels) statistic batch before counting, must be
+        picklable (ex: a TFCE transform); p-values and the max statistics are of the transformed statistic
+
+    Returns {"t": observed t, "stat": observed (transformed) statistic, "p": uncorrected p, "corrp": FWE
+    corrected p, "max_null": max statistic of every permutation, "n_perm": permutations run}
+    """
+    n_subjects = (np.load(Y, mmap_mode="r") if isinstance(Y, str) else Y).shape[0]
+
+    X = np.ones((n_subjects, 1)) if X is None else np.asarray(X, dtype=np.float64)
+    contrast = np.eye(X.shape[1])[0] if contrast is None else np.asarray(contrast, dtype=np.float64)
+
+    if X.shape[0] != n_subjects:
+        raise ValueError(f"Design has {X.shape[0]} rows, data has {n_subjects} subjects")
+
+    n_perm = n_permutations(n_subjects, n_perm)
+    n_blocks = -(-n_perm // block_size)
+
+    init_args = (Y, X, contrast, seed, n_perm, block_size, batch_size, stat_transform)
+
+    # observed statistic (identity sign flip) in this process
+    _init_worker(*init_args)
+    identity = np.ones((1, n_subjects), dtype=np.float32)
+    t = _worker_state["model"].t_stats(identity, _worker_state["Rz"], _worker_state["offset"], _worker_state["sum_squares"])
+    observed = t if stat_transform is None else stat_transform(t)
+    t, observed = t[0], observed[0]
+
+    if n_procs > 1 and n_blocks > 1:
+        _worker_state.clear()
+        with ProcessPoolExecutor(max_workers=min(n_procs, n_blocks), initializer=_init_worker, initargs=init_args) as executor:
+            results = list(executor.map(_run_block, range(n_blocks), [observed] * n_blocks))
+    else:
+        results = [_run_block(block, observed) for block in range(n_blocks)]
+        _worker_state.clear()
+
+    counts = sum([block_counts for block_counts, _ in results])
+    max_null = np.concatenate([block_max for _, block_max in results])
+
+    return {"t": t, "stat": observed, "p": counts / n_perm, "corrp": corrected_p(observed, max_null), "max_null": max_null, "n_perm": n_perm}
+
+
+def corrected_p(observed: np.ndarray, max_null: np.ndarray) -> np.ndarray:
+    """
+    Returns the FWE corrected p-values: fraction of the permutations whose maximum statistic reaches the observed one.
+    """
+    n_below = np.searchsorted(np.sort(max_null), observed - TIE_TOLERANCE * np.maximum(np.abs(observed), 1), side="left")
+
+    return (len(max_null) - n_below) / len(max_null)
+
+
+def unmask(values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    Returns a volume with the in-mask values (C order of the mask, as merge.merge_to_matrix) and zeros outside.
+    """
+    volume = np.zeros(mask.shape, dtype=np.float32)
+    volume[mask] = values
+    return volume
+
+
+def write_maps(result: dict, mask_file: str, out_prefix: str, contrast_number: int = 1, stat_name: str = "vox") -> dict:
+    """
+    Writes the statistic and 1 - p maps of a permutation_test result with randomise's
+    names: <out_prefix>_tstat1.nii.gz, _vox_p_tstat1.nii.gz, _vox_corrp_tstat1.nii.gz
+    (stat_name "tfce": _tfce_p_tstat1, _tfce_corrp_tstat1). Returns {name: path}.
+    """
+    import nibabel as nib
+
+    mask_img = nib.load(mask_file)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+
+    maps = {
+        f"tstat{contrast_number}": result["t"],
+        f"{stat_name}_p_tstat{contrast_number}": 1 - result["p"],
+        f"{stat_name}_corrp_tstat{contrast_number}": 1 - result["corrp"],
+    }
+
+    paths = {}
+    for name, values in maps.items():
+        path = f"{out_prefix}_{name}.nii.gz"
+        img = nib.Nifti1Image(unmask(values, mask), mask_img.affine)
+        img.header.set_data_dtype(np.float32)
+        nib.save(img, path)
+        paths[name] = path
+
+    return paths
+
+
+def permutation_node_func(matrix_file: str, mask_file: str, out_name: str, n_perm: int = 5000, seed: int = 0, n_procs: int = 1, tfce: bool = False,
+                          subject_ids: list = None, generation: int = None):
+    """
+    Node function, one-sample sign-flip test of a subjects x voxels matrix (merge.merge_to_matrix,
+    common/group_store.py), of the TFCE of the t statistic if tfce (as randomise -T).
+    subject_ids: subject of each row, checked against the matrix
+    generation: group store generation of the matrix (GroupStore.generation), only an input of the
+        node, so a group store matrix that changed in place (new or replaced rows) reruns the test
+    Returns (tstat_files, p_files, corrected_p_files) in the node directory.
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    import nibabel as nib
+    import numpy as np
+    from common.permutation import permutation_test, write_maps
+    from common.tfce import TFCE
+
+    if subject_ids is not None and len(subject_ids) != np.load(matrix_file, mmap_mode="r").shape[0]:
+        raise ValueError(f"{matrix_file} does not have a row for each of the {len(subject_ids)} subjects")
+
+    stat_transform = TFCE(np.asanyarray(nib.load(mask_file).dataobj)) if tfce else None
+    stat_name = "tfce" if tfce else "vox"
+
+    result = permutation_test(matrix_file, n_perm=n_perm, seed=seed, n_procs=n_procs, stat_transform=stat_transform)
+    paths = write_maps(result, mask_file, os.path.join(os.getcwd(), out_name), stat_name=stat_name)
+
+    return [paths["tstat1"]], [paths[f"{stat_name}_p_tstat1"]], [paths[f"{stat_name}_corrp_tstat1"]]
@@ -0,0 +1,215 @@
+"""
+Query API over the extracted results, for the analysis notebooks:
+
+    load_roi            ROI activation table of roi/main.py (roi_activations Parquet dataset, or .csv)
+    load_roi_voxels     voxel values of the ROIs (roi/main.py --array-store, common/array_store.py)
+    load_timeseries     ROI timeseries (filtered-func-reg/main.py --array_store)
+
+Filters are pushed down: on the Parquet dataset the session and image filters
+select partition directories and the others are evaluated by the Parquet reader
+(row group statistics), only the requested columns are decoded; on an array store
+the filters select index rows and only the requested ROIs / time window chunks are
+decompressed. Long format results are cached in the process (keyed on the query
+and the modification times of the files), repeated queries return a copy of the cache.
+
+Every filter takes one value or a list, None means all.
+
+Usage:
+    from common.query import load_roi
+    activations = load_roi(ROI_TABLE, subjects=["NDARINV00CY2MDM"], rois=[1, 3], images="corGo", nonlinear=False, session="baselineYear1Arm1")
+    timeseries = load_timeseries(STORE_DIR, subjects="NDARINV00CY2MDM", rois=3, time=slice(0, 100))    # long format, as the timeseries csv
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# decoded query results kept per process
+CACHE_SIZE = 32
+
+_cache = OrderedDict()
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set, np.ndarray, pd.Index, pd.Series)):
+        return list(value)
+    return [value]
+
+
+def _subject_ids(subjects) -> list:
+    # subject ids are stored without sub-
+    subjects = _as_list(subjects)
+    return None if subjects is None else [str(subject)[len("sub-"):] if str(subject).startswith("sub-") else str(subject) for subject in subjects]
+
+
+def _signature(path: str) -> tuple:
+    """
+    Returns the modification times of the files of path (a file or a directory tree), changes when the results are rewritten.
+    """
+    if not os.path.isdir(path):
+        return (os.path.getmtime(path),)
+
+    return tuple(sorted([(os.path.relpath(os.path.join(root, file), path), os.path.getmtime(os.path.join(root, file)))
+                         for root, _, files in os.walk(path) for file in files if ".tmp-" not in file]))
+
+
+def _cached(key: tuple, signature: tuple, load):
+    entry = _cache.get(key)
+    if entry is not None and entry[0] == signature:
+        _cache.move_to_end(key)
+        return entry[1].copy()
+
+    result = load()
+
+    _cache[key] = (signature, result)
+    _cache.move_to_end(key)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+    return result.copy()
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _roi_filters(subjects, rois, images, nonlinear, session, runs) -> dict:
+    """
+    Returns {column: allowed values} of the filters given (not None).
+    """
+    filters = {
+        "subject_id": _subject_ids(subjects),
+        "roi_num": _as_list(rois),
+        "image_name": _as_list(images),
+        "is_nonlinear": _as_list(nonlinear),
+        "session": _as_list(session),
+        "run": _as_list(runs),
+    }
+    return {column: values for column, values in filters.items() if values is not None}
+
+
+def load_roi(path: str, subjects=None, rois=None, images=None, nonlinear=None, session=None, runs=None, columns: list = None) -> pd.DataFrame:
+    """
+    Returns the rows of the ROI activation table (roi_activations dataset directory or .csv) matching
+    the filters, only the given columns (default: all).
+    """
+    filters = _roi_filters(subjects, rois, images, nonlinear, session, runs)
+    key = ("roi", os.path.abspath(path), tuple([(column, tuple(values)) for column, values in sorted(filters.items())]), tuple(columns or []))
+
+    return _cached(key, _signature(path), lambda: _load_table(path, filters, columns))
+
+
+def _load_table(path: str, filters: dict, columns: list) -> pd.DataFrame:
+    if os.path.isdir(path):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(path, format="parquet", partitioning="hive")
+
+        expression = None
+        for column, values in filters.items():
+            # partition columns and categories are strings, the other columns have their stored types
+            field_type = dataset.schema.field(column).type
+            if pa.types.is_string(field_type) or (pa.types.is_dictionary(field_type) and pa.types.is_string(field_type.value_type)):
+                values = [str(value) for value in values]
+
+            condition = ds.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+
+        table = dataset.to_table(columns=columns, filter=expression)
+        return table.to_pandas()
+
+    # csv: no pushdown possible, only the needed columns are parsed
+    usecols = None if columns is None else list(dict.fromkeys(list(columns) + list(filters)))
+    table = pd.read_csv(path, usecols=usecols)
+    for column, values in filters.items():
+        table = table[table[column].isin(values)]
+
+    return table[columns].reset_index(drop=True) if columns is not None else table.reset_index(drop=True)
+
+
+def _array_index_path(store_dir: str) -> str:
+    # index rows of the array store (index/), its index.parquet if they are not split yet (older stores)
+    index_dir = os.path.join(store_dir, "index")
+    return index_dir if os.path.isdir(index_dir) else os.path.join(store_dir, "index.parquet")
+
+
+def _load_arrays(store_dir: str, rois, time: slice, value_name: str, index_filters: dict, long: bool):
+    from common.array_store import ArrayStore
+
+    store = ArrayStore(store_dir)
+    entries = store.entries(**index_filters)
+    rois = store.roi_nums if rois is None else _as_list(rois)
+
+    if not long:
+        return {roi_num: (entries.reset_index(drop=True), [store.read(key, roi_num, time) for key in entries["key"]]) for roi_num in rois}
+
+    start = 0 if time is None or time.start is None else time.start
+
+    tables = []
+    for roi_num in rois:
+        coords = store.coords(roi_num)
+        for _, entry in entries.iterrows():
+            values = store.read(entry["key"], roi_num, time)
+            n_voxels, n_timepoints = values.shape
+
+            # one row per voxel and timepoint, voxels vary fastest
+            table = pd.DataFrame({
+                "x": np.tile(coords[:, 0], n_timepoints),
+                "y": np.tile(coords[:, 1], n_timepoints),
+                "z": np.tile(coords[:, 2], n_timepoints),
+                value_name: values.T.ravel(),
+                "roi_num": np.int8(roi_num),
+                "time_index": np.repeat(np.arange(start, start + n_timepoints, dtype=np.int32), n_voxels),
+            })
+            for column in entries.columns:
+                if column not in ["key", "n_timepoints", "in_file", "mtime"]:
+                    table[column] = entry[column]
+
+            tables.append(table)
+
+    if not tables:
+        return pd.DataFrame(columns=["x", "y", "z", value_name, "roi_num", "time_index"])
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def load_roi_voxels(store_dir: str, subjects=None, rois=None, images=None, nonlinear=None, session=None, runs=None, long: bool = True):
+    """
+    Returns the voxel values of the ROIs (array store of roi/main.py --array-store) of the matching images:
+    long format (x, y, z, roi_value, roi_num, time_index + metadata, as the --no-avg table), or
+    {roi_num: (index rows, [ROI voxels x 1 arrays])} if not long.
+    """
+    filters = _roi_filters(subjects, None, images, None, session, runs)
+    if nonlinear is not None:
+        filters["registration"] = ["NL" if value else "LN" for value in _as_list(nonlinear)]
+
+    key = ("roi_voxels", os.path.abspath(store_dir), tuple([(column, tuple(values)) for column, values in sorted(filters.items())]),
+           tuple(_as_list(rois) or []), long)
+    index_path = _array_index_path(store_dir)
+
+    if not long:
+        return _load_arrays(store_dir, rois, None, "roi_value", filters, long)
+
+    return _cached(key, _signature(index_path), lambda: _load_arrays(store_dir, rois, None, "roi_value", filters, long))
+
+
+def load_timeseries(store_dir: str, subjects=None, rois=None, session=None, runs=None, time: slice = None, long: bool = True):
+    """
+    Returns the ROI timeseries (array store of filtered-func-reg/main.py --array_store) of the matching runs,
+    only the timepoints of time (ex: slice(0, 100)): long format (x, y, z, raw_value, roi_num, time_index,
+    subject_id, run, session, as the timeseries csv), or {roi_num: (index rows, [ROI voxels x timepoints arrays])} if not long.
+    """
+    filters = _roi_filters(subjects, None, None, None, session, runs)
+
+    key = ("timeseries", os.path.abspath(store_dir), tuple([(column, tuple(values)) for column, values in sorted(filters.items())]),
+           tuple(_as_list(rois) or []), None if time is None else (time.start, time.stop), long)
+    index_path = _array_index_path(store_dir)
+
+    if not long:
+        return _load_arrays(store_dir, rois, time, "raw_value", filters, long)
+
+    return _cached(key, _signature(index_path), lambda: _load_arrays(store_dir, rois, time, "raw_value", filters, long))
@@ -0,0 +1,230 @@
+"""
+Resource-aware scheduling for the nipype MultiProc workflows.
+
+Nodes declare what they need through a resource profile (node_resources), and
+AdaptiveMultiProcPlugin adjusts how many processors and how much memory MultiProc
+may hand out from the live CPU count, load average, available memory and swap
+activity, so the machine stays busy without thrashing or swapping. The samples it
+takes are written to a utilization report at the end of the run.
+
+Usage:
+    feat_node = Node(fsl.FEAT(), name="feat_node", **scheduler.node_resources("feat"))
+    workflow.run(plugin=scheduler.AdaptiveMultiProcPlugin(plugin_args={"n_procs": 60}))
+"""
+import json
+import os
+import time
+
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+# per node type resources, passed to nipype's Node(..., mem_gb=, n_procs=)
+RESOURCE_PROFILES = {
+    # FEAT (film_gls + BBR/FLIRT registration, FNIRT if nonlinear)
+    "feat": {"mem_gb": 3.0, "n_procs": 1},
+    # FNIRT registration (also derive_nonlinear_feat)
+    "fnirt": {"mem_gb": 2.0, "n_procs": 1},
+    # FLIRT applying a transformation
+    "flirt": {"mem_gb": 0.5, "n_procs": 1},
+    # BET of a T1w
+    "bet": {"mem_gb": 0.5, "n_procs": 1},
+    # randomise on a merged 4D image
+    "randomise": {"mem_gb": 4.0, "n_procs": 1},
+    # python nodes reading or writing a few small files (timing files, ROI extraction)
+    "io": {"mem_gb": 0.5, "n_procs": 1},
+    # trivial python nodes (paths, design.fsf, waiting), run in the main process
+    "light": {"mem_gb": 0.1, "n_procs": 1, "run_without_submitting": True},
+}
+
+SAMPLE_INTERVAL = 10.0 # seconds between system samples
+MEMORY_RESERVE_GB = 4.0 # memory always left free for the OS and page cache
+
+
+def node_resources(profile: str) -> dict:
+    """
+    Returns the Node keyword arguments (mem_gb, n_procs, ...) of a resource profile.
+    """
+    if profile not in RESOURCE_PROFILES:
+        raise ValueError(f"Unknown resource profile {profile}, expected one of {list(RESOURCE_PROFILES)}")
+
+    return dict(RESOURCE_PROFILES[profile])
+
+
+def cpu_count() -> int:
+    """
+    Returns the number of CPUs this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def _read_meminfo() -> dict:
+    meminfo = {}
+    with open("/proc/meminfo", "r") as file:
+        for line in file:
+            name, value = line.split(":", 1)
+            meminfo[name] = int(value.split()[0]) / 1024 / 1024 # kB -> GB
+    return meminfo
+
+
+def _read_swap_out() -> int:
+    with open("/proc/vmstat", "r") as file:
+        for line in file:
+            if line.startswith("pswpout "):
+                return int(line.split()[1])
+    return 0
+
+
+def _read_cpu_times():
+    with open("/proc/stat", "r") as file:
+        values = [int(value) for value in file.readline().split()[1:]]
+    idle = values[3] + values[4] # idle + iowait
+    return sum(values), idle
+
+
+def system_snapshot() -> dict:
+    """
+    Returns the current CPU count, load average, total/available memory (GB) and
+    the number of pages swapped out since boot.
+    """
+    meminfo = _read_meminfo()
+    total_time, idle_time = _read_cpu_times()
+
+    return {
+        "time": time.time(),
+        "cpus": cpu_count(),
+        "load_1min": os.getloadavg()[0],
+        "mem_total_gb": meminfo["MemTotal"],
+        "mem_available_gb": meminfo["MemAvailable"],
+        "swap_out_pages": _read_swap_out(),
+        "cpu_total_time": total_time,
+        "cpu_idle_time": idle_time,
+    }
+
+
+class AdaptiveMultiProcPlugin(MultiProcPlugin):
+    """
+    MultiProc plugin whose processor and memory limits follow the machine.
+
+    n_procs and memory_gb in plugin_args are ceilings (defaults: all CPUs and the
+    available memory at start-up minus MEMORY_RESERVE_GB). Every `sample_interval`
+    seconds the limits are recomputed:
+
+    - processors = CPUs - load caused by other processes (load average minus our
+      running nodes), between `min_procs` and the ceiling
+    - memory = memory reserved by our running nodes + available memory - reserve
+    - when the system swapped since the last sample no new nodes are started
+
+    Extra plugin_args: min_procs, sample_interval, memory_reserve_gb,
+    utilization_report (json path the samples are written to at the end).
+    """
+
+    def __init__(self, plugin_args=None):
+        plugin_args = dict(plugin_args or {})
+
+        snapshot = system_snapshot()
+        self.memory_reserve_gb = plugin_args.get("memory_reserve_gb", MEMORY_RESERVE_GB)
+
+        plugin_args.setdefault("n_procs", snapshot["cpus"])
+        plugin_args.setdefault("memory_gb", max(1.0, snapshot["mem_available_gb"] - self.memory_reserve_gb))
+
+        super().__init__(plugin_args=plugin_args)
+
+        self.max_processors = self.processors
+        self.max_memory_gb = self.memory_gb
+        self.min_processors = plugin_args.get("min_procs", 1)
+        self.sample_interval = plugin_args.get("sample_interval", SAMPLE_INTERVAL)
+        self.utilization_report = plugin_args.get("utilization_report")
+
+        self.samples = []
+        self._last_snapshot = snapshot
+
+        print(f"SCHEDULER: {snapshot['cpus']} CPUs, load {snapshot['load_1min']:.1f}, {snapshot['mem_available_gb']:.1f}/{snapshot['mem_total_gb']:.1f} GB available")
+        print(f"SCHEDULER: at most {self.max_processors} processors and {self.max_memory_gb:.1f} GB")
+
+    def _running_resources(self, running_tasks):
+        running_procs = sum([self.procs[jobid].n_procs for _, jobid in running_tasks])
+        running_mem_gb = sum([self.procs[jobid].mem_gb for _, jobid in running_tasks])
+        return running_procs, running_mem_gb
+
+    def _adapt(self, running_tasks):
+        now = time.time()
+        if self.samples and now - self.samples[-1]["time"] < self.sample_interval:
+            return
+
+        snapshot = system_snapshot()
+        running_procs, running_mem_gb = self._running_resources(running_tasks)
+
+        # load not caused by our own running nodes
+        external_load = max(0.0, snapshot["load_1min"] - running_procs)
+        processors = int(round(snapshot["cpus"] - external_load))
+
+        # swapping since the last sample, do not start anything new
+        swapping = snapshot["swap_out_pages"] > self._last_snapshot["swap_out_pages"]
+        if swapping:
+            processors = min(processors, running_procs)
+
+        self.processors = max(self.min_processors, min(self.max_processors, processors))
+
+        memory_gb = running_mem_gb + snapshot["mem_available_gb"] - self.memory_reserve_gb
+        self.memory_gb = max(min(running_mem_gb, self.max_memory_gb), min(self.max_memory_gb, memory_gb))
+
+        total_delta = snapshot["cpu_total_time"] - self._last_snapshot["cpu_total_time"]
+        idle_delta = snapshot["cpu_idle_time"] - self._last_snapshot["cpu_idle_time"]
+        cpu_utilization = 1.0 - idle_delta / total_delta if total_delta > 0 else 0.0
+
+        self.samples.append({
+            "time": now,
+            "load_1min": snapshot["load_1min"],
+            "cpu_utilization": cpu_utilization,
+            "mem_available_gb": snapshot["mem_available_gb"],
+            "swapping": swapping,
+            "running_tasks": len(running_tasks),
+            "running_procs": running_procs,
+            "running_mem_gb": running_mem_gb,
+            "processors": self.processors,
+            "memory_gb": self.memory_gb,
+        })
+
+        self._last_snapshot = snapshot
+
+    def _check_resources(self, running_tasks):
+        self._adapt(running_tasks)
+        return super()._check_resources(running_tasks)
+
+    def _postrun_check(self):
+        super()._postrun_check()
+        self.report()
+
+    def report(self):
+        """
+        Prints a utilization summary and writes the samples to `utilization_report`.
+        """
+        if not self.samples:
+            return
+
+        n = len(self.samples)
+        duration = self.samples[-1]["time"] - self.samples[0]["time"]
+        mean_cpu = sum([sample["cpu_utilization"] for sample in self.samples]) / n
+        mean_running = sum([sample["running_procs"] for sample in self.samples]) / n
+        mean_processors = sum([sample["processors"] for sample in self.samples]) / n
+        mean_running_mem = sum([sample["running_mem_gb"] for sample in self.samples]) / n
+        mean_memory = sum([sample["memory_gb"] for sample in self.samples]) / n
+        min_available = min([sample["mem_available_gb"] for sample in self.samples])
+        n_swapping = sum([sample["swapping"] for sample in self.samples])
+        n_idle_slots = sum([sample["running_procs"] < sample["processors"] for sample in self.samples])
+
+        print()
+        print(f"SCHEDULER: utilization over {duration / 60:.1f} minutes ({n} samples)")
+        print(f"SCHEDULER: mean CPU utilization {mean_cpu * 100:.1f}%")
+        print(f"SCHEDULER: mean running processes {mean_running:.1f} of {mean_processors:.1f} allowed (ceiling {self.max_processors})")
+        print(f"SCHEDULER: mean reserved memory {mean_running_mem:.1f} of {mean_memory:.1f} GB allowed (ceiling {self.max_memory_gb:.1f})")
+        print(f"SCHEDULER: free slots in {n_idle_slots / n * 100:.1f}% of samples")
+        print(f"SCHEDULER: minimum available memory {min_available:.1f} GB, swapping in {n_swapping} samples")
+
+        if self.utilization_report:
+            with open(self.utilization_report, "w") as file:
+                json.dump({"max_processors": self.max_processors, "max_memory_gb": self.max_memory_gb, "samples": self.samples}, file, indent=2)
+
+            print(f"SCHEDULER: utilization report written to {self.utilization_report}")
@@ -0,0 +1,359 @@
+"""
+Staging of node inputs and outputs on local scratch, so the nodes do not block
+on the NFS mounted /mnt/storage (SST inputs, FEAT datasink).
+
+The main process of a pipeline starts a Prefetcher with the inputs of its nodes
+in the workflow's task order (the iterables order). Background threads copy them
+to the staging directory, ahead of the nodes, up to the staging size. The nodes
+(other processes) only ask for the local copy:
+
+    staged(path)                    local copy of path if it is staged (or a pending output), else path,
+                                    never waits: an input not staged yet is read from NFS
+    write_back(local_path, path)    an output for path, copied to the outbox and written to path by the
+                                    Prefetcher's threads while the node returns (synchronous without staging)
+
+Layout of the staging directory (STAGING_DIR, set by the mains for their nodes):
+    inputs/<key>/<file name>        copy of a source, key: hash of the path, size, mtime (a rewritten source
+                                    gets a new copy), .consumed once handed to a node
+    outbox/<key>/<file name>        output waiting to be written back (dest.json: its path and a token of
+                                    this write), .written (the token) once this write is done
+
+Consumed inputs and written outputs are evicted least recently used first when
+the staging directory is full (down to EVICT_FRACTION of its size, so that it is
+not scanned again for every input), the Prefetcher waits for evictable copies
+before staging more. Its size is counted as the copies are made, written back and
+evicted (one scan at start). Outputs are written back as soon as the nodes hand
+them over, by a thread of their own; outputs not written back by a crashed run
+are written at the start of the next one.
+
+Usage (main process):
+    prefetcher = Prefetcher(staging_dir)
+    prefetcher.start(input_paths)          # in task order, also sets STAGING_DIR for the nodes
+    try:
+        workflow.run(...)
+    finally:
+        prefetcher.close()                 # waits for the write backs
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as opj
+
+DEFAULT_STAGING_DIR = "/tmp/fmri-pipeline-staging"
+DEFAULT_STAGING_GB = 100
+
+# eviction frees the staging directory down to this fraction of its size
+EVICT_FRACTION = 0.9
+
+INPUTS_DIR = "inputs"
+OUTBOX_DIR = "outbox"
+CONSUMED = ".consumed"
+WRITTEN = ".written"
+DEST_FILE = "dest.json"
+
+
+def staging_dir() -> str:
+    """
+    Returns the staging directory of this pipeline run (None if staging is off).
+    """
+    return os.getenv("STAGING_DIR") or None
+
+
+def _path_hash(path: str) -> str:
+    return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+
+
+def _input_dir(base_dir: str, path: str) -> str:
+    stat = os.stat(path)
+    return opj(base_dir, INPUTS_DIR, f"{_path_hash(path)}-{stat.st_size}-{stat.st_mtime_ns}")
+
+
+def _outbox_dir(base_dir: str, path: str) -> str:
+    return opj(base_dir, OUTBOX_DIR, _path_hash(path))
+
+
+def _copy(src: str, dst: str):
+    # temporary file then rename, a copy is either complete or absent
+    tmp_path = f"{dst}.tmp-{os.getpid()}-{threading.get_ident()}"
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def _entry_size(entry_dir: str) -> int:
+    size = 0
+    for name in os.listdir(entry_dir):
+        try:
+            size += os.path.getsize(opj(entry_dir, name))
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def _touch(path: str):
+    with open(path, "a"):
+        pass
+    os.utime(path)
+
+
+def _read_token(path: str):
+    # token of a write back (dest.json) or of the write back done (.written), None if there is none
+    try:
+        with open(path, "r") as file:
+            content = file.read()
+    except FileNotFoundError:
+        return None
+    if os.path.basename(path) == DEST_FILE:
+        # outboxes of runs before the tokens: an empty token
+        return json.loads(content).get("token", "")
+    return content
+
+
+def _is_written(entry_dir: str) -> bool:
+    # written back if .written holds the token of the current dest.json (a rewrite gets a new token)
+    token = _read_token(opj(entry_dir, DEST_FILE))
+    return token is not None and token == _read_token(opj(entry_dir, WRITTEN))
+
+
+def staged(path: str) -> str:
+    """
+    Returns the local copy of path (a pending output, or a staged input), path itself if there is none.
+    """
+    base_dir = staging_dir()
+    if base_dir is None:
+        return path
+
+    candidates = [_outbox_dir(base_dir, path)]
+    try:
+        candidates.append(_input_dir(base_dir, path))
+    except FileNotFoundError:
+        pass
+
+    for entry_dir in candidates:
+        local_path = opj(entry_dir, os.path.basename(path))
+        written_path = opj(entry_dir, WRITTEN)
+        # a written output is stale if path was rewritten since
+        if os.path.exists(written_path) and os.path.exists(path) and os.path.getmtime(path) > os.path.getmtime(written_path):
+            continue
+        if os.path.exists(local_path):
+            # handed out, can be evicted once the cache is full
+            _touch(opj(entry_dir, CONSUMED))
+            return local_path
+
+    return path
+
+
+def write_back(local_path: str, path: str) -> str:
+    """
+    Writes the output local_path to path: through the outbox (written back in the background) if
+    staging is on, else now. Returns path.
+    """
+    base_dir = staging_dir()
+    if base_dir is None:
+        _copy(local_path, path)
+        return path
+
+    entry_dir = _outbox_dir(base_dir, path)
+    os.makedirs(entry_dir, exist_ok=True)
+
+    for marker in [WRITTEN, DEST_FILE]:
+        if os.path.exists(opj(entry_dir, marker)):
+            os.remove(opj(entry_dir, marker))
+
+    _copy(local_path, opj(entry_dir, os.path.basename(path)))
+
+    # the destination last, the entry is complete once it exists
+    tmp_path = f"{opj(entry_dir, DEST_FILE)}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        json.dump({"dest": path, "token": uuid.uuid4().hex}, file)
+    os.replace(tmp_path, opj(entry_dir, DEST_FILE))
+
+    return path
+
+
+class Prefetcher:
+    """
+    Stages the inputs of the nodes in task order and writes their outputs back, in background threads
+    of the main process (see the module docstring).
+    """
+
+    def __init__(self, base_dir: str = None, max_gb: float = DEFAULT_STAGING_GB, n_workers: int = 4, poll_interval: float = 1.0):
+        self.base_dir = base_dir or staging_dir() or DEFAULT_STAGING_DIR
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.n_workers = n_workers
+        self.poll_interval = poll_interval
+
+        self.n_staged = 0
+        self.n_written = 0
+        self.staged_bytes = 0
+        # bytes of the submitted copies not on disk yet
+        self._in_flight = 0
+        # bytes in the staging directory (inputs and written back outputs), and of each output
+        self._bytes = 0
+        self._outbox_sizes = {}
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._drain_thread = None
+        self._executor = None
+
+        os.makedirs(opj(self.base_dir, INPUTS_DIR), exist_ok=True)
+        os.makedirs(opj(self.base_dir, OUTBOX_DIR), exist_ok=True)
+
+    def _entries(self, sub_dir: str) -> list:
+        return [opj(self.base_dir, sub_dir, name) for name in os.listdir(opj(self.base_dir, sub_dir))]
+
+    def _scan(self):
+        # size of the staging directory, once at start
+        with self._lock:
+            self._bytes = sum([_entry_size(entry_dir) for entry_dir in self._entries(INPUTS_DIR)])
+            for entry_dir in self._entries(OUTBOX_DIR):
+                self._outbox_sizes[entry_dir] = _entry_size(entry_dir)
+                self._bytes += self._outbox_sizes[entry_dir]
+
+    def _evict(self, needed: int) -> bool:
+        """
+        Evicts consumed inputs and written outputs (least recently used first) until needed bytes
+        fit, down to EVICT_FRACTION of the staging size. Returns False if they do not fit yet.
+        """
+        if self._bytes + needed <= self.max_bytes:
+            return True
+
+        evictable = []
+        for sub_dir, marker in [(INPUTS_DIR, CONSUMED), (OUTBOX_DIR, WRITTEN)]:
+            for entry_dir in self._entries(sub_dir):
+                # never an output rewritten since it was written back
+                if sub_dir == OUTBOX_DIR and not _is_written(entry_dir):
+                    continue
+                try:
+                    evictable.append((os.path.getmtime(opj(entry_dir, marker)), entry_dir))
+                except FileNotFoundError:
+                    pass
+
+        for _, entry_dir in sorted(evictable):
+            if self._bytes + needed <= self.max_bytes * EVICT_FRACTION:
+                break
+            entry_size = _entry_size(entry_dir)
+            # nodes still reading an evicted copy keep their open file
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            with self._lock:
+                self._bytes -= self._outbox_sizes.pop(entry_dir, entry_size)
+
+        return self._bytes + needed <= self.max_bytes
+
+    def _stage(self, path: str, size: int):
+        try:
+            entry_dir = _input_dir(self.base_dir, path)
+            local_path = opj(entry_dir, os.path.basename(path))
+            if os.path.exists(local_path):
+                return
+
+            os.makedirs(entry_dir, exist_ok=True)
+            _copy(path, local_path)
+
+            with self._lock:
+                self.n_staged += 1
+                self.staged_bytes += size
+                self._bytes += size
+        except FileNotFoundError:
+            print(f"WARN: staging: {path} does not exist")
+        finally:
+            with self._lock:
+                self._in_flight -= size
+
+    def drain(self):
+        """
+        Writes the pending outputs of the outbox back to their paths.
+        """
+        for entry_dir in self._entries(OUTBOX_DIR):
+            dest_path = opj(entry_dir, DEST_FILE)
+            if not os.path.exists(dest_path) or _is_written(entry_dir):
+                continue
+
+            with open(dest_path, "r") as file:
+                entry = json.load(file)
+            dest, token = entry["dest"], entry.get("token", "")
+
+            _copy(opj(entry_dir, os.path.basename(dest)), dest)
+
+            # rewritten by a node during the copy: written back by the next drain
+            if _read_token(dest_path) != token:
+                continue
+            tmp_path = f"{opj(entry_dir, WRITTEN)}.tmp-{os.getpid()}"
+            with open(tmp_path, "w") as file:
+                file.write(token)
+            os.replace(tmp_path, opj(entry_dir, WRITTEN))
+
+            # counted once written back (a rewritten output replaces its previous size)
+            size = _entry_size(entry_dir)
+            with self._lock:
+                self.n_written += 1
+                self._bytes += size - self._outbox_sizes.get(entry_dir, 0)
+                self._outbox_sizes[entry_dir] = size
+
+    def _drain_loop(self):
+        while not self._stop.is_set():
+            self.drain()
+            self._stop.wait(self.poll_interval)
+
+    def _run(self, paths: list):
+        pending = []
+        for path in paths:
+            # staged as the space frees up (the outbox is written back by _drain_loop meanwhile)
+            needed = os.path.getsize(path) if os.path.exists(path) else 0
+            if needed > self.max_bytes:
+                print(f"WARN: staging: {path} is larger than the staging directory, read from its storage")
+                continue
+            while not self._stop.is_set() and not self._evict(needed + self._in_flight):
+                self._stop.wait(self.poll_interval)
+
+            if self._stop.is_set():
+                break
+
+            with self._lock:
+                self._in_flight += needed
+            pending.append(self._executor.submit(self._stage, path, needed))
+            # at most n_workers copies ahead
+            pending = [future for future in pending if not future.done()]
+            while len([future for future in pending if not future.done()]) >= self.n_workers and not self._stop.is_set():
+                self._stop.wait(0.05)
+
+    def start(self, paths: list):
+        """
+        Writes back the outputs of a previous run, then stages paths (task order) in the background.
+        Sets STAGING_DIR for the nodes (started after this).
+        """
+        os.environ["STAGING_DIR"] = self.base_dir
+
+        self._scan()
+        self.drain()
+
+        # each input once, in order
+        paths = list(dict.fromkeys(paths))
+
+        print(f"STAGING: {len(paths)} inputs to {self.base_dir} ({self.max_bytes / 1024 ** 3:.1f} GB, {self.n_workers} threads)")
+
+        self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        self._thread = threading.Thread(target=self._run, args=(paths,), daemon=True)
+        self._thread.start()
+        self._drain_thread = threading.Thread(target=self._drain_loop, daemon=True)
+        self._drain_thread.start()
+
+    def close(self):
+        """
+        Stops staging and writes back the remaining outputs.
+        """
+        self._stop.set()
+        for thread in [self._thread, self._drain_thread]:
+            if thread is not None:
+                thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+        self.drain()
+
+        print(f"STAGING: {self.n_staged} inputs staged ({self.staged_bytes / 1024 ** 3:.1f} GB), {self.n_written} outputs written back")
@@ -0,0 +1,188 @@
+"""
+Streaming execution of registration -> extraction (roi/ and filtered-func-reg/ --stream),
+without the nipype node per image.
+
+    stream          producer/consumer pools with a bounded number of images in flight: the
+                    registration workers (FLIRT/FNIRT, one process each) hand the registered
+                    image (the local output in their scratch directory) to the extraction
+                    workers as soon as it is done, and the results go to the writer in the
+                    main process. Registration waits when max_pending images are registered
+                    but not extracted yet (backpressure), so both pools stay busy and memory
+                    and scratch stay bounded.
+    ShardWriter     table written as its rows arrive: every shard_rows rows a shard is
+                    written (a file per partition of the Parquet dataset, or appended to the
+                    csv) to a temporary path that replaces the table when it is closed.
+
+Compared to the workflow, there are no pickled node results and no process spawned per
+image, and the registered image is extracted from local scratch instead of being read
+back from the FEAT directory.
+
+Usage:
+    writer = ShardWriter(save_path, partition_cols=["session", "image_name"])
+    failures = stream(units, utils.stream_register_func, utils.stream_extract_func, lambda unit, rows: writer.add(rows))
+    writer.close()
+"""
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+# rows of the table per shard
+SHARD_ROWS = 1_000_000
+
+
+def stream(units: list, produce, consume, sink, n_producers: int = 8, n_consumers: int = 8, max_pending: int = None,
+           report_every: int = 50) -> list:
+    """
+    Runs produce(unit) in the producer pool, then consume(unit, produced) in the consumer pool, then
+    sink(unit, consumed) in this process, for every unit. At most max_pending units (default: both
+    pool sizes) are between produce and sink at once.
+
+    produce and consume must be module level functions (run in other processes).
+    Returns the failed units as (unit, error) pairs, the other units are still processed.
+    """
+    max_pending = max_pending or n_producers + n_consumers
+
+    units = list(units)
+    next_unit = 0
+    n_pending = 0
+    n_done = 0
+    failures = []
+    in_flight = {}
+
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers=n_producers) as producers, ProcessPoolExecutor(max_workers=n_consumers) as consumers:
+        while True:
+            # backpressure: no new registration until an extraction is done
+            while n_pending < max_pending and next_unit < len(units):
+                unit = units[next_unit]
+                in_flight[producers.submit(produce, unit)] = ("produce", unit)
+                next_unit += 1
+                n_pending += 1
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, unit = in_flight.pop(future)
+
+                try:
+                    result = future.result()
+                except Exception as error:
+                    print(f"WARN: STREAM: {stage} failed for {unit}: {error!r}")
+                    failures.append((unit, error))
+                    n_pending -= 1
+                    continue
+
+                if stage == "produce":
+                    in_flight[consumers.submit(consume, unit, result)] = ("consume", unit)
+                    continue
+
+                sink(unit, result)
+                n_pending -= 1
+                n_done += 1
+
+                if n_done % report_every == 0:
+                    elapsed = time.time() - start_time
+                    print(f"STREAM: {n_done}/{len(units)} done ({len(failures)} failed), {n_done / elapsed * 60:.1f} per minute")
+
+    print(f"STREAM: {n_done}/{len(units)} done, {len(failures)} failed, in {time.time() - start_time:.1f} seconds")
+
+    return failures
+
+
+class ShardWriter:
+    """
+    Table written in shards as rows are added (see the module docstring): a Parquet dataset
+    partitioned by partition_cols, or a csv if save_path ends with .csv.
+    """
+
+    def __init__(self, save_path: str, partition_cols: list = None, shard_rows: int = SHARD_ROWS, transform=None):
+        """
+        transform: applied to each shard before it is written (ex: activation_table.compact)
+        """
+        self.save_path = save_path
+        self.partition_cols = partition_cols
+        self.shard_rows = shard_rows
+        self.transform = transform
+
+        self.is_csv = save_path.endswith(".csv")
+        self.tmp_path = f"{save_path}.tmp-{os.getpid()}"
+        self.columns = None
+        self.n_shards = 0
+        self.n_rows = 0
+
+        self._buffer = []
+        self._buffered_rows = 0
+
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+
+    def add(self, rows):
+        """
+        Adds rows (list of dicts or DataFrame), writes a shard once shard_rows rows are buffered.
+        """
+        rows = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        if not len(rows):
+            return
+
+        self._buffer.append(rows)
+        self._buffered_rows += len(rows)
+
+        if self._buffered_rows >= self.shard_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+
+        shard = pd.concat(self._buffer, ignore_index=True)
+        self._buffer = []
+        self._buffered_rows = 0
+
+        # every shard with the columns of the first one
+        if self.columns is None:
+            self.columns = list(shard.columns)
+        shard = shard.reindex(columns=self.columns)
+
+        if self.transform is not None:
+            shard = self.transform(shard)
+
+        if self.is_csv:
+            shard.to_csv(self.tmp_path, mode="a", header=self.n_shards == 0, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            pq.write_to_dataset(pa.Table.from_pandas(shard, preserve_index=False), self.tmp_path, partition_cols=self.partition_cols,
+                                basename_template=f"part-{self.n_shards:05d}-{{i}}.parquet", compression="zstd")
+
+        self.n_shards += 1
+        self.n_rows += len(shard)
+
+    def close(self) -> str:
+        """
+        Writes the last shard and replaces the table at save_path. Returns save_path.
+        """
+        self._flush()
+
+        if self.is_csv:
+            if self.n_shards == 0:
+                pd.DataFrame().to_csv(self.tmp_path, index=False)
+            os.replace(self.tmp_path, self.save_path)
+        else:
+            os.makedirs(self.tmp_path, exist_ok=True)
+            shutil.rmtree(self.save_path, ignore_errors=True)
+            os.replace(self.tmp_path, self.save_path)
+
+        print(f"SHARD_WRITER: {self.n_rows} rows in {self.n_shards} shards -> {self.save_path}")
+
+        return self.save_path
@@ -0,0 +1,407 @@
+"""
+Execution timeline of a pipeline run, from its event log (common/instrument.py):
+the nodes of the workflow (nipype status callbacks), the measured functions, and
+the machine samples (CPU, memory).
+
+    export_timeline     writes next to the event log:
+                        <log>.trace.json    Chrome trace (open in Perfetto, ui.perfetto.dev works offline, or chrome://tracing)
+                        <log>.html          self-contained timeline: node per slot, running nodes, CPU and
+                                            memory utilization, critical path, stragglers
+    critical_path       chain of nodes that set the makespan: from the node ending last, back through the
+                        dependency that ended last (the execution graph of workflow.run), with the time
+                        each one waited after its dependency ended (no free slot, or the scheduler's polling)
+
+Slots: MultiProc does not report which worker ran a node, a node gets the lowest
+slot free at its start (so the number of slots in use is the number of running nodes).
+Without workflow nodes (--stream) the slots hold the measured functions of the
+worker processes (not the ones nested in another).
+
+Without an execution graph (--stream, or a log whose graph was not saved) the
+critical path is approximated: the node before is the one that ended last before
+the node started.
+
+Usage:
+    run = workflow.run(plugin="MultiProc", plugin_args={..., "status_callback": instrument.status_callback})
+    export_timeline(event_log, graph=run)
+    report_run(event_log, graph=run)    # both reports of a run, in the mains' finally blocks
+
+    python -m common.timeline roi/workingdir/event_logs/roi_2024-05-02_10-30-00.jsonl
+"""
+import argparse
+import heapq
+import html
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from common.instrument import ENTITY_KEYS, print_summary, read_events
+
+# colors of the node types in the HTML timeline
+PALETTE = ["#4e79a7", "#f28e2b", "#59a14f", "#e15759", "#76b7b2", "#edc948", "#b07aa1", "#ff9da7", "#9c755f", "#bab0ac"]
+
+# the idle tail starts when fewer than this fraction of the peak nodes run until the end
+TAIL_FRACTION = 0.5
+
+
+def _base_path(event_log: str) -> str:
+    return event_log[:-len(".jsonl")] if event_log.endswith(".jsonl") else event_log
+
+
+def save_graph(graph, event_log: str) -> str:
+    """
+    Saves the edges of the execution graph (returned by workflow.run) next to the event log. Returns its path.
+    """
+    path = f"{_base_path(event_log)}.graph.json"
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        json.dump({"edges": [[source.itername, target.itername] for source, target in graph.edges()]}, file)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def load_graph(event_log: str) -> list:
+    """
+    Returns the saved edges of the execution graph of the event log (None if there are none).
+    """
+    path = f"{_base_path(event_log)}.graph.json"
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as file:
+        return [tuple(edge) for edge in json.load(file)["edges"]]
+
+
+def load_timeline(event_log: str):
+    """
+    Returns (intervals, samples) of the event log: the nodes and measured functions that ran (start, end,
+    relative to the start of the run) and the machine samples.
+    """
+    events = read_events(event_log)
+    if "source" not in events.columns:
+        events["source"] = None
+    for column in ["start", "end", "wall_s", "cpu_percent", "mem_used_gb", "mem_total_gb", "pid"]:
+        events[column] = pd.to_numeric(events[column], errors="coerce") if column in events.columns else np.nan
+    for column in ["node_id", "cache"]:
+        if column not in events.columns:
+            events[column] = None
+
+    samples = events[events["source"] == "sample"].sort_values("start")
+    intervals = events[(events["source"] != "sample") & events["start"].notna() & events["end"].notna()]
+
+    origin = min(intervals["start"].min() if len(intervals) else np.inf, samples["start"].min() if len(samples) else np.inf)
+    origin = 0.0 if np.isinf(origin) else origin
+
+    intervals = intervals.assign(start=intervals["start"] - origin, end=intervals["end"] - origin).sort_values("start").reset_index(drop=True)
+    samples = samples.assign(start=samples["start"] - origin).reset_index(drop=True)
+
+    return intervals, samples
+
+
+def _primary(intervals: pd.DataFrame) -> pd.DataFrame:
+    # the intervals occupying the slots: workflow nodes, else the top level measured functions of each process
+    nodes = intervals[intervals["source"] == "workflow"]
+    if len(nodes):
+        return nodes
+
+    measured = intervals.sort_values(["pid", "start", "end"], ascending=[True, True, False])
+    top_level = []
+    for _, group in measured.groupby("pid", sort=False):
+        last_end = -np.inf
+        for index, end in zip(group.index, group["end"]):
+            if end > last_end:
+                top_level.append(index)
+                last_end = end
+
+    return intervals.loc[sorted(top_level)]
+
+
+def assign_slots(intervals: pd.DataFrame) -> pd.Series:
+    """
+    Returns the slot of each interval: the lowest slot free at its start.
+    """
+    free = []
+    busy = []
+    n_slots = 0
+    slots = {}
+
+    for index, start, end in sorted(zip(intervals.index, intervals["start"], intervals["end"]), key=lambda item: item[1]):
+        while busy and busy[0][0] <= start:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if free:
+            slot = heapq.heappop(free)
+        else:
+            slot = n_slots
+            n_slots += 1
+        slots[index] = slot
+        heapq.heappush(busy, (end, slot))
+
+    return pd.Series(slots, dtype=int).reindex(intervals.index)
+
+
+def running(intervals: pd.DataFrame):
+    """
+    Returns (times, counts): the number of running intervals from each time on (step function).
+    """
+    changes = pd.concat([pd.Series(1, index=intervals["start"].to_numpy()), pd.Series(-1, index=intervals["end"].to_numpy())])
+    changes = changes.groupby(level=0).sum().sort_index()
+
+    return changes.index.to_numpy(), changes.cumsum().to_numpy()
+
+
+def critical_path(intervals: pd.DataFrame, edges: list = None) -> pd.DataFrame:
+    """
+    Returns the critical path (see the module docstring), first node first, with the time each node
+    waited after the node before it ended (wait_s).
+    """
+    if not len(intervals):
+        return intervals.assign(wait_s=[])
+
+    by_id = {node_id: index for index, node_id in zip(intervals.index, intervals["node_id"]) if pd.notna(node_id)}
+
+    predecessors = None
+    if edges is not None and by_id:
+        predecessors = {}
+        for source, target in edges:
+            predecessors.setdefault(target, []).append(source)
+
+    def timed_predecessors(node_id: str) -> list:
+        # through the nodes that did not run (nipype cache)
+        found, stack, seen = [], list(predecessors.get(node_id, [])), set()
+        while stack:
+            predecessor = stack.pop()
+            if predecessor in seen:
+                continue
+            seen.add(predecessor)
+            if predecessor in by_id:
+                found.append(by_id[predecessor])
+            else:
+                stack.extend(predecessors.get(predecessor, []))
+        return found
+
+    starts = intervals["start"].to_numpy()
+    ends = intervals["end"].to_numpy()
+    order = np.argsort(ends)
+
+    path = [intervals["end"].idxmax()]
+    while True:
+        current = path[-1]
+        if predecessors is not None:
+            candidates = [index for index in timed_predecessors(intervals.at[current, "node_id"]) if index not in path]
+        else:
+            # the interval that ended last before this one started
+            position = np.searchsorted(ends[order], starts[intervals.index.get_loc(current)], side="left")
+            candidates = [intervals.index[order[position - 1]]] if position > 0 else []
+
+        if not candidates:
+            break
+        path.append(max(candidates, key=lambda index: intervals.at[index, "end"]))
+
+    path = intervals.loc[path[::-1]].copy()
+    path["wait_s"] = (path["start"] - path["end"].shift(1).fillna(0.0)).clip(lower=0.0)
+
+    return path
+
+
+def _label(row) -> str:
+    entities = [f"{key}={row[key]}" for key in ENTITY_KEYS + ["unit"] if key in row.index and pd.notna(row[key]) and not isinstance(row[key], float)]
+    return f"{row['node_type']} " + " ".join(entities)
+
+
+def _args(row) -> dict:
+    # numpy scalars as python values, no NaN (not JSON)
+    return {key: row[key].item() if isinstance(row[key], np.generic) else row[key]
+            for key in ENTITY_KEYS + ["unit", "node_id", "cache", "cpu_s", "peak_rss_mb", "read_bytes", "write_bytes"]
+            if key in row.index and row[key] is not None and not (isinstance(row[key], (float, np.floating)) and np.isnan(row[key]))}
+
+
+def write_chrome_trace(path: str, intervals: pd.DataFrame, samples: pd.DataFrame, slots: pd.Series, critical: pd.DataFrame):
+    """
+    Writes the Chrome trace (JSON object format): the slots, the measured functions per worker process,
+    the critical path, and the counters (running nodes, CPU, memory).
+    """
+    trace = [
+        {"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "machine"}},
+        {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "slots"}},
+        {"name": "process_name", "ph": "M", "pid": 2, "args": {"name": "measured (worker processes)"}},
+        {"name": "process_name", "ph": "M", "pid": 3, "args": {"name": "critical path"}},
+    ]
+
+    def complete(row, pid: int, tid: int) -> dict:
+        return {"name": row["node_type"], "cat": row["source"], "ph": "X", "ts": round(row["start"] * 1e6), "dur": round((row["end"] - row["start"]) * 1e6),
+                "pid": pid, "tid": tid, "args": _args(row)}
+
+    for index, row in intervals.loc[slots.index].iterrows():
+        trace.append(complete(row, 1, int(slots[index])))
+
+    for _, row in intervals[intervals["source"] == "node"].iterrows():
+        trace.append(complete(row, 2, int(row["pid"]) if pd.notna(row["pid"]) else 0))
+
+    for _, row in critical.iterrows():
+        trace.append(complete(row, 3, 0))
+
+    times, counts = running(intervals.loc[slots.index])
+    for time, count in zip(times, counts):
+        trace.append({"name": "running", "ph": "C", "ts": round(time * 1e6), "pid": 0, "args": {"nodes": int(count)}})
+
+    for _, sample in samples.dropna(subset=["cpu_percent", "mem_used_gb"]).iterrows():
+        trace.append({"name": "cpu", "ph": "C", "ts": round(sample["start"] * 1e6), "pid": 0, "args": {"percent": float(sample["cpu_percent"])}})
+        trace.append({"name": "memory", "ph": "C", "ts": round(sample["start"] * 1e6), "pid": 0, "args": {"used_gb": float(sample["mem_used_gb"])}})
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, file, default=str)
+    os.replace(tmp_path, path)
+
+
+def timeline_stats(intervals: pd.DataFrame, slots: pd.Series, critical: pd.DataFrame) -> dict:
+    """
+    Returns the makespan, the slot utilization (busy time / slots x makespan), the idle tail and the critical path length.
+    """
+    primary = intervals.loc[slots.index]
+    makespan = primary["end"].max() if len(primary) else 0.0
+    n_slots = int(slots.max()) + 1 if len(slots) else 0
+    busy = (primary["end"] - primary["start"]).sum()
+
+    times, counts = running(primary)
+    tail_start = makespan
+    if len(counts):
+        # last time enough nodes were running
+        enough = np.nonzero(counts >= TAIL_FRACTION * counts.max())[0]
+        tail_start = times[enough[-1] + 1] if len(enough) and enough[-1] + 1 < len(times) else makespan
+
+    return {
+        "makespan_s": makespan,
+        "nodes": len(primary),
+        "slots": n_slots,
+        "slot_utilization": busy / (n_slots * makespan) if n_slots and makespan else np.nan,
+        "idle_tail_s": makespan - tail_start,
+        "critical_path_nodes": len(critical),
+        "critical_path_wait_s": critical["wait_s"].sum() if len(critical) else 0.0,
+    }
+
+
+def _duration(seconds: float) -> str:
+    return f"{seconds:.1f} s" if seconds < 120 else f"{seconds / 60:.1f} min" if seconds < 7200 else f"{seconds / 3600:.1f} h"
+
+
+def _polyline(xs, ys, x_scale, y_scale, height: float, color: str) -> str:
+    points = " ".join([f"{x * x_scale:.1f},{height - y * y_scale:.1f}" for x, y in zip(xs, ys) if not np.isnan(y)])
+    return f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="1.2"/>'
+
+
+def write_html(path: str, intervals: pd.DataFrame, samples: pd.DataFrame, slots: pd.Series, critical: pd.DataFrame, title: str,
+               approximate: bool, top: int = 10):
+    """
+    Writes the self-contained HTML timeline (inline SVG, no scripts): nodes per slot (critical path outlined),
+    running nodes, CPU and memory utilization, the summary and the stragglers.
+    """
+    width = 1400
+    stats = timeline_stats(intervals, slots, critical)
+    makespan = max(stats["makespan_s"], samples["start"].max() if len(samples) else 0.0, 1e-9)
+    x_scale = width / makespan
+
+    lane_height = max(2, min(14, 600 // max(stats["slots"], 1)))
+    lanes_height = lane_height * stats["slots"]
+    critical_ids = set(critical.index)
+    colors = {node_type: PALETTE[i % len(PALETTE)] for i, node_type in enumerate(sorted(intervals.loc[slots.index, "node_type"].unique()))}
+
+    rects = []
+    for index, row in intervals.loc[slots.index].iterrows():
+        outline = ' stroke="#d00" stroke-width="1.5"' if index in critical_ids else ""
+        rects.append(f'<rect x="{row["start"] * x_scale:.1f}" y="{slots[index] * lane_height}" width="{max((row["end"] - row["start"]) * x_scale, 0.5):.1f}" '
+                     f'height="{lane_height - 1}" fill="{colors[row["node_type"]]}"{outline}><title>{html.escape(_label(row))} '
+                     f'({row["end"] - row["start"]:.1f} s)</title></rect>')
+
+    chart_height = 90
+    times, counts = running(intervals.loc[slots.index])
+    step_times = np.repeat(times, 2)[1:]
+    step_counts = np.repeat(counts, 2)[:-1]
+    charts = [("running nodes", _polyline(step_times, step_counts, x_scale, chart_height / max(stats["slots"], 1), chart_height, "#333"))]
+    if len(samples):
+        charts.append(("CPU %", _polyline(samples["start"], samples["cpu_percent"], x_scale, chart_height / 100, chart_height, "#e15759")))
+        charts.append(("memory used / total", _polyline(samples["start"], samples["mem_used_gb"], x_scale, chart_height / samples["mem_total_gb"].max(),
+                                                        chart_height, "#4e79a7")))
+
+    legend = " ".join([f'<span style="background:{color}">&nbsp;&nbsp;&nbsp;</span> {html.escape(node_type)}' for node_type, color in colors.items()])
+
+    def table(rows: pd.DataFrame) -> str:
+        lines = [f"<tr><td>{row['start']:.1f}</td><td>{row['end'] - row['start']:.1f}</td><td>{f'{row.wait_s:.1f}' if 'wait_s' in row.index else ''}</td>"
+                 f"<td>{html.escape(_label(row))}</td></tr>" for _, row in rows.iterrows()]
+        return "<table><tr><th>start (s)</th><th>duration (s)</th><th>waited (s)</th><th>node</th></tr>" + "".join(lines) + "</table>"
+
+    primary = intervals.loc[slots.index]
+    stragglers = primary.assign(duration=primary["end"] - primary["start"]).sort_values("duration", ascending=False).head(top)
+
+    summary = (f"makespan {_duration(stats['makespan_s'])}, {stats['nodes']} nodes on {stats['slots']} slots, "
+               f"slot utilization {stats['slot_utilization']:.0%}, idle tail {_duration(stats['idle_tail_s'])} "
+               f"(fewer than {TAIL_FRACTION:.0%} of the peak nodes running), critical path {stats['critical_path_nodes']} nodes "
+               f"that waited {_duration(stats['critical_path_wait_s'])} after their dependencies ended{' (approximate, no execution graph)' if approximate else ''}")
+
+    sections = [f"<h1>{html.escape(title)}</h1>", f"<p>{summary}</p>", f"<p>{legend}</p>",
+                f'<svg width="{width}" height="{lanes_height}">{"".join(rects)}</svg>']
+    for name, line in charts:
+        sections.append(f'<h3>{name}</h3><svg width="{width}" height="{chart_height}"><rect width="{width}" height="{chart_height}" fill="#f6f6f6"/>{line}</svg>')
+    sections.append(f"<h3>critical path</h3>{table(critical)}")
+    sections.append(f"<h3>{top} slowest nodes</h3>{table(stragglers)}")
+
+    style = "body{font-family:sans-serif;font-size:13px} table{border-collapse:collapse} td,th{padding:2px 8px;text-align:left;border-bottom:1px solid #ddd}"
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        file.write(f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{html.escape(title)}</title><style>{style}</style></head>"
+                   f"<body>{''.join(sections)}</body></html>")
+    os.replace(tmp_path, path)
+
+
+def export_timeline(event_log: str, graph=None) -> tuple:
+    """
+    Writes the Chrome trace and the HTML timeline of the event log (see the module docstring).
+    graph: the execution graph returned by workflow.run (saved next to the event log), else the saved one.
+    Returns (trace path, html path).
+    """
+    if graph is not None:
+        save_graph(graph, event_log)
+    edges = load_graph(event_log)
+
+    intervals, samples = load_timeline(event_log)
+    if not len(intervals):
+        print(f"No node events in {event_log}, no timeline")
+        return None, None
+
+    slots = assign_slots(_primary(intervals))
+    critical = critical_path(intervals.loc[slots.index], edges if len(intervals.loc[slots.index, "node_id"].dropna()) else None)
+    approximate = edges is None or not len(intervals.loc[slots.index, "node_id"].dropna())
+
+    trace_path = f"{_base_path(event_log)}.trace.json"
+    html_path = f"{_base_path(event_log)}.html"
+
+    write_chrome_trace(trace_path, intervals, samples, slots, critical)
+    write_html(html_path, intervals, samples, slots, critical, os.path.basename(_base_path(event_log)), approximate)
+
+    print(f"TIMELINE: {trace_path} (Perfetto / chrome://tracing), {html_path}")
+
+    return trace_path, html_path
+
+
+def report_run(event_log: str, graph=None):
+    """
+    Prints the summary of a run's event log and exports its timeline, for the finally block of
+    the mains: an error of the report is printed, it never replaces the workflow's own exception.
+    """
+    for report, kwargs in [(print_summary, {}), (export_timeline, {"graph": graph})]:
+        try:
+            report(event_log, **kwargs)
+        except Exception as error:
+            print(f"WARN: {report.__name__} of {event_log} failed: {error!r}")
+
+
+parser = argparse.ArgumentParser(description="Chrome trace and HTML timeline of a pipeline run's event log")
+parser.add_argument("event_log", type=str, help="Event log (.jsonl) written by a run")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    export_timeline(args.event_log)
@@ -1,30 +1,150 @@
 import argparse
-from logging import log
-from nipype import Node, Workflow, Function, IdentityInterface, DataSink, JoinNode, MapNode
 import os
+import re
 import time
 import utils
 import constants
 
-##############
-# Nodes
-##############
-itersource = Node(interface=IdentityInterface(fields=["filtered_func", "affine_file", "ev_files"]), name="itersource")
-itersource.synchronize = True # do not do all permutations
+# shared modules (common/), also needed by the Function nodes in the worker processes
+os.sys.path.append(os.path.dirname(constants.BASE_DIR))
+
+# nipype is only imported when the workflow is built, --plan only lists the inputs and outputs
+
+# timeseries csv of the datasink (DataSink's csv/ folder)
+AGGREGATE_CSV = os.path.join(constants.BASE_DIR, "filtered_func_reg_datasink", "csv", "roi_timeseries.csv")
+
+
+def get_run_keys(filtered_func_path: str) -> dict:
+    """
+    Returns the subject_id, session and run of a filtered_func path (as roi_extract_all_timeseries_node_func).
+    """
+    subj_match = re.search(r"sub-([^_/]+)", filtered_func_path)
+    run_match = re.search(r"run-([\d]+)", filtered_func_path)
+    session_match = re.search(r"ses-([^_/]+)", filtered_func_path)
+
+    return {
+        "subject_id": subj_match.group(1) if subj_match else None,
+        "session": session_match.group(1) if session_match else None,
+        "run": int(run_match.group(1)) if run_match else None,
+    }
+
+
+def plan_incremental(filtered_func_paths: list, aggregate_path: str):
+    """
+    Returns the units (subject, session, run) of the filtered_funcs that are not in the aggregate
+    timeseries csv yet or whose filtered_func changed (common/incremental.py), as a list of dicts.
+    """
+    import pandas as pd
+    from common.incremental import TIMESERIES_UNIT_COLUMNS, plan_units
+
+    candidates = [{**get_run_keys(filtered_func_path), "source": filtered_func_path} for filtered_func_path in filtered_func_paths]
+
+    return plan_units(pd.DataFrame(candidates, columns=TIMESERIES_UNIT_COLUMNS + ["source"]), aggregate_path, TIMESERIES_UNIT_COLUMNS).to_dict("records")
+
+
+def run_stream(filtered_func_paths: list, affine_files: list, force_run: bool, no_affine: bool, save_path: str, n_register: int, n_extract: int) -> list:
+    """
+    Streaming mode (--stream): registers the filtered_funcs and extracts their ROI timeseries in two process
+    pools (common/streaming.py) instead of the workflow, the rows are written to the csv save_path as they come.
+    Returns the failed units.
+    """
+    from common.streaming import ShardWriter, stream
+
+    units = [{
+        "filtered_func": filtered_func_path,
+        "affine_file": affine_file,
+        "mni_template": constants.MNI_TEMPLATE,
+        "force_run": force_run,
+        "no_affine": no_affine,
+        "scratch_dir": os.path.join(constants.WORKING_DIR, "stream"),
+        "mask_file_path": constants.MASK_PATH,
+        **get_run_keys(filtered_func_path),
+    } for filtered_func_path, affine_file in zip(filtered_func_paths, affine_files)]
+
+    writer = ShardWriter(save_path)
+
+    failures = stream(units, utils.stream_register_func, utils.stream_extract_func, lambda unit, rows: writer.add(rows),
+                      n_producers=n_register, n_consumers=n_extract)
+    writer.close()
+
+    return failures
 
-registration_node = Node(interface=Function(input_names=["nonlinear", "in_file", "affine_file", "mni_template", "force_run", "no_affine"], output_names=["out_file", "nonlinear"], function=utils.registration_node_func), name="registration_node")                  
 
-# join_node = JoinNode(interface=Function(input_names=["in_reg_files"], function=utils.registration_node_func), name="join_node", joinsource="itersource", joinfield=["in_reg_files"])
+def build_workflow(filtered_func_paths: list, affine_files: list, force_run: bool, no_affine: bool, array_store_dir: str = None,
+                   incremental_units: list = None):
+    """
+    Builds the filtered_func registration and ROI timeseries workflow. With array_store_dir, the
+    timeseries are written to the array store (common/array_store.py) instead of a csv. With
+    incremental_units (common/incremental.py), the csv is merged into the aggregate csv of the datasink.
+    """
+    from nipype import Node, Workflow, Function, IdentityInterface, DataSink, JoinNode, MapNode
 
-roi_extract_timeseries = Node(interface=Function(input_names=["input_nifti_path", "mask_file_path"], output_names=["roi_dicts"], function=utils.roi_extract_all_timeseries_node_func), name="roi_extract_timeseries")
-roi_extract_timeseries.inputs.mask_file_path = constants.MASK_PATH
+    ##############
+    # Nodes
+    ##############
+    itersource = Node(interface=IdentityInterface(fields=["filtered_func", "affine_file", "ev_files"]), name="itersource")
+    itersource.synchronize = True # do not do all permutations
 
-join_node = JoinNode(interface=Function(input_names=["joined_dicts"], output_names=["flattened"], function=utils.join_main), name="join_node", joinsource="itersource", joinfield=["joined_dicts"])
+    registration_node = Node(interface=Function(input_names=["nonlinear", "in_file", "affine_file", "mni_template", "force_run", "no_affine"], output_names=["out_file", "nonlinear"], function=utils.registration_node_func), name="registration_node")                  
 
-csv_node = Node(interface=Function(input_names=["flattened"], output_names=["save_path"], function=utils.make_csv_node_func), name="csv_node")
+    # join_node = JoinNode(interface=Function(input_names=["in_reg_files"], function=utils.registration_node_func), name="join_node", joinsource="itersource", joinfield=["in_reg_files"])
+
+    roi_extract_timeseries = Node(interface=Function(input_names=["input_nifti_path", "mask_file_path"], output_names=["roi_dicts"], function=utils.roi_extract_all_timeseries_node_func), name="roi_extract_timeseries")
+    roi_extract_timeseries.inputs.mask_file_path = constants.MASK_PATH
+
+    join_node = JoinNode(interface=Function(input_names=["joined_dicts"], output_names=["flattened"], function=utils.join_main), name="join_node", joinsource="itersource", joinfield=["joined_dicts"])
+
+    csv_node = Node(interface=Function(input_names=["flattened"], output_names=["save_path"], function=utils.make_csv_node_func), name="csv_node")
+
+    datasink = Node(interface=DataSink(), name="datasink")   
+    datasink.inputs.base_directory = os.path.join(constants.BASE_DIR, "filtered_func_reg_datasink")
+
+    itersource.iterables = [("filtered_func", filtered_func_paths), ("affine_file", affine_files)]
+
+    registration_node.inputs.nonlinear = False
+    registration_node.inputs.mni_template = constants.MNI_TEMPLATE
+    registration_node.inputs.force_run = force_run
+    registration_node.inputs.no_affine = no_affine
+
+    workflow = Workflow(name="filtered_func_reg_workflow", base_dir=constants.WORKING_DIR)
+
+    # connect the nodes
+    workflow.connect(itersource, "filtered_func", registration_node, "in_file")
+    workflow.connect(itersource, "affine_file", registration_node, "affine_file")
+    # workflow.connect(registration_node, "out_file", datasink, "reg.@out_file")
+    # workflow.connect(registration_node, "nonlinear", datasink, "reg.@nonlinear")
+    if array_store_dir is not None:
+        from common.array_store import store_index_node_func
+
+        roi_store_timeseries = Node(interface=Function(input_names=["input_nifti_path", "store_dir", "mask_file_path"], output_names=["key"], function=utils.roi_store_timeseries_node_func), name="roi_store_timeseries")
+        roi_store_timeseries.inputs.store_dir = array_store_dir
+        roi_store_timeseries.inputs.mask_file_path = constants.MASK_PATH
+
+        store_index_node = JoinNode(interface=Function(input_names=["keys", "store_dir"], output_names=["store_dir", "index_path"], function=store_index_node_func), name="store_index", joinsource="itersource", joinfield=["keys"])
+        store_index_node.inputs.store_dir = array_store_dir
+
+        workflow.connect(registration_node, "out_file", roi_store_timeseries, "input_nifti_path")
+        workflow.connect(roi_store_timeseries, "key", store_index_node, "keys")
+    else:
+        workflow.connect(registration_node, "out_file", roi_extract_timeseries, "input_nifti_path")
+        workflow.connect(roi_extract_timeseries, "roi_dicts", join_node, "joined_dicts")
+        workflow.connect(join_node, "flattened", csv_node, "flattened")
+        if incremental_units is not None:
+            merge_csv_node = Node(interface=Function(input_names=["csv_path", "aggregate_path", "units"], output_names=["aggregate_path"], function=utils.merge_csv_node_func), name="merge_csv_node")
+            merge_csv_node.inputs.aggregate_path = AGGREGATE_CSV
+            merge_csv_node.inputs.units = incremental_units
+
+            workflow.connect(csv_node, "save_path", merge_csv_node, "csv_path")
+        else:
+            workflow.connect(csv_node, "save_path", datasink, "csv.@save_path")
+    
+    crash_dir = os.path.join(constants.WORKING_DIR, "crash")
+
+    # set crash directory
+    workflow.config["execution"]["crashdump_dir"] = crash_dir
+
+    return workflow
 
-datasink = Node(interface=DataSink(), name="datasink")   
-datasink.inputs.base_directory = os.path.join(constants.BASE_DIR, "filtered_func_reg_datasink")
 
 ##############
 # Parser
@@ -33,11 +153,17 @@ parser = argparse.ArgumentParser(description="Register filtered_func's to MNI te
 parser.add_argument("--force_run", action="store_true", help="Whether to force run the registration node (ignore if the output file already exists)")
 parser.add_argument("--no_affine", action="store_true", help="Whether to use affine file (transfromation matrix) or not (FNIRT only)")
 parser.add_argument("--base_feat_path", type=str, help="Base FEAT directory path")
+parser.add_argument("--plan", action="store_true", help="Only print what would be registered and what already exists, without writing anything")
+parser.add_argument("--graph", action="store_true", help="Whether to write the workflow graph")
 parser.add_argument("--exec_graph", action="store_true", help="Whether to write the execution graph")
 parser.add_argument("--n_procs", type=int, help="Number of processes to run the workflow")
 parser.add_argument("-n", "--num_subjects", type=int, help="Number of subjects to run the workflow")
 parser.add_argument("-y", "--yes", action="store_true", help="Whether to run the workflow without asking for confirmation")
 parser.add_argument("--linear_feat", action="store_true", help="Whether to use linear feat paths only")
+parser.add_argument("--array_store", action="store_true", help="Whether to write the ROI timeseries to the chunked array store instead of a csv")
+parser.add_argument("--stage", action="store_true", help="Whether to copy the filtered_funcs to local scratch (STAGING_DIR) ahead of the nodes and write the registrations back in the background")
+parser.add_argument("--stream", type=int, nargs=2, default=None, metavar=("N_REGISTER", "N_EXTRACT"), help="Whether to register and extract in two process pools (streaming) instead of the workflow, with these numbers of workers")
+parser.add_argument("--incremental", action="store_true", help="Whether to only extract the runs missing from (or changed since) the timeseries csv and merge them into it")
 
 if __name__ == "__main__":
     
@@ -63,46 +189,74 @@ if __name__ == "__main__":
     
     print(f"Using {len(filtered_func_paths)} subjects")
     
-    itersource.iterables = [("filtered_func", filtered_func_paths), ("affine_file", affine_files)]           
+    force_run = args.force_run or False
+    no_affine = args.no_affine or False
         
     print(f"Nonlinear registration: {False}")
     
-    registration_node.inputs.nonlinear = False
-    registration_node.inputs.mni_template = constants.MNI_TEMPLATE
-    registration_node.inputs.force_run = args.force_run or False        
-    registration_node.inputs.no_affine = args.no_affine or False    
-    
     print()
     print(f"Registration node base inputs:\n{"-" * 20}")    
-    print(f"Nonlinear: {registration_node.inputs.nonlinear}")
-    print(f"MNI template: {registration_node.inputs.mni_template}")
-    print(f"Force run: {registration_node.inputs.force_run}")
-    print(f"No affine: {registration_node.inputs.no_affine}")     
-    print(f"Mask path: {roi_extract_timeseries.inputs.mask_file_path}")
+    print(f"Nonlinear: {False}")
+    print(f"MNI template: {constants.MNI_TEMPLATE}")
+    print(f"Force run: {force_run}")
+    print(f"No affine: {no_affine}")     
+    print(f"Mask path: {constants.MASK_PATH}")
     print()
     
-    workflow = Workflow(name="filtered_func_reg_workflow", base_dir=constants.WORKING_DIR)
+    array_store_dir = os.path.join(constants.BASE_DIR, "filtered_func_reg_datasink", "array_store") if args.array_store else None
     
-    # connect the nodes
-    workflow.connect(itersource, "filtered_func", registration_node, "in_file")
-    workflow.connect(itersource, "affine_file", registration_node, "affine_file")
-    # workflow.connect(registration_node, "out_file", datasink, "reg.@out_file")
-    # workflow.connect(registration_node, "nonlinear", datasink, "reg.@nonlinear")
-    workflow.connect(registration_node, "out_file", roi_extract_timeseries, "input_nifti_path")
-    workflow.connect(roi_extract_timeseries, "roi_dicts", join_node, "joined_dicts")
-    workflow.connect(join_node, "flattened", csv_node, "flattened")
-    workflow.connect(csv_node, "save_path", datasink, "csv.@save_path")
+    if args.stream is not None and array_store_dir is not None:
+        print("WARN: --stream writes the timeseries csv, ignored with --array_store")
+        args.stream = None
+    
+    incremental_units = None
+    if args.incremental:
+        if array_store_dir is not None:
+            print("WARN: the array store already skips stored runs, --incremental only applies to the timeseries csv")
+        else:
+            incremental_units = plan_incremental(filtered_func_paths, AGGREGATE_CSV)
+            
+            sources = set([unit["source"] for unit in incremental_units])
+            keep = [i for i, filtered_func_path in enumerate(filtered_func_paths) if filtered_func_path in sources]
+            filtered_func_paths = [filtered_func_paths[i] for i in keep]
+            affine_files = [affine_files[i] for i in keep]
+            print(f"Incremental: {len(filtered_func_paths)} filtered_funcs to extract")
+            
+            if not filtered_func_paths and not args.plan:
+                print("Nothing to compute, the timeseries csv is up to date")
+                exit(0)
+    
+    if args.plan:
+        out_paths = [filtered_func_path.replace(".nii.gz", "_LN.nii.gz") for filtered_func_path in filtered_func_paths]
+        n_cached = 0 if force_run else sum([os.path.exists(out_path) for out_path in out_paths])
         
-    crash_dir = os.path.join(constants.WORKING_DIR, "crash")
+        print("PLAN")
+        print("-" * 20)
+        print(f"FLIRT: {len(out_paths)} registrations, {n_cached} already done, {len(out_paths) - n_cached} to run")
+        print(f"expected outputs: {out_paths[:2]}{' ...' if len(out_paths) > 2 else ''}")
+        if array_store_dir is not None:
+            print(f"ROI timeseries array store: {array_store_dir}")
+        else:
+            print(f"ROI timeseries csv: {os.path.join(constants.BASE_DIR, 'filtered_func_reg_datasink', 'csv')}")
+        if incremental_units is not None:
+            print(f"Incremental: {len(incremental_units)} runs merged into {AGGREGATE_CSV}")
+        if args.stream is not None:
+            print(f"Streaming: {len(filtered_func_paths)} registrations -> extractions, {args.stream[0]} + {args.stream[1]} workers")
+        if args.stage:
+            from common.staging import DEFAULT_STAGING_DIR, staging_dir
+            print(f"Staging: {len(filtered_func_paths) + len(set(affine_files))} inputs to {staging_dir() or DEFAULT_STAGING_DIR}")
+        print(f"nipype cache: {os.path.join(constants.WORKING_DIR, 'filtered_func_reg_workflow')}{'' if os.path.exists(os.path.join(constants.WORKING_DIR, 'filtered_func_reg_workflow')) else ' (none yet)'}")
+        exit(0)
     
-    # set crash directory
-    workflow.config["execution"]["crashdump_dir"] = crash_dir
+    if args.stream is None:
+        workflow = build_workflow(filtered_func_paths, affine_files, force_run, no_affine, array_store_dir, incremental_units)
 
-    # write graphs 
-    if args.exec_graph:
-        workflow.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")    
-        
-    workflow.write_graph(graph2use="colored", format="png")
+        # write graphs 
+        if args.exec_graph:
+            workflow.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")    
+            
+        if args.graph:
+            workflow.write_graph(graph2use="colored", format="png")
     
     # if '-y' argument is passed, run the workflow without asking for confirmation
     if args.yes:
@@ -114,12 +268,48 @@ if __name__ == "__main__":
         print("Exiting...")
         exit(0)
         
+    from common import instrument, timeline
+    
+    # timing and memory events of the nodes, summary: python -m common.instrument <event log>,
+    # timeline: <event log>.html and .trace.json (common/timeline.py)
+    event_log = instrument.start_run(os.path.join(constants.WORKING_DIR, "event_logs"), "filtered_func_reg")
+    
     start_time = time.time()    
     
     n_procs = args.n_procs if args.n_procs else 56
     
-    run = workflow.run(plugin="MultiProc", plugin_args={"n_procs": n_procs})
+    prefetcher = None
+    if args.stage:
+        from common.staging import Prefetcher
+        
+        # in the order of the itersource iterables, each filtered_func with its affine file
+        prefetcher = Prefetcher()
+        prefetcher.start([path for filtered_func_path, affine_file in zip(filtered_func_paths, affine_files) for path in [filtered_func_path, affine_file]])
+    
+    run = None
+    try:
+        if args.stream is not None:
+            # incremental: the csv of this run is merged into the aggregate afterwards
+            csv_path = AGGREGATE_CSV if incremental_units is None else os.path.join(constants.WORKING_DIR, "stream", "roi_timeseries.csv")
+            
+            failures = run_stream(filtered_func_paths, affine_files, force_run, no_affine, csv_path, *args.stream)
+            
+            if incremental_units is not None:
+                # failed runs stay to compute in the next run
+                failed = set([unit["filtered_func"] for unit, _ in failures])
+                utils.merge_csv_node_func(csv_path, AGGREGATE_CSV, [unit for unit in incremental_units if unit["source"] not in failed])
+            
+            if failures:
+                print(f"WARN: {len(failures)} registrations/extractions failed, ex: {failures[0][0]['filtered_func']}: {failures[0][1]!r}")
+        else:
+            run = workflow.run(plugin="MultiProc", plugin_args={"n_procs": n_procs, "status_callback": instrument.status_callback})
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        
+        # also for a failed run, the execution graph only if the workflow finished
+        timeline.report_run(event_log, graph=run)
     
     end_time = time.time()
     
-    print(f"Time taken: {end_time - start_time} seconds, or {(end_time - start_time) / 60} minutes, or {(end_time - start_time) / 3600} hours")
\ No newline at end of file
+    print(f"Time taken: {end_time - start_time} seconds, or {(end_time - start_time) / 60} minutes, or {(end_time - start_time) / 3600} hours")
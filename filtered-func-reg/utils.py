@@ -14,7 +14,9 @@ def registration_node_func(nonlinear: bool, in_file: str, affine_file: str, mni_
     """
     import os
     import time
-    import shutil
+    from common.instrument import measure
+    from common.locking import single_flight
+    from common.staging import staged, write_back
      
      # Ex: zfstat1.nii.gz
     in_file_name = os.path.basename(in_file)    
@@ -29,48 +31,65 @@ def registration_node_func(nonlinear: bool, in_file: str, affine_file: str, mni_
     
     print(f"{node_name}_NODE: {in_file} -> {out_feat_path}")
     
-    # check if the output file already exists
-    if os.path.exists(out_feat_path) and not force_run:
+    # check if the output file already exists, only one process registers this
+    # file, the others wait and reuse its output
+    # timing event of the registration, a cache hit if its output already exists
+    with measure(node_name.lower(), in_file=in_file) as event, single_flight(out_feat_path, force=force_run) as should_compute:
+        event["cache"] = "miss" if should_compute else "hit"
+        
+        if not should_compute:
             print(f"{node_name}_NODE: {in_file} -> {out_name} already exists. Skipping.")
             return out_feat_path, nonlinear
-    
-    def get_interface():
-        if nonlinear:
-            from nipype.interfaces.fsl import FNIRT
-            # Run FNIRT    
+        
+        # registered by an earlier node, still being written back from the staging directory
+        if staged(out_feat_path) != out_feat_path:
+            print(f"{node_name}_NODE: {in_file} -> {out_name} already staged for write back. Skipping.")
+            event["cache"] = "hit"
+            return out_feat_path, nonlinear
+        
+        # local copies of the inputs if they were staged (--stage), else the inputs themselves
+        in_file_local = staged(in_file)
+        affine_file_local = staged(affine_file)
+    
+        def get_interface():
+            if nonlinear:
+                from nipype.interfaces.fsl import FNIRT
+                # Run FNIRT    
 
-            if no_affine:
-                return FNIRT(ref_file=mni_template, in_file=in_file, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")
+                if no_affine:
+                    return FNIRT(ref_file=mni_template, in_file=in_file_local, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")
+                else:
+                    return FNIRT(ref_file=mni_template, in_file=in_file_local, affine_file=affine_file_local, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")    
             else:
-                return FNIRT(ref_file=mni_template, in_file=in_file, affine_file=affine_file, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")    
-        else:
-            from nipype.interfaces.fsl import FLIRT
+                from nipype.interfaces.fsl import FLIRT
 
-            if not "brain" in mni_template:
-                raise ValueError("MNI template must be a brain template for FLIRT.")                
+                if not "brain" in mni_template:
+                    raise ValueError("MNI template must be a brain template for FLIRT.")                
 
-            return FLIRT(in_file=in_file, out_file=out_name, reference=mni_template, apply_xfm=True, in_matrix_file=affine_file, save_log=True, out_log="flirt-log.txt", padding_size=0, interp="trilinear", output_type='NIFTI_GZ')
+                return FLIRT(in_file=in_file_local, out_file=out_name, reference=mni_template, apply_xfm=True, in_matrix_file=affine_file_local, save_log=True, out_log="flirt-log.txt", padding_size=0, interp="trilinear", output_type='NIFTI_GZ')
     
-    interface = get_interface()
+        interface = get_interface()
     
-    start_time = time.time()
+        start_time = time.time()
     
-    result = interface.run()    
+        result = interface.run()    
     
-    stdout = result.runtime.stdout
+        stdout = result.runtime.stdout
     
-    print(f"{node_name}_NODE: {in_file} -> {out_feat_path} stdout: {stdout}")
+        print(f"{node_name}_NODE: {in_file} -> {out_feat_path} stdout: {stdout}")
     
-    end_time = time.time()                
+        end_time = time.time()                
     
-    print(f"{node_name}_NODE: {in_file} -> {out_feat_path} took {end_time - start_time} seconds, {(end_time - start_time) / 60} minutes.")
+        print(f"{node_name}_NODE: {in_file} -> {out_feat_path} took {end_time - start_time} seconds, {(end_time - start_time) / 60} minutes.")
     
-    out_path = os.path.join(os.getcwd(), out_name)
+        out_path = os.path.join(os.getcwd(), out_name)
     
-    # copy the fnirt file to the location where the input file is (FEAT directory)
-    dest = shutil.copy(out_path, out_feat_path)
+        # copy the fnirt file to the location where the input file is (FEAT directory),
+        # through a temporary file so readers never see a partial copy (in the background with --stage)
+        dest = write_back(out_path, out_feat_path)
+    
+        print(f"{node_name}_NODE: Copied {out_path} to {dest}")
     
-    print(f"{node_name}_NODE: Copied {out_path} to {dest}")
     
     return out_feat_path, nonlinear            
       
@@ -146,6 +165,9 @@ def roi_extract_all_timeseries_node_func(input_nifti_path: str, mask_file_path:
     Extracts all the ROIs from the input nifti file, must be 4D
     """
     from nilearn.image import load_img
+    from common.instrument import measure
+    from common.nifti_io import load_nifti
+    from common.staging import staged
     import numpy as np
     import logging     
     import regex as re       
@@ -163,8 +185,9 @@ def roi_extract_all_timeseries_node_func(input_nifti_path: str, mask_file_path:
     run = int(run_match.group(1)) if run_match else None
     session = session_match.group(1) if session_match else None
     
-    # Load the nifti file
-    data = load_img(input_nifti_path).get_fdata()
+    # Load the nifti file (shared NIfTI reader, local decompressed cache if NIFTI_CACHE_DIR is set)
+    with measure("timeseries_extract_read", subject_id=subject_id, session=session, run=run, input_nifti_path=input_nifti_path):
+        data = load_nifti(staged(input_nifti_path)).get_fdata()
     
     if (len(data.shape) != 4):
         raise ValueError("roi_extract_all_timeseries_node_func: Input nifti file must be 4D")
@@ -200,6 +223,85 @@ def roi_extract_all_timeseries_node_func(input_nifti_path: str, mask_file_path:
     return roi_dicts
 
 
+def roi_store_timeseries_node_func(input_nifti_path: str, store_dir: str, mask_file_path: str):
+    """
+    Writes the timeseries of all the ROIs of the input nifti file (4D) to the array store,
+    in chunks of timepoints (instead of one dict per voxel and timepoint). Returns its key in the store.
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import regex as re
+    from common.array_store import ArrayStore
+    from common.instrument import measure
+    
+    # Extract the subject, run, and session from the input nifti path
+    subj_match = re.search(r"sub-([^_/]+)", input_nifti_path)
+    run_match = re.search(r"run-([\d]+)", input_nifti_path)
+    session_match = re.search(r"ses-([^_/]+)", input_nifti_path)
+    
+    subject_id = subj_match.group(1) if subj_match else None
+    run = int(run_match.group(1)) if run_match else None
+    session = session_match.group(1) if session_match else None
+    
+    # Ex: sub-NDARINV00CY2MDM_ses-baselineYear1Arm1_run-01
+    key = f"sub-{subject_id}_ses-{session}_run-{run:02}"
+    
+    with measure("timeseries_store", subject_id=subject_id, session=session, run=run) as event:
+        store = ArrayStore(store_dir, atlas_file=mask_file_path)
+        written = store.write(key, input_nifti_path, subject_id=subject_id, session=session, run=run)
+        event["cache"] = "miss" if written else "hit"
+    
+    print(f"ROI_STORE: {input_nifti_path} -> {key}{'' if written else ' already stored. Skipping.'}")
+    
+    return key
+
+
+def stream_register_func(unit: dict) -> dict:
+    """
+    Streaming mode (--stream) producer: registers the filtered_func of unit (registration_node_func) in a
+    scratch directory of its own. Returns the file to extract: the local registration output if it
+    was registered now (no read back from the FEAT directory), else the existing registered file.
+    
+    unit: filtered_func, affine_file, mni_template, force_run, no_affine, scratch_dir (+ the extraction's keys)
+    """
+    import os
+    import tempfile
+    
+    os.makedirs(unit["scratch_dir"], exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="register-", dir=unit["scratch_dir"])
+    
+    # FLIRT writes its output to the working directory
+    os.chdir(work_dir)
+    out_feat_path, _ = registration_node_func(False, unit["filtered_func"], unit["affine_file"], unit["mni_template"], unit["force_run"], unit["no_affine"])
+    
+    local_path = os.path.join(work_dir, os.path.basename(out_feat_path))
+    
+    return {
+        "in_file": local_path if os.path.exists(local_path) else out_feat_path,
+        "work_dir": work_dir,
+    }
+
+def stream_extract_func(unit: dict, registered: dict):
+    """
+    Streaming mode (--stream) consumer: the timeseries rows of the registered filtered_func
+    (roi_extract_all_timeseries_node_func). Removes the producer's scratch directory.
+    
+    unit: mask_file_path, subject_id, run, session
+    """
+    import shutil
+    import pandas as pd
+    from common.instrument import measure
+    
+    with measure("stream_extract", subject_id=unit["subject_id"], session=unit["session"], run=unit["run"]):
+        timeseries = pd.DataFrame(roi_extract_all_timeseries_node_func(registered["in_file"], unit["mask_file_path"]))
+    
+    # the local copy's path has no subject, session and run
+    for key in ["subject_id", "run", "session"]:
+        timeseries[key] = unit[key]
+    
+    shutil.rmtree(registered["work_dir"], ignore_errors=True)
+    
+    return timeseries
+
 def join_main(joined_dicts: list):  
     """
     Joins and flattens the dictionaries
@@ -229,6 +331,20 @@ def make_csv_node_func(flattened: list):
     
     return save_path    
 
+def merge_csv_node_func(csv_path: str, aggregate_path: str, units: list):
+    """
+    Merges the timeseries csv of this run into the aggregate timeseries csv (incremental mode),
+    the rows of the runs computed in this run replace or extend it. Returns the aggregate path.
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    import pandas as pd
+    from common.incremental import TIMESERIES_UNIT_COLUMNS, merge_rows
+    
+    os.makedirs(os.path.dirname(aggregate_path), exist_ok=True)
+    
+    return merge_rows(aggregate_path, pd.read_csv(csv_path), pd.DataFrame(units), TIMESERIES_UNIT_COLUMNS)
+
 if __name__ == "__main__":
     import constants
     # test registration node function
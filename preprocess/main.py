@@ -1,366 +1,731 @@
-import time
+"""
+FEAT preprocessing pipeline.
+
+BET runs once per subject-session, custom timing files, design.fsf and FEAT (LN
+and NL) once per subject-session-task-run. FEAT runs already recorded in the
+completion ledger are skipped.
+
+Usage:
+    python main.py [--plan] [-y] [--name NAME | --resume] [--derive-nonlinear] [--offset-timing-files]
+                   [--batch-timing-files] [--slim POLICY] [--stage] [--n-procs N]
+
+nipype, pandas and the node modules are only imported once the workflow is built.
+--plan prints what a run would do (units, expected outputs, what is already
+completed) without building the workflow or writing anything.
+"""
+import argparse
 import os
-from os.path import join as opj
-import json
 import re
-from nipype.interfaces.spm import Level1Design, EstimateModel, EstimateContrast
-from nipype.algorithms.modelgen import SpecifySPMModel
-from nipype.interfaces.utility import Function, IdentityInterface
-import nipype.interfaces.fsl as fsl
-from nipype.interfaces.io import SelectFiles, DataSink
-from nipype import Workflow, Node, MapNode
-from nipype.pipeline.engine import JoinNode
-import util
-
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
-
-# list of subject identifiers
-# subject_id_list = ['NDARINV00BD7VDC', 'NDARINV00CY2MDM', 'NDARINV00HEV6HB', 'NDARINV00LH735Y', 'NDARINV00R4TXET']
-print("FEAT preprocessing pipeline")
+import sys
+import time
+from os.path import join as opj
 
 PREPROCESS_DIR = os.path.dirname(os.path.realpath(__file__))
 
 PIPELINE_BASE_DIR = os.path.dirname(PREPROCESS_DIR)
 
-print("pipeline base dir:", PIPELINE_BASE_DIR)
+# shared modules (common/), also needed by the Function nodes in the worker processes
+sys.path.append(PIPELINE_BASE_DIR)
+
+from common.ledger import Ledger, design_hash
 
-# base_design_fsf = input("Please enter the full path to the desired base design.fsf file:")
-# base_design_fsf = "/mnt/storage/SST/sub-NDARINVZT44Y065/ses-baselineYear1Arm1/func/test_based_off_ritesh.feat/design.fsf"
+import slim
 
 # base design fsf that is modified for each subject
 base_design_fsf = opj(PREPROCESS_DIR, "base_design_ritesh.fsf")
-    
+
 # base_subjects_dir = input("Please enter the base directory containing all of the subjects:")
-BASE_SUBJECTS_DIR = "/mnt/storage/SST/" 
-
-# subject_directory_names = [name for name in os.listdir(base_subjects_dir) if name.startswith("sub-")]
-# extract 'sub-' prefix from 'sub-{subj_id}'
-# subject_id_list = [re.sub(r'^sub-', '', dir_name) for dir_name in subject_directory_names]
-# Only for test subjects right now
-
-# The subject ids that are used within the preprocessing pipeline
-subject_id_list = []
-
-original_fifty_subjects_path = opj(PIPELINE_BASE_DIR, "subjects", "subject_same_mri.txt")
-
-with open(original_fifty_subjects_path, "r") as file:
-    subject_id_list = [name.strip() for name in file.readlines()]
-    print(f"loaded {len(subject_id_list)} subjects from {original_fifty_subjects_path}")
-
-anx_test_subjects_path = opj(PIPELINE_BASE_DIR, "subjects", "pilot_anx_subjects.txt")
-
-with open(anx_test_subjects_path, "r") as file:
-    anx_subject_ids = [name.strip() for name in file.readlines()]        
-    print(f"loaded {len(anx_subject_ids)} subjects from {anx_test_subjects_path}")
-    
-    # only append unique subjects
-    for subj_id in anx_subject_ids:
-        if subj_id not in subject_id_list:
-            subject_id_list.append(subj_id)
-
-all_subjects_path = opj(PIPELINE_BASE_DIR, "subjects", "all_subj_ids.txt")
-
-# add 150 more random subjects not in previous 2 groups
-n_added = 0
-with open(all_subjects_path, "r") as file:
-    all_subject_ids = [name.strip() for name in file.readlines()]
-    print(f"loaded {len(all_subject_ids)} subjects from {all_subjects_path}")
-    
-    # only append unique subjects
-    for subj_id in all_subject_ids:
-        if subj_id not in subject_id_list:
-            subject_id_list.append(subj_id)
-            n_added += 1
-            if n_added >= 150:
-                break
-
-subject_id_list = subject_id_list[:1]
-
-print("subject id list", subject_id_list)
-print("total number of unique subjects:", len(subject_id_list))
-# print(subject_id_list)
-
-# subject_id_list = ['NDARINV00BD7VDC', 'NDARINV00CY2MDM']
-# print(subject_id_list)
-
-# TR of functional images
-# task_json_path = '/mnt/Storage/temp1/sub-NDARINV00BD7VDC/ses-baselineYear1Arm1/func/sub-NDARINV00BD7VDC_ses-baselineYear1Arm1_task-sst_run-01_bold.json'
-# with open(task_json_path, 'rt') as fp:#     task_info = json.load(fp)
-# TR = task_info['RepetitionTime']
+BASE_SUBJECTS_DIR = "/mnt/storage/SST/"
+
+# templates for deriving the nonlinear FEAT runs (--derive-nonlinear), same as FEAT uses
+MNI_TEMPLATE_SKULL = "/usr/local/fsl/data/standard/MNI152_T1_2mm.nii.gz"
+MNI_BRAIN_MASK = "/usr/local/fsl/data/standard/MNI152_T1_2mm_brain_mask_dil.nii.gz"
+
+# output directory path
+datasink_dir_base = "/mnt/storage/daniel/feat-preprocess-datasink"
+
+working_dir = opj(PREPROCESS_DIR, "workingdir")
+
+# completed FEAT runs, kept across crashes and restarts (--ignore-ledger reruns everything)
+ledger_path = opj(working_dir, "ledger.sqlite")
+
+# events table cache of --batch-timing-files (timing_files.DEFAULT_CACHE_PATH)
+events_cache_path = opj(working_dir, "events_cache.parquet")
 
 # TODO: remove hardcoding
 TR = 0.8
-print("TR:", TR)
 
-# Smoothing widths used during preprocessing
-# fwhm_list = [5]
 run_list = [1, 2]
-print("run list", run_list)
 task_list = ["sst"]
-print("task list", task_list)
 # session_list = ["baselineYear1Arm1", "2YearFollowUpYArm1", "4YearFollowUpYArm1"]
 session_list = ["baselineYear1Arm1"]
-print("session list", session_list)
 
-experiment_dir = BASE_SUBJECTS_DIR
-# datasink_dir = opj(PREPROCESS_DIR, "datasink")
 
-# output directory path
-datasink_dir_base = "/mnt/storage/daniel/feat-preprocess-datasink"
+def load_subject_ids() -> list:
+    """
+    Returns the subject ids used within the preprocessing pipeline: the original
+    fifty subjects, the pilot anxiety subjects and 150 more subjects not in those.
+    """
+    original_fifty_subjects_path = opj(PIPELINE_BASE_DIR, "subjects", "subject_same_mri.txt")
 
-if "--name" in os.sys.argv:
-    name = os.sys.argv[os.sys.argv.index("--name") + 1]
-    datasink_dir = f"{datasink_dir_base}/{name}"
-else:
-    date_string = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
-    datasink_dir = f"{datasink_dir_base}/{date_string}" 
-# datasink_dir = f"/mnt/storage/daniel/feat-preprocess-datasink/{date_string}"
+    with open(original_fifty_subjects_path, "r") as file:
+        subject_id_list = [name.strip() for name in file.readlines()]
+        print(f"loaded {len(subject_id_list)} subjects from {original_fifty_subjects_path}")
 
+    anx_test_subjects_path = opj(PIPELINE_BASE_DIR, "subjects", "pilot_anx_subjects.txt")
 
-# make sure datasink directory exists
-if not os.path.exists(datasink_dir):
-    os.makedirs(datasink_dir)
+    with open(anx_test_subjects_path, "r") as file:
+        anx_subject_ids = [name.strip() for name in file.readlines()]
+        print(f"loaded {len(anx_subject_ids)} subjects from {anx_test_subjects_path}")
 
-print("datasink dir:", datasink_dir)
+        # only append unique subjects
+        for subj_id in anx_subject_ids:
+            if subj_id not in subject_id_list:
+                subject_id_list.append(subj_id)
 
-working_dir = opj(PREPROCESS_DIR,  "workingdir")
+    all_subjects_path = opj(PIPELINE_BASE_DIR, "subjects", "all_subj_ids.txt")
+
+    # add 150 more random subjects not in previous 2 groups
+    n_added = 0
+    with open(all_subjects_path, "r") as file:
+        all_subject_ids = [name.strip() for name in file.readlines()]
+        print(f"loaded {len(all_subject_ids)} subjects from {all_subjects_path}")
+
+        # only append unique subjects
+        for subj_id in all_subject_ids:
+            if subj_id not in subject_id_list:
+                subject_id_list.append(subj_id)
+                n_added += 1
+                if n_added >= 150:
+                    break
+
+    subject_id_list = subject_id_list[:1]
+
+    return subject_id_list
+
+
+def get_datasink_dir(args, feat_ledger) -> str:
+    """
+    Returns the output directory: --name, the directory of the last run (--resume)
+    or a new timestamped directory.
+    """
+    if args.name is not None:
+        return f"{datasink_dir_base}/{args.name}"
+
+    if args.resume and feat_ledger is not None and feat_ledger.last_output_dir("feat") is not None:
+        # continue writing into the datasink directory of the last (crashed) run
+        datasink_dir = feat_ledger.last_output_dir("feat")
+        print("INFO: Resuming in", datasink_dir)
+        return datasink_dir
+
+    date_string = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+    return f"{datasink_dir_base}/{date_string}"
+
+
+def preprocess_base_design(datasink_dir: str) -> str:
+    """
+    Returns the base design.fsf contents with the subject paths under
+    BASE_SUBJECTS_DIR and a placeholder output directory in datasink_dir.
+    """
+    with open(base_design_fsf, "r") as file:
+        content = file.read()
+
+    # make sure all subject paths have the correct prefix path (base_subjects_dir)
+    content = re.sub(f'"(.+?)sub', '"' + os.path.join(BASE_SUBJECTS_DIR, "sub"), content)
 
-# preprocess base design.fsf file
-with open(base_design_fsf, "r") as file:
-    content = file.read()
-    
-    # make sure all subject paths have the correct prefix path (base_subjects_dir)    
-    content = re.sub(f'"(.+?)sub', '"' + os.path.join(BASE_SUBJECTS_DIR, "sub"), content)   
-    
     # set placeholder FEAT output directory path
-    placeholder_feat_dir_path = os.path.join(datasink_dir, f'sub-PLACEHOLDER_ses-PLACEHOLDER_task-sst_run-00LN')                
-    
+    placeholder_feat_dir_path = os.path.join(datasink_dir, f'sub-PLACEHOLDER_ses-PLACEHOLDER_task-sst_run-00LN')
+
     # set output directory to be in the working directory plus placeholder: subject id + session + task name + run number
     content = re.sub(r"set fmri\(outputdir\) \"(.+?)\"", # match everything between 'set fmri(outputdir) "' and '"'
-                          f"set fmri(outputdir) \"{placeholder_feat_dir_path}\"", # replace with new output path
-                          content)
+                     f"set fmri(outputdir) \"{placeholder_feat_dir_path}\"", # replace with new output path
+                     content)
+
+    return content
+
+
+def get_design_hashes(content: str, args) -> dict:
+    """
+    Returns the ledger design hashes of the LN and NL FEAT runs.
+    """
+    # everything in the design except the output directory (differs between runs) changes the FEAT outputs
+    design_content = re.sub(r"set fmri\(outputdir\) \"(.+?)\"", "", content)
+
+    return {"LN": design_hash(design_content, "LN", args.offset_timing_files),
+            "NL": design_hash(design_content, "NL", args.offset_timing_files, "derived" if args.derive_nonlinear else "feat")}
+
+
+def feat_dir_name(subject_id: str, session: str, task: str, run: int, is_nonlinear: bool) -> str:
+    """
+    Ex: sub-NDARINV003RTV85_ses-baselineYear1Arm1_task-sst_run-01LN.feat (FEAT appends .feat to the design's outputdir)
+    """
+    return f"sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}{'NL' if is_nonlinear else 'LN'}.feat"
+
+
+def get_remaining_units(subject_id_list: list, completed_units: dict, derive_nonlinear: bool):
+    """
+    Prunes the completed FEAT runs, so nipype never walks or rehashes them.
+
+    completed_units: {unit key: FEAT directory} of the ledger
+
+    Returns (remaining units, number of FEAT runs, number of completed FEAT runs),
+    remaining units: (subject_id, session) -> [(task, run, is_nonlinear list, existing LN FEAT directory)],
+    the existing LN FEAT directory ("" if none) is set when only its derived NL run is missing
+    """
+    remaining_units = {}
+    n_units = 0
+    n_completed = 0
+    for subject_id in subject_id_list:
+        for session in session_list:
+            for task in task_list:
+                for run in run_list:
+                    variants = [variant for variant in ["LN", "NL"] if (subject_id, session, task, run, variant) not in completed_units]
+                    n_units += 2
+                    n_completed += 2 - len(variants)
+
+                    if not variants:
+                        continue
+
+                    # the NL run is derived from the LN FEAT run: a completed LN run is not rerun (FEAT would
+                    # write a second "+.feat" directory), only its NL run is derived again
+                    is_nonlinear_list = [False] if derive_nonlinear else [variant == "NL" for variant in variants]
+                    existing_feat_dir = completed_units.get((subject_id, session, task, run, "LN"), "") if derive_nonlinear and variants == ["NL"] else ""
+                    remaining_units.setdefault((subject_id, session), []).append((task, run, is_nonlinear_list, existing_feat_dir or ""))
+
+    return remaining_units, n_units, n_completed
+
+
+def get_staging_inputs(remaining_units: dict) -> list:
+    """
+    Returns the input files of the remaining units in task order (the T1w of each subject-session,
+    then its BOLD runs), for --stage.
+    """
+    paths = []
+    for (subject_id, session), units in remaining_units.items():
+        subject_dir = opj(BASE_SUBJECTS_DIR, f"sub-{subject_id}", f"ses-{session}")
+        paths.append(opj(subject_dir, "anat", f"sub-{subject_id}_ses-{session}_run-01_T1w.nii"))
+
+        for task, run, _, existing_feat_dir in units:
+            # FEAT is not rerun for a completed LN run
+            if existing_feat_dir:
+                continue
+            bold_prefix = opj(subject_dir, "func", f"sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}_bold")
+            paths.extend([f"{bold_prefix}{ext}" for ext in [".nii.gz", ".nii"] if os.path.exists(f"{bold_prefix}{ext}")][:1])
+
+    return paths
+
+
+def print_plan(args, subject_id_list: list, datasink_dir: str, remaining_units: dict, n_units: int, n_completed: int):
+    """
+    Prints what a run would do, without building the workflow or writing anything.
+    """
+    n_feat_runs = sum([len(is_nonlinear_list) for units in remaining_units.values() for _, _, is_nonlinear_list, existing_feat_dir in units if not existing_feat_dir])
+    n_derived = sum([len(units) for units in remaining_units.values()]) if args.derive_nonlinear else 0
+
+    print()
+    print("PLAN")
+    print("--------------------")
+    print(f"subjects: {len(subject_id_list)}, sessions: {session_list}, tasks: {task_list}, runs: {run_list}")
+    print(f"FEAT runs (LN + NL): {n_units} total, {n_completed} completed (ledger), {n_units - n_completed} to do")
+    print(f"units to run: {len(remaining_units)} BET, {sum([len(units) for units in remaining_units.values()])} timing files + design.fsf, {n_feat_runs} FEAT, {n_derived} derived NL")
+    print(f"slimming: {args.slim if args.slim else 'no'}, n_procs ceiling: {args.n_procs}")
+    if args.stage:
+        from common.staging import DEFAULT_STAGING_DIR, staging_dir
+        print(f"staging: T1w and BOLD inputs of {len(remaining_units)} subject-sessions to {staging_dir() or DEFAULT_STAGING_DIR}")
+    print()
+    print(f"datasink dir: {datasink_dir}{'' if os.path.exists(datasink_dir) else ' (new)'}")
+
+    expected_feat_dirs = [feat_dir_name(subject_id, session, task, run, is_nonlinear)
+                          for (subject_id, session), units in remaining_units.items()
+                          for task, run, is_nonlinear_list, existing_feat_dir in units
+                          for is_nonlinear in (is_nonlinear_list if not args.derive_nonlinear else [True] if existing_feat_dir else [False, True])]
+    print(f"expected FEAT directories ({len(expected_feat_dirs)}): {expected_feat_dirs[:4]}{' ...' if len(expected_feat_dirs) > 4 else ''}")
+    print()
+    print(f"ledger: {ledger_path}{'' if os.path.exists(ledger_path) else ' (none yet)'}")
+    print(f"events cache: {events_cache_path}{'' if os.path.exists(events_cache_path) else ' (none yet)'}")
+    print(f"nipype cache: {opj(working_dir, 'preproc_FEAT_workflow')}{'' if os.path.exists(opj(working_dir, 'preproc_FEAT_workflow')) else ' (none yet)'}")
 
-new_base_design_fsf = os.path.join(os.getcwd(), working_dir, "base_design.fsf")
-with open(new_base_design_fsf, "w+") as file:
-    file.write(content)
-
-print("new design.fsf file:", new_base_design_fsf)
 
 # create a new design.fsf file for each subject, task, run, and session
 def create_design_fsf(subject_id: str, task: str, session: str, run: int, base_design_fsf: str, is_nonlinear: bool, datasink_dir: bool):
     import os # dynamic imports required because nipype Function's execute in their own context
     import re
-    
+
     with open(base_design_fsf, "r") as file:
-        file_content = file.read()  
-    
+        file_content = file.read()
+
     subj_regex = r"sub-([^_/]+)" # match 'sub-' and any non-delimter characters ('_' or '/')
     run_regex = r"run-([\d]+)"    # 'run-' and any digits
     task_regex = r"task-([^_]+)" # 'task-' and any non-delimter characters ('_' or '/')
     session_regex = r"ses-([^_/]+)" # 'ses-' and any non-delimter characters ('_' or '/')
-    
+
     # replace 'sub-' with actual subject id
-    file_content = re.sub(subj_regex, f"sub-{subject_id}", file_content)            
-    
+    file_content = re.sub(subj_regex, f"sub-{subject_id}", file_content)
+
     # replace 'run-' with actual run number
-    file_content = re.sub(run_regex, f"run-{run:02d}", file_content)  
-        
+    file_content = re.sub(run_regex, f"run-{run:02d}", file_content)
+
     # replace 'task-' with actual task name
-    file_content = re.sub(task_regex, f"task-{task}", file_content)    
-    
+    file_content = re.sub(task_regex, f"task-{task}", file_content)
+
     # replace 'ses-' with actual session name
-    file_content = re.sub(session_regex, f"ses-{session}", file_content)          
-    
+    file_content = re.sub(session_regex, f"ses-{session}", file_content)
+
     highres_file_regex = r"set highres_files(.*)\"(.*)\""
-    
+
     # there is only run-01 for T1w images, so we need to replace run-02 with run-01
     current_brain_path = re.search(highres_file_regex, file_content).group(2)
-    
+
     if "run-02" in current_brain_path:
-        file_content = re.sub(highres_file_regex, f"set highres_files(1) \"{current_brain_path.replace('run-02', 'run-01')}\"", file_content)            
-        
-    if is_nonlinear:        
+        file_content = re.sub(highres_file_regex, f"set highres_files(1) \"{current_brain_path.replace('run-02', 'run-01')}\"", file_content)
+
+    # read the BOLD from its local copy if it was staged (--stage)
+    from common.staging import staged
+    bold_prefix = re.search(r"set feat_files\(1\) \"(.*)\"", file_content).group(1)
+    for ext in [".nii.gz", ".nii"]:
+        local_bold = staged(f"{bold_prefix}{ext}")
+        if local_bold != f"{bold_prefix}{ext}":
+            file_content = file_content.replace(f"set feat_files(1) \"{bold_prefix}\"", f"set feat_files(1) \"{local_bold[:-len(ext)]}\"")
+            break
+
+    if is_nonlinear:
         # set fmri(regstandard_nonlinear_yn) 0     <- set to 1
         nonlinear_regex = r"set fmri\(regstandard_nonlinear_yn\) (\d+)"
-        file_content = re.sub(nonlinear_regex, "set fmri(regstandard_nonlinear_yn) 1", file_content)                
-        
+        file_content = re.sub(nonlinear_regex, "set fmri(regstandard_nonlinear_yn) 1", file_content)
+
         # change output directory to include _NL
         new_output_feat_dir_path = os.path.join(datasink_dir, f'sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}NL')
-        file_content = re.sub(r"set fmri\(outputdir\) \"(.+?)\"", # match everything between 'set fmri(outputdir) "' and '"'        
+        file_content = re.sub(r"set fmri\(outputdir\) \"(.+?)\"", # match everything between 'set fmri(outputdir) "' and '"'
                               f"set fmri(outputdir) \"{new_output_feat_dir_path}\"", # replace with new output path
                               file_content)
-        
+
     # create design FSF file for use by feat_node (NL = nonlinear if is_nonlinear is True)
-    new_design_fsf = f"sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}_design{'_NL' if is_nonlinear else ''}.fsf"            
-    
+    new_design_fsf = f"sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}_design{'_NL' if is_nonlinear else ''}.fsf"
+
     with open(new_design_fsf, "w") as file:
         file.write(file_content)
-        
+
     return os.path.join(os.getcwd(), new_design_fsf)
 
 def create_BET_paths(base_subjects_dir: str, subject_id: str, session: str, run: int):
     # dynamic imports because nipype executes functions in separate context
-    from os.path import join as opj        
-    
+    from os.path import join as opj
+
     paths_dict = {
         "in_file": opj(base_subjects_dir, f"sub-{subject_id}", f"ses-{session}", "anat", f"sub-{subject_id}_ses-{session}_run-{run:02d}_T1w.nii"),
         "out_file": opj(base_subjects_dir, f"sub-{subject_id}", f"ses-{session}", "anat", f"sub-{subject_id}_ses-{session}_run-{run:02d}_T1w_brain.nii")
     }
     return paths_dict["in_file"], paths_dict["out_file"]
 
-# # test create_design_fsf function    
-# print()
-# print("Testing create_design_fsf function...")
-# print("with: subject_id=NDARINV00BD7VDC, task=sst, session=baselineYear1Arm1, run=1, base_design_fsf=", base_design_fsf)
-# print(create_design_fsf("NDARINV00BD7VDC", "sst", "baselineYear1Arm1", 1, base_design_fsf))
-# print()
-
-infosource = Node(IdentityInterface(fields=['subject_id', 'task', 'run', 'session']),
-                  name="infosource")
-infosource.iterables = [("subject_id", subject_id_list),
-                        ('task', task_list),
-                        ('run', run_list),
-                        ('session', session_list)]
-
-create_BET_paths_node = Node(Function(input_names=["base_subjects_dir", "subject_id", "session", "run"], output_names=["in_file", "out_file"], function=create_BET_paths), name="create_BET_paths_node")
-create_BET_paths_node.inputs.base_subjects_dir = BASE_SUBJECTS_DIR
-create_BET_paths_node.inputs.run = 1 # only run-01 for T1w images
-
-# bet_node = Node(fsl.BET(frac=0.5, vertical_gradient=0), name="bet_node")
-
 def wrapped_bet_node_func(in_file, out_file):
     import nipype.interfaces.fsl as fsl
     import os
-    
+    from common.instrument import measure
+    from common.locking import single_flight
+    from common.staging import staged
+
     # # TODO: make more permanent fix
     # # replace run number with 01 in in_file
     # in_file = in_file.replace("run-02", "run-01")
-    
+
     if not os.path.exists(in_file):
         print(f"File {in_file} does not exist")
         raise FileNotFoundError(f"File {in_file} does not exist")
-    
-    if os.path.exists(out_file):
-        print(f"File {out_file} already exists")
-        return "success"
-    
-    bet = fsl.BET(frac=0.5, vertical_gradient=0)
-    bet.inputs.in_file = in_file
-    bet.inputs.out_file = out_file
-    
-    bet.run()    
-    
+
+    # only one process runs BET for this T1w, the others wait and reuse its output
+    with measure("bet", in_file=in_file) as event, single_flight(out_file) as should_compute:
+        event["cache"] = "miss" if should_compute else "hit"
+        if not should_compute:
+            print(f"File {out_file} already exists")
+            return "success"
+
+        bet = fsl.BET(frac=0.5, vertical_gradient=0)
+        bet.inputs.in_file = staged(in_file)
+        bet.inputs.out_file = out_file
+
+        bet.run()
+
     return "success"
 
-wrapped_bet_node = Node(Function(input_names=["in_file", "out_file"], output_names="out", function=wrapped_bet_node_func), name="wrapped_bet_node")
+def wrapped_feat_node_func(fsf_file: str, datasink_dir: str, subject_id: str, session: str, task: str, run: int, is_nonlinear: bool, existing_feat_dir: str = ""):
+    """
+    Runs FEAT on the design, returns its FEAT directory in the datasink. FEAT appends .feat to the
+    design's outputdir, so the directory is built from the unit (nipype's FEAT interface looks for it
+    in the node directory and fails).
 
-# bet <anat> <output> -f <fractional intensity threshold> -g <vertical gradient>
+    existing_feat_dir: completed LN FEAT directory (--derive-nonlinear with only the NL run missing),
+    FEAT is not rerun and it is returned as is
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    import subprocess
 
-if "--offset-timing-files" in os.sys.argv:
-    custom_timing_files_node = Node(Function(input_names=["base_subjects_path", "subject_id", "session", "run"], output_names="out_files", function=util.create_custom_timing_files_sst_offset), name="custom_timing_files_node")
-    custom_timing_files_node.inputs.base_subjects_path = BASE_SUBJECTS_DIR
-    print("INFO: Using offset timing files")
-else: 
-    custom_timing_files_node = Node(Function(input_names=["base_subjects_path", "subject_id", "session", "run"], output_names="out_files", function=util.create_custom_timing_files_sst), name="custom_timing_files_node")
-    custom_timing_files_node.inputs.base_subjects_path = BASE_SUBJECTS_DIR
+    if existing_feat_dir:
+        print(f"FEAT_NODE: {existing_feat_dir} is completed, only its NL run is derived")
+        return existing_feat_dir
 
-def wait_node_func(subject_id, task, run, session, custom_timing_files_node_out, bet_node_out):
-    return subject_id, task, run, session
+    # same as feat_dir_name (a Function node only sees its own source)
+    feat_dir = os.path.join(datasink_dir, f"sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}{'NL' if is_nonlinear else 'LN'}.feat")
 
-# wait_node = Node(IdentityInterface(fields=["subject_id", "task", "session", "run", "custom_timing_files_node_out", "bet_node_out"]), name="wait_node")
-wait_node = Node(Function(input_names=["subject_id", "task", "run", "session", "custom_timing_files_node_out", "bet_node_out"], output_names=["subject_id", "task", "run", "session"], function=wait_node_func), name="wait_node")
+    subprocess.run(["feat", fsf_file], check=True, env={**os.environ, "FSLOUTPUTTYPE": "NIFTI_GZ"})
 
-nonlinear_iter_node = Node(IdentityInterface(fields=["is_nonlinear"]), name="nonlinear_iter_node")
-nonlinear_iter_node.iterables = [("is_nonlinear", [False, True])]
+    if not os.path.isdir(feat_dir):
+        raise RuntimeError(f"FEAT did not write {feat_dir}")
 
-create_design_fsf_node = Node(Function(input_names=["subject_id", "task", "run", "session", "base_design_fsf", "is_nonlinear", "datasink_dir"], output_names="out_design_fsf", function=create_design_fsf, name="test"), name="create_design_fsf_node")
-# these inputs are here because function doesn't see global context
-create_design_fsf_node.inputs.base_design_fsf = new_base_design_fsf
-create_design_fsf_node.inputs.datasink_dir = datasink_dir
-    
-feat_node = Node(fsl.FEAT(), name="feat_node")
+    return feat_dir
 
-preproc = Workflow("preproc_FEAT_workflow", working_dir)
+def wait_node_func(subject_id, task, run, session, custom_timing_files_node_out, bet_node_out):
+    return subject_id, task, run, session
 
-datasink = Node(DataSink(base_directory=datasink_dir), name="sinker")
 
-join_node = JoinNode(Function(input_names=["in_files"], output_names="out_files", function=lambda in_files: in_files), name="join_node", joinsource="infosource")
+def build_workflow(args, datasink_dir: str, remaining_units: dict, design_hashes: dict, new_base_design_fsf: str):
+    """
+    Builds the preprocessing workflow for the remaining units.
+    """
+    import nipype.interfaces.fsl as fsl
+    from nipype import Workflow, Node
+    from nipype.interfaces.utility import Function, IdentityInterface
+    from nipype.pipeline.engine import JoinNode
+
+    import util
+    from common import scheduler
+
+    fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+
+    # anatomical work (BET) fans out per subject-session, functional work (timing
+    # files, design.fsf, FEAT) fans out per task-run below it
+    subject_source = Node(IdentityInterface(fields=['subject_id', 'session']),
+                          name="subject_source")
+    subject_source.iterables = [("subject_id", [subject_id for subject_id, _ in remaining_units]),
+                                ('session', [session for _, session in remaining_units])]
+    subject_source.synchronize = True
+
+    # the task-runs of each subject-session that still have FEAT runs to do
+    run_source = Node(IdentityInterface(fields=['subject_id', 'session', 'task', 'run', 'unit_key']),
+                      name="run_source")
+    run_source.itersource = ("subject_source", ["subject_id", "session"])
+    run_source.iterables = [('task', {key: [task for task, _, _, _ in units] for key, units in remaining_units.items()}),
+                            ('run', {key: [run for _, run, _, _ in units] for key, units in remaining_units.items()}),
+                            ('unit_key', {key: [f"{key[0]}_{key[1]}_{task}_{run}" for task, run, _, _ in units] for key, units in remaining_units.items()})]
+    run_source.synchronize = True
+
+    create_BET_paths_node = Node(Function(input_names=["base_subjects_dir", "subject_id", "session", "run"], output_names=["in_file", "out_file"], function=create_BET_paths), name="create_BET_paths_node", **scheduler.node_resources("light"))
+    create_BET_paths_node.inputs.base_subjects_dir = BASE_SUBJECTS_DIR
+    create_BET_paths_node.inputs.run = 1 # only run-01 for T1w images
+
+    # bet <anat> <output> -f <fractional intensity threshold> -g <vertical gradient>
+    wrapped_bet_node = Node(Function(input_names=["in_file", "out_file"], output_names="out", function=wrapped_bet_node_func), name="wrapped_bet_node", **scheduler.node_resources("bet"))
+
+    if args.offset_timing_files:
+        custom_timing_files_node = Node(Function(input_names=["base_subjects_path", "subject_id", "session", "run"], output_names="out_files", function=util.create_custom_timing_files_sst_offset), name="custom_timing_files_node", **scheduler.node_resources("io"))
+        print("INFO: Using offset timing files")
+    else:
+        custom_timing_files_node = Node(Function(input_names=["base_subjects_path", "subject_id", "session", "run"], output_names="out_files", function=util.create_custom_timing_files_sst), name="custom_timing_files_node", **scheduler.node_resources("io"))
+    custom_timing_files_node.inputs.base_subjects_path = BASE_SUBJECTS_DIR
 
-# note, datasink is manually set as output_dir in OG base_design_fsf file, so no
-# need to connect feat_node to datasink for now
-preproc.connect([(infosource, create_BET_paths_node, [('subject_id', 'subject_id'),
-                                            # ('run', 'run'), # only run-01 for T1w images
-                                            ('session', 'session')]),                 
-                 (infosource, custom_timing_files_node, [('subject_id', 'subject_id'),
-                                                        ('session', 'session'),
-                                                        ('run', 'run')]),
-                 (infosource, wait_node, [('subject_id', 'subject_id'),                                                        
+    wait_node = Node(Function(input_names=["subject_id", "task", "run", "session", "custom_timing_files_node_out", "bet_node_out"], output_names=["subject_id", "task", "run", "session"], function=wait_node_func), name="wait_node", **scheduler.node_resources("light"))
+
+    # LN and/or NL, whichever is not completed yet for this subject-session-task-run
+    # (with the completed LN FEAT directory if only its derived NL run is missing)
+    nonlinear_iter_node = Node(IdentityInterface(fields=["is_nonlinear", "existing_feat_dir", "unit_key"]), name="nonlinear_iter_node")
+    nonlinear_iter_node.itersource = ("run_source", "unit_key")
+    nonlinear_iter_node.iterables = [("is_nonlinear", {f"{key[0]}_{key[1]}_{task}_{run}": is_nonlinear_list
+                                                       for key, units in remaining_units.items() for task, run, is_nonlinear_list, _ in units}),
+                                     ("existing_feat_dir", {f"{key[0]}_{key[1]}_{task}_{run}": [existing_feat_dir] * len(is_nonlinear_list)
+                                                            for key, units in remaining_units.items() for task, run, is_nonlinear_list, existing_feat_dir in units})]
+    nonlinear_iter_node.synchronize = True
+
+    if args.derive_nonlinear:
+        print("INFO: Deriving nonlinear FEAT runs from the linear FEAT runs")
+
+    create_design_fsf_node = Node(Function(input_names=["subject_id", "task", "run", "session", "base_design_fsf", "is_nonlinear", "datasink_dir"], output_names="out_design_fsf", function=create_design_fsf, name="test"), name="create_design_fsf_node", **scheduler.node_resources("light"))
+    # these inputs are here because function doesn't see global context
+    create_design_fsf_node.inputs.base_design_fsf = new_base_design_fsf
+    create_design_fsf_node.inputs.datasink_dir = datasink_dir
+
+    # FEAT, its output is the FEAT directory built from the unit (nipype's FEAT interface cannot find it)
+    feat_node = Node(Function(input_names=["fsf_file", "datasink_dir", "subject_id", "session", "task", "run", "is_nonlinear", "existing_feat_dir"], output_names="feat_dir", function=wrapped_feat_node_func), name="feat_node", **scheduler.node_resources("feat"))
+    feat_node.inputs.datasink_dir = datasink_dir
+
+    # run FEAT once (LN) and derive the NL run from its outputs, instead of a second full FEAT
+    derive_nonlinear_node = Node(Function(input_names=["feat_dir", "highres_head", "standard_head", "standard_mask"], output_names="nl_feat_dir", function=util.derive_nonlinear_feat), name="derive_nonlinear_node", **scheduler.node_resources("fnirt"))
+    derive_nonlinear_node.inputs.standard_head = MNI_TEMPLATE_SKULL
+    derive_nonlinear_node.inputs.standard_mask = MNI_BRAIN_MASK
+
+    # verify the FEAT outputs and record the run in the ledger
+    record_feat_node = Node(Function(input_names=["feat_dir", "ledger_path", "subject_id", "session", "task", "run", "is_nonlinear", "design_hashes"], output_names="feat_dir", function=util.record_feat_completion), name="record_feat_node", **scheduler.node_resources("light"))
+    record_feat_node.inputs.ledger_path = ledger_path
+    record_feat_node.inputs.design_hashes = design_hashes
+
+    record_nonlinear_node = Node(Function(input_names=["feat_dir", "ledger_path", "subject_id", "session", "task", "run", "is_nonlinear", "design_hashes"], output_names="feat_dir", function=util.record_feat_completion), name="record_nonlinear_node", **scheduler.node_resources("light"))
+    record_nonlinear_node.inputs.ledger_path = ledger_path
+    record_nonlinear_node.inputs.design_hashes = design_hashes
+    record_nonlinear_node.inputs.is_nonlinear = True
+
+    # drop (or archive) the FEAT intermediates later stages do not read, ex: --slim analysis
+    slim_feat_node = Node(Function(input_names=["feat_dir", "policy", "archive_dir", "float32", "wait"], output_names="feat_dir", function=util.slim_feat_dir_node_func), name="slim_feat_node", **scheduler.node_resources("io"))
+    slim_nonlinear_node = Node(Function(input_names=["feat_dir", "policy", "archive_dir", "float32", "wait"], output_names="feat_dir", function=util.slim_feat_dir_node_func), name="slim_nonlinear_node", **scheduler.node_resources("io"))
+
+    for node in [slim_feat_node, slim_nonlinear_node]:
+        node.inputs.policy = args.slim
+        node.inputs.archive_dir = args.slim_archive
+        node.inputs.float32 = args.slim_float32
+
+    if args.slim is not None:
+        print(f"INFO: Slimming FEAT directories with the {args.slim} retention policy")
+
+    join_node = JoinNode(Function(input_names=["in_files"], output_names="out_files", function=lambda in_files: in_files), name="join_node", joinsource="subject_source")
+
+    # anatomical sub-workflow, runs exactly once per subject-session
+    anat_inputnode = Node(IdentityInterface(fields=["subject_id", "session"]), name="inputnode")
+    anat_outputnode = Node(IdentityInterface(fields=["bet_out", "t1w"]), name="outputnode")
+
+    anat_workflow = Workflow("anat_workflow")
+    anat_workflow.connect([(anat_inputnode, create_BET_paths_node, [('subject_id', 'subject_id'),
+                                                                    # ('run', 'run'), # only run-01 for T1w images
+                                                                    ('session', 'session')]),
+                           (create_BET_paths_node, wrapped_bet_node, [('in_file', 'in_file'),
+                                                                      ('out_file', 'out_file')]),
+                           (create_BET_paths_node, anat_outputnode, [('in_file', 't1w')]),
+                           (wrapped_bet_node, anat_outputnode, [('out', 'bet_out')]),
+                           ])
+
+    # functional sub-workflow, runs once per subject-session-task-run (and LN/NL),
+    # waits on the anatomical sub-workflow of its subject-session
+    func_inputnode = Node(IdentityInterface(fields=["subject_id", "session", "task", "run", "unit_key", "bet_out", "t1w"]), name="inputnode")
+
+    func_workflow = Workflow("func_workflow")
+
+    # note, datasink is manually set as output_dir in OG base_design_fsf file, so no
+    # need to connect feat_node to datasink for now
+    func_workflow.connect([(func_inputnode, custom_timing_files_node, [('subject_id', 'subject_id'),
+                                                                       ('session', 'session'),
+                                                                       ('run', 'run')]),
+                           (func_inputnode, wait_node, [('subject_id', 'subject_id'),
                                                         ('run', 'run'),
                                                         ('session', 'session'),
-                                                        ('task', 'task')]),
-                 (create_BET_paths_node, wrapped_bet_node, [('in_file', 'in_file'),
-                                                    ('out_file', 'out_file')]),
-                 (wrapped_bet_node, wait_node, [('out', 'bet_node_out')]),                                  
-                 (custom_timing_files_node, wait_node, [('out_files', 'custom_timing_files_node_out')]),                 
-                 (wait_node, create_design_fsf_node, [('subject_id', 'subject_id'),
-                                                        ('session', 'session'),
-                                                        ('run', 'run'),
-                                                        ('task', 'task')]),        
-                 (nonlinear_iter_node, create_design_fsf_node, [('is_nonlinear', 'is_nonlinear')]),         
-                 (create_design_fsf_node, feat_node, [('out_design_fsf', 'fsf_file')]),
-                #  (feat_node, join_node, [('feat_dir', 'in_files')]),
-                #  (feat_node, datasink, [('feat_dir', 'preproc')]),
-                #  (feat_node, datasink, [('feat_dir', 'preproc.')]
-                 ])
+                                                        ('task', 'task'),
+                                                        ('bet_out', 'bet_node_out')]),
+                           (custom_timing_files_node, wait_node, [('out_files', 'custom_timing_files_node_out')]),
+                           (wait_node, create_design_fsf_node, [('subject_id', 'subject_id'),
+                                                                ('session', 'session'),
+                                                                ('run', 'run'),
+                                                                ('task', 'task')]),
+                           (func_inputnode, nonlinear_iter_node, [('unit_key', 'unit_key')]),
+                           (nonlinear_iter_node, create_design_fsf_node, [('is_nonlinear', 'is_nonlinear')]),
+                           (create_design_fsf_node, feat_node, [('out_design_fsf', 'fsf_file')]),
+                           (wait_node, feat_node, [('subject_id', 'subject_id'),
+                                                   ('session', 'session'),
+                                                   ('run', 'run'),
+                                                   ('task', 'task')]),
+                           (nonlinear_iter_node, feat_node, [('is_nonlinear', 'is_nonlinear'),
+                                                             ('existing_feat_dir', 'existing_feat_dir')]),
+                           (wait_node, record_feat_node, [('subject_id', 'subject_id'),
+                                                          ('session', 'session'),
+                                                          ('run', 'run'),
+                                                          ('task', 'task')]),
+                           (nonlinear_iter_node, record_feat_node, [('is_nonlinear', 'is_nonlinear')]),
+                           (feat_node, record_feat_node, [('feat_dir', 'feat_dir')]),
+                           ])
+
+    if args.derive_nonlinear:
+        func_workflow.connect([(feat_node, derive_nonlinear_node, [('feat_dir', 'feat_dir')]),
+                               (func_inputnode, derive_nonlinear_node, [('t1w', 'highres_head')]),
+                               (wait_node, record_nonlinear_node, [('subject_id', 'subject_id'),
+                                                                   ('session', 'session'),
+                                                                   ('run', 'run'),
+                                                                   ('task', 'task')]),
+                               (derive_nonlinear_node, record_nonlinear_node, [('nl_feat_dir', 'feat_dir')]),
+                               ])
+
+    if args.slim is not None:
+        # slim only after the run was recorded as complete, the LN run also after its NL run was derived
+        func_workflow.connect([(record_feat_node, slim_feat_node, [('feat_dir', 'feat_dir')])])
+
+        if args.derive_nonlinear:
+            func_workflow.connect([(record_nonlinear_node, slim_nonlinear_node, [('feat_dir', 'feat_dir')]),
+                                   (slim_nonlinear_node, slim_feat_node, [('feat_dir', 'wait')]),
+                                   ])
+
+    preproc = Workflow("preproc_FEAT_workflow", working_dir)
+
+    preproc.connect([(subject_source, anat_workflow, [('subject_id', 'inputnode.subject_id'),
+                                                      ('session', 'inputnode.session')]),
+                     (subject_source, run_source, [('subject_id', 'subject_id'),
+                                                   ('session', 'session')]),
+                     (run_source, func_workflow, [('subject_id', 'inputnode.subject_id'),
+                                                  ('session', 'inputnode.session'),
+                                                  ('task', 'inputnode.task'),
+                                                  ('run', 'inputnode.run'),
+                                                  ('unit_key', 'inputnode.unit_key')]),
+                     (anat_workflow, func_workflow, [('outputnode.bet_out', 'inputnode.bet_out'),
+                                                     ('outputnode.t1w', 'inputnode.t1w')]),
+                     ])
+
+    # set crash directory
+    preproc.config["execution"]["crashdump_dir"] = opj(preproc.config["execution"]["crashdump_dir"], working_dir, "crash")
+
+    return preproc
+
+
+parser = argparse.ArgumentParser(description="FEAT preprocessing pipeline")
+parser.add_argument("--plan", action="store_true", help="Only print what would be run and what is already completed, without writing anything")
+parser.add_argument("-y", "--yes", action="store_true", help="Run the workflow without asking for confirmation")
+parser.add_argument("--name", type=str, default=None, help="Name of the datasink directory (default: timestamp)")
+parser.add_argument("--resume", action="store_true", help="Write into the datasink directory of the last run")
+parser.add_argument("--ignore-ledger", action="store_true", help="Rerun FEAT runs the ledger has as completed")
+parser.add_argument("--derive-nonlinear", action="store_true", help="Run FEAT once (LN) and derive the NL run from it")
+parser.add_argument("--offset-timing-files", action="store_true", help="Offset all onsets by the first onset")
+parser.add_argument("--batch-timing-files", action="store_true", help="Generate all timing files up front from the cached events table")
+parser.add_argument("--slim", type=str, default=None, choices=list(slim.RETENTION_POLICIES), help="Slim finished FEAT directories with this retention policy")
+parser.add_argument("--slim-float32", action="store_true", help="Rewrite kept volumes as float32 when slimming")
+parser.add_argument("--slim-archive", type=str, default=None, help="Archive dropped FEAT files here instead of deleting them")
+parser.add_argument("--n-procs", type=int, default=60, help="Maximum number of processes (the scheduler lowers it under load)")
+parser.add_argument("--stage", action="store_true", help="Copy the T1w and BOLD inputs to local scratch (STAGING_DIR) ahead of the nodes")
+parser.add_argument("--graph", action="store_true", help="Write the workflow graph")
+parser.add_argument("--exec-graph", action="store_true", help="Write the execution graph")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    print("FEAT preprocessing pipeline")
+    print("pipeline base dir:", PIPELINE_BASE_DIR)
+
+    subject_id_list = load_subject_ids()
+
+    print("subject id list", subject_id_list)
+    print("total number of unique subjects:", len(subject_id_list))
+    print("TR:", TR)
+    print("run list", run_list)
+    print("task list", task_list)
+    print("session list", session_list)
+
+    # --plan only reads the ledger, and only if it exists
+    if args.plan:
+        feat_ledger = Ledger(ledger_path, read_only=True) if os.path.exists(ledger_path) else None
+    else:
+        feat_ledger = Ledger(ledger_path)
+
+    datasink_dir = get_datasink_dir(args, feat_ledger)
+
+    content = preprocess_base_design(datasink_dir)
+    design_hashes = get_design_hashes(content, args)
+
+    # only the FEAT runs of this datasink that still exist: later stages read one datasink
+    completed_units = {}
+    if not args.ignore_ledger and feat_ledger is not None:
+        n_elsewhere = 0
+        for variant in ["LN", "NL"]:
+            completed_units.update({key: feat_dir for key, feat_dir in feat_ledger.completed("feat", design_hashes[variant], output_dir=datasink_dir, check_exists=True).items()
+                                    if key[4] == variant})
+            n_elsewhere += len([key for key in feat_ledger.completed("feat", design_hashes[variant]) if key[4] == variant])
+        n_elsewhere -= len(completed_units)
+        if n_elsewhere > 0:
+            print(f"INFO: {n_elsewhere} FEAT runs completed in other (or removed) datasink directories are run again in {datasink_dir}, --resume or --name to continue one")
+
+    remaining_units, n_units, n_completed = get_remaining_units(subject_id_list, completed_units, args.derive_nonlinear)
+
+    print(f"ledger: {n_completed} of {n_units} FEAT runs already completed ({ledger_path})")
+
+    if args.plan:
+        print_plan(args, subject_id_list, datasink_dir, remaining_units, n_units, n_completed)
+        return
+
+    if not remaining_units:
+        print("All FEAT runs are completed, nothing to do")
+        return
+
+    # make sure datasink directory exists
+    if not os.path.exists(datasink_dir):
+        os.makedirs(datasink_dir)
+
+    print("datasink dir:", datasink_dir)
+
+    new_base_design_fsf = opj(working_dir, "base_design.fsf")
+    with open(new_base_design_fsf, "w+") as file:
+        file.write(content)
+
+    print("new design.fsf file:", new_base_design_fsf)
+
+    preproc = build_workflow(args, datasink_dir, remaining_units, design_hashes, new_base_design_fsf)
+
+    if args.exec_graph:
+        preproc.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")
+    if args.graph:
+        preproc.write_graph(graph2use="colored", format="png")
+
+    # if '-y' argument is passed, run the workflow without asking for confirmation
+    if args.yes:
+        s = "yes"
+    else:
+        s = input("Would you like to run the workflow? (Y/n)")
+
+    if not (s.lower() == "yes" or s.lower() == "y"):
+        print("Exiting...")
+        exit(0)
+
+    # timing and memory events of the nodes, summary: python -m common.instrument <event log>,
+    # timeline: <event log>.html and .trace.json (common/timeline.py)
+    # (imported here, timeline imports numpy and pandas)
+    from common import instrument, timeline
+
+    event_log = instrument.start_run(opj(working_dir, "event_logs"), "preprocess")
+
+    # Record the start time
+    start_time = time.time()
 
-# set crash directory
-preproc.config["execution"]["crashdump_dir"] = opj(preproc.config["execution"]["crashdump_dir"], working_dir, "crash")
+    feat_ledger.record_run("feat", datasink_dir, sys.argv)
 
-if "--exec-graph" in os.sys.argv:
-    preproc.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")
-preproc.write_graph(graph2use="colored", format="png")
+    # generate all timing files up front from the cached events table, the
+    # custom_timing_files_node's then find their outputs and return immediately
+    if args.batch_timing_files:
+        import timing_files
+        timing_files.generate_timing_files(BASE_SUBJECTS_DIR, subject_id_list, session_list, run_list, offset=args.offset_timing_files, cache_path=events_cache_path)
 
+    from common import scheduler
 
-# if '-y' argument is passed, run the workflow without asking for confirmation
-if "-y" in os.sys.argv:
-    s = "yes"
-else:
-    s = input("Would you like to run the workflow? (Y/n)")
+    # CPU(s):                  64
+    #   On-line CPU(s) list:   0-63
+    # Vendor ID:               AuthenticAMD
+    #   Model name:            AMD Ryzen Threadripper PRO 5975WX 32-Cores
+    #     CPU family:          25
+    #     Model:               8
+    #     Thread(s) per core:  2
+    #     Core(s) per socket:  32
+    #     Socket(s):           1
+    # n_procs is only the ceiling, the scheduler lowers it when the machine is loaded or memory runs low
+    plugin_args = {"n_procs": args.n_procs, "utilization_report": opj(datasink_dir, "utilization_report.json"),
+                   "status_callback": instrument.status_callback}
 
-if not (s.lower() == "yes" or s.lower() == "y"):
-    print("Exiting...")
-    exit(0)
+    prefetcher = None
+    if args.stage:
+        from common.staging import Prefetcher
 
-# Record the start time
-start_time = time.time()
+        prefetcher = Prefetcher()
+        prefetcher.start(get_staging_inputs(remaining_units))
 
-# CPU(s):                  64
-#   On-line CPU(s) list:   0-63
-# Vendor ID:               AuthenticAMD
-#   Model name:            AMD Ryzen Threadripper PRO 5975WX 32-Cores
-#     CPU family:          25
-#     Model:               8
-#     Thread(s) per core:  2
-#     Core(s) per socket:  32
-#     Socket(s):           1
-run = preproc.run(plugin="MultiProc", plugin_args={"n_procs": 60})
+    run = None
+    try:
+        run = preproc.run(plugin=scheduler.AdaptiveMultiProcPlugin(plugin_args=plugin_args))
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
 
-## testing
-# run = preproc.run(plugin="MultiProc", plugin_args={"n_procs": 1})
+        # also for a failed run, the execution graph only if the workflow finished
+        timeline.report_run(event_log, graph=run)
 
-# Record the end time
-end_time = time.time()
+    ## testing
+    # run = preproc.run(plugin="MultiProc", plugin_args={"n_procs": 1})
 
-# Calculate the total execution time
-execution_time = end_time - start_time
+    # Record the end time
+    end_time = time.time()
 
-print(f"The workflow took {execution_time} seconds to complete.")
+    # Calculate the total execution time
+    execution_time = end_time - start_time
 
-# dg = nio.DataGrabber()
+    print(f"The workflow took {execution_time} seconds to complete.")
 
-# df = nio.DataFinder()
-# df.inputs.root_paths = '.'
-# df.inputs.match_regex = r'.+/(?P<series_dir>.+(qT1|ep2d_fid_T1).+)/(?P<basename>.+)\.nii.gz'
-# result = df.run() 
-# result.outputs.out_paths  
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Post-FEAT slimming of .feat directories.
+
+A finished FEAT directory holds large intermediates (stats/res4d, pe's, mc/ and
+reg/ images, tsplot/, ...) that no later stage reads. slim_feat_dir() applies a
+retention policy: kept files stay, everything else is deleted or archived (one
+uncompressed tar per FEAT directory). Kept volumes can be rewritten as float32
+with a faster gzip level. The datasink manifest is updated afterwards.
+
+Every policy keeps the files the completion ledger checks (report.html,
+reg/example_func2standard.mat/_warp, stats/zfstat*), so slimmed runs stay complete.
+
+Usage:
+    python slim.py --datasink_dir /mnt/storage/daniel/feat-preprocess-datasink/<name> --policy analysis [--float32] [--archive_dir DIR] [--dry_run]
+"""
+import argparse
+import fnmatch
+import gzip
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as opj
+
+PREPROCESS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# shared modules (common/)
+sys.path.append(os.path.dirname(PREPROCESS_DIR))
+
+# written into every slimmed FEAT directory
+SLIM_RECORD_NAME = ".slim.json"
+
+# needed by the completion ledger (util.record_feat_completion) and for provenance
+ALWAYS_KEEP = [
+    SLIM_RECORD_NAME,
+    "design.fsf",
+    "report*.html",
+    "reg/example_func2standard.mat",
+    "reg/example_func2standard_warp.nii.gz",
+    "stats/zfstat*",
+]
+
+# policy -> patterns (relative to the FEAT directory) of the files to keep
+RETENTION_POLICIES = {
+    "full": ["*"],
+    # everything roi, randomise and filtered-func-reg read, plus the first-level stats and QC files
+    "analysis": ALWAYS_KEEP + [
+        "filtered_func_data.nii.gz",
+        "mask.nii.gz",
+        "mean_func.nii.gz",
+        "example_func.nii.gz",
+        "design.*",
+        "custom_timing_files/*",
+        "reg/*.mat",
+        "stats/zstat*",
+        "stats/cope*",
+        "stats/varcope*",
+        "mc/*.par",
+        "mc/*.rms",
+        "logs/*",
+    ],
+    # first-level stats only, drops filtered_func_data (filtered-func-reg can not run on these)
+    "stats": ALWAYS_KEEP + [
+        "mask.nii.gz",
+        "mean_func.nii.gz",
+        "design.*",
+        "custom_timing_files/*",
+        "reg/*.mat",
+        "stats/zstat*",
+        "stats/cope*",
+        "stats/varcope*",
+        "mc/*.par",
+        "logs/*",
+    ],
+    # what roi and randomise read
+    "minimal": ALWAYS_KEEP + [
+        "reg/*.mat",
+    ],
+}
+
+FLOAT32_COMPRESSLEVEL = 1 # gzip level of volumes rewritten as float32
+
+
+def plan_slim(feat_dir: str, policy: str = "analysis"):
+    """
+    Returns the (keep, drop) lists of paths (relative to feat_dir) for a policy.
+    """
+    if policy not in RETENTION_POLICIES:
+        raise ValueError(f"Unknown retention policy {policy}, expected one of {list(RETENTION_POLICIES)}")
+
+    patterns = RETENTION_POLICIES[policy]
+
+    keep = []
+    drop = []
+    for root, dirs, files in os.walk(feat_dir):
+        for file_name in files:
+            path = os.path.relpath(opj(root, file_name), feat_dir)
+            if any([fnmatch.fnmatchcase(path, pattern) for pattern in patterns]):
+                keep.append(path)
+            else:
+                drop.append(path)
+
+    return sorted(keep), sorted(drop)
+
+
+def _is_fast_gzip(path: str) -> bool:
+    # XFL byte of the gzip header, 4: written with the fastest level (1, FLOAT32_COMPRESSLEVEL)
+    with open(path, "rb") as file:
+        header = file.read(9)
+
+    return len(header) == 9 and header[8] == 4
+
+
+def convert_volume(path: str, float32: bool = True, compresslevel: int = None) -> bool:
+    """
+    Rewrites a .nii.gz volume as float32 and/or with another gzip level, in place
+    (atomically). Volumes are written with FLOAT32_COMPRESSLEVEL unless compresslevel
+    is given. With float32, volumes that already are float32 (FEAT writes float32) are
+    recompressed, unless they already are at FLOAT32_COMPRESSLEVEL. Returns False if
+    nothing had to be done.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    img = nib.load(path)
+
+    to_float32 = float32 and img.get_data_dtype() != np.float32
+    recompress = compresslevel is not None or (float32 and not _is_fast_gzip(path))
+    if not to_float32 and not recompress:
+        return False
+
+    header = img.header.copy()
+    if to_float32:
+        data = np.asarray(img.dataobj, dtype=np.float32)
+        header.set_data_dtype(np.float32)
+    else:
+        data = np.asanyarray(img.dataobj)
+
+    tmp_path = f"{path[:-len('.nii.gz')]}.tmp-{os.getpid()}.nii"
+    nib.save(img.__class__(data, img.affine, header), tmp_path)
+
+    tmp_gz_path = f"{tmp_path}.gz"
+    with open(tmp_path, "rb") as src, gzip.open(tmp_gz_path, "wb", compresslevel=FLOAT32_COMPRESSLEVEL if compresslevel is None else compresslevel) as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+
+    os.remove(tmp_path)
+    os.replace(tmp_gz_path, path)
+
+    return True
+
+
+def _remove_empty_dirs(feat_dir: str):
+    for root, dirs, files in os.walk(feat_dir, topdown=False):
+        if root != feat_dir and not os.listdir(root):
+            os.rmdir(root)
+
+
+def slim_feat_dir(feat_dir: str, policy: str = "analysis", archive_dir: str = None, float32: bool = False,
+                  compresslevel: int = None, dry_run: bool = False) -> dict:
+    """
+    Slims one FEAT directory according to a retention policy.
+
+    archive_dir: dropped files are put in archive_dir/<feat dir name>.tar instead of being deleted
+    float32: rewrite kept volumes as float32 with gzip level FLOAT32_COMPRESSLEVEL (unless compresslevel is given)
+    compresslevel: rewrite all kept volumes with this gzip level
+    dry_run: only print what would be done
+
+    Symlinked files (derived NL runs link into their LN run) are only unlinked or
+    skipped, never archived or converted, their target belongs to the LN run.
+
+    Returns {"kept": n, "dropped": n, "converted": n, "bytes_before": n, "bytes_after": n}
+    """
+    feat_dir = feat_dir.rstrip("/")
+    keep, drop = plan_slim(feat_dir, policy)
+
+    def size(path):
+        full_path = opj(feat_dir, path)
+        return 0 if os.path.islink(full_path) else os.path.getsize(full_path)
+
+    bytes_before = sum([size(path) for path in keep + drop])
+
+    print(f"{'[dry run] ' if dry_run else ''}Slimming {feat_dir} ({policy}): keeping {len(keep)} files, dropping {len(drop)} files ({sum([size(path) for path in drop]) / 1024 ** 2:.1f} MB)")
+
+    if dry_run:
+        return {"kept": len(keep), "dropped": len(drop), "converted": 0, "bytes_before": bytes_before, "bytes_after": bytes_before - sum([size(path) for path in drop])}
+
+    real_drop = [path for path in drop if not os.path.islink(opj(feat_dir, path))]
+
+    if archive_dir is not None and real_drop:
+        os.makedirs(archive_dir, exist_ok=True)
+        archive_path = opj(archive_dir, f"{os.path.basename(feat_dir)}.tar")
+        if os.path.exists(archive_path):
+            archive_path = opj(archive_dir, f"{os.path.basename(feat_dir)}_{time.strftime('%Y-%m-%d_%H-%M-%S')}.tar")
+
+        # the volumes are already gzipped, no compression
+        tmp_path = f"{archive_path}.tmp-{os.getpid()}"
+        with tarfile.open(tmp_path, "w") as tar:
+            for path in real_drop:
+                tar.add(opj(feat_dir, path), arcname=path)
+        os.replace(tmp_path, archive_path)
+
+    for path in drop:
+        os.remove(opj(feat_dir, path))
+
+    _remove_empty_dirs(feat_dir)
+
+    converted = 0
+    if float32 or compresslevel is not None:
+        for path in keep:
+            full_path = opj(feat_dir, path)
+            if path.endswith(".nii.gz") and not os.path.islink(full_path):
+                converted += convert_volume(full_path, float32=float32, compresslevel=compresslevel)
+
+    bytes_after = sum([size(path) for path in keep])
+
+    with open(opj(feat_dir, SLIM_RECORD_NAME), "w") as file:
+        json.dump({"policy": policy, "archive_dir": archive_dir, "float32": float32, "compresslevel": compresslevel,
+                   "dropped": drop, "bytes_before": bytes_before, "bytes_after": bytes_after, "time": time.time()}, file, indent=2)
+
+    print(f"Slimmed {feat_dir}: {bytes_before / 1024 ** 2:.1f} MB -> {bytes_after / 1024 ** 2:.1f} MB ({converted} volumes converted)")
+
+    return {"kept": len(keep), "dropped": len(drop), "converted": converted, "bytes_before": bytes_before, "bytes_after": bytes_after}
+
+
+def slim_datasink(datasink_dir: str, policy: str = "analysis", archive_dir: str = None, float32: bool = False,
+                  compresslevel: int = None, dry_run: bool = False, n_workers: int = 8) -> dict:
+    """
+    Slims every FEAT directory of a datasink in parallel and updates its manifest.
+    LN runs are slimmed after the NL runs derived from them.
+    """
+    from common.manifest import list_feat_dirs, update_manifest
+
+    feat_dirs = list_feat_dirs(datasink_dir)
+
+    def slim(feat_dir):
+        return slim_feat_dir(opj(datasink_dir, feat_dir), policy=policy, archive_dir=archive_dir, float32=float32,
+                             compresslevel=compresslevel, dry_run=dry_run)
+
+    results = []
+    for variant in ["NL", "LN"]:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            results += list(executor.map(slim, [feat_dir for feat_dir in feat_dirs if feat_dir.endswith(f"{variant}.feat")]))
+
+    if not dry_run:
+        update_manifest(datasink_dir, feat_dirs)
+
+    total = {key: sum([result[key] for result in results]) for key in ["kept", "dropped", "converted", "bytes_before", "bytes_after"]}
+
+    print(f"{'[dry run] ' if dry_run else ''}{len(feat_dirs)} FEAT directories: {total['bytes_before'] / 1024 ** 3:.2f} GB -> {total['bytes_after'] / 1024 ** 3:.2f} GB")
+
+    return total
+
+
+parser = argparse.ArgumentParser(description="Drop or archive FEAT intermediates that later stages do not read")
+parser.add_argument("--datasink_dir", type=str, required=True, help="FEAT datasink directory (contains the .feat directories)")
+parser.add_argument("--policy", type=str, default="analysis", choices=list(RETENTION_POLICIES), help="Retention policy")
+parser.add_argument("--archive_dir", type=str, default=None, help="Archive dropped files here instead of deleting them")
+parser.add_argument("--float32", action="store_true", help="Rewrite kept volumes as float32 with a faster gzip level")
+parser.add_argument("--compresslevel", type=int, default=None, help="Rewrite kept volumes with this gzip level")
+parser.add_argument("--dry_run", action="store_true", help="Only print what would be dropped")
+parser.add_argument("--n_workers", type=int, default=8, help="Number of FEAT directories slimmed at once")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    slim_datasink(args.datasink_dir, policy=args.policy, archive_dir=args.archive_dir, float32=args.float32,
+                  compresslevel=args.compresslevel, dry_run=args.dry_run, n_workers=args.n_workers)
+
+    print(f"Took {time.time() - start_time:.1f} seconds")
@@ -0,0 +1,261 @@
+"""
+Cohort-wide generator for the SST custom timing (EV) files.
+
+Instead of one nipype node per subject-run re-reading its own events.tsv, every
+events file is read once (in parallel) into a single columnar events table that
+is cached as Parquet. All EV files are then written from one groupby over
+(subject, session, run, trial_type).
+
+Usage:
+    python timing_files.py --subjects ../subjects/all_subj_ids.txt [--offset] [--overwrite]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as opj
+
+import pandas as pd
+
+PREPROCESS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+BASE_SUBJECTS_DIR = "/mnt/storage/SST/"
+
+DEFAULT_CACHE_PATH = opj(PREPROCESS_DIR, "workingdir", "events_cache.parquet")
+
+# EV file suffix -> trial_type value in events.tsv
+STIMULUS_NAMES = ["corrGo", "incorrGo", "corrStop", "incorrStop"]
+TRIAL_TYPES = ["correct_go", "incorrect_go", "correct_stop", "incorrect_stop"]
+
+# columns kept from events.tsv (FSL 3 column format: onset, duration, weight)
+EVENT_COLUMNS = ["onset", "duration", "trial_type"]
+
+UNIT_KEYS = ["subject_id", "session", "run"]
+
+
+def events_tsv_path(base_subjects_path: str, subject_id: str, session: str, run: int, task: str = "sst") -> str:
+    """
+    Returns the path to the events.tsv file of a subject, session and run.
+    """
+    func_path = opj(base_subjects_path, f"sub-{subject_id}", f"ses-{session}", "func")
+    return opj(func_path, f"sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}_events.tsv")
+
+
+def timing_file_paths(base_subjects_path: str, subject_id: str, session: str, run: int, task: str = "sst") -> list:
+    """
+    Returns the custom timing file paths (same order as STIMULUS_NAMES), named
+    exactly like the ones created by util.create_custom_timing_files_sst.
+    """
+    func_path = opj(base_subjects_path, f"sub-{subject_id}", f"ses-{session}", "func")
+    return [opj(func_path, f"sub-{subject_id}_ses-{session}_task-{task}_run-{run:02d}_{stimulus_name}.tsv") for stimulus_name in STIMULUS_NAMES]
+
+
+def _read_events_tsv(path: str, subject_id: str, session: str, run: int, mtime: float):
+    df = pd.read_csv(path, sep="\t", usecols=EVENT_COLUMNS)
+    df["event_index"] = range(len(df))
+    df["subject_id"] = subject_id
+    df["session"] = session
+    df["run"] = run
+    df["source_mtime"] = mtime
+    return df
+
+
+def _stat_mtime(path: str):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _to_compact_dtypes(events: pd.DataFrame) -> pd.DataFrame:
+    return events.astype({
+        "subject_id": "category",
+        "session": "category",
+        "trial_type": "category",
+        "run": "int8",
+        "event_index": "int16",
+    })
+
+
+def load_events_table(base_subjects_path: str, subject_ids: list, sessions: list, runs: list,
+                      cache_path: str = DEFAULT_CACHE_PATH, n_workers: int = 32, verbose: bool = False) -> pd.DataFrame:
+    """
+    Returns one events table for every (subject, session, run), with columns
+    subject_id, session, run, event_index, onset, duration, trial_type, source_mtime.
+
+    Events files already in the Parquet cache (with an unchanged mtime) are not
+    re-read, everything else is read in parallel and merged back into the cache.
+    Missing events files are skipped.
+    """
+    units = [(subject_id, session, run) for subject_id in subject_ids for session in sessions for run in runs]
+    paths = [events_tsv_path(base_subjects_path, *unit) for unit in units]
+
+    # stat in parallel, this is most of the cost of a warm cache on NFS
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        mtimes = list(executor.map(_stat_mtime, paths))
+
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        cached = pd.read_parquet(cache_path)
+        print(f"Loaded {len(cached)} cached events from {cache_path}")
+
+    cached_mtimes = {}
+    if cached is not None and len(cached) > 0:
+        first_rows = cached.drop_duplicates(UNIT_KEYS)
+        cached_mtimes = dict(zip(zip(first_rows["subject_id"].astype(str), first_rows["session"].astype(str), first_rows["run"].astype(int)),
+                                 first_rows["source_mtime"]))
+
+    to_read = []
+    n_missing = 0
+    for unit, path, mtime in zip(units, paths, mtimes):
+        if mtime is None:
+            n_missing += 1
+            if verbose:
+                print(f"WARN: events file {path} does not exist")
+            continue
+
+        if cached_mtimes.get(unit) != mtime:
+            to_read.append((path, *unit, mtime))
+
+    print(f"{len(units)} subject-session-runs: {len(units) - n_missing - len(to_read)} cached, {len(to_read)} to read, {n_missing} missing events files")
+
+    if to_read:
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            new_events = list(executor.map(lambda args: _read_events_tsv(*args), to_read))
+        print(f"Read {len(to_read)} events files in {time.time() - start_time:.1f} seconds")
+
+        new_events = pd.concat(new_events, ignore_index=True)
+
+        if cached is not None and len(cached) > 0:
+            # drop stale rows of re-read files, then merge
+            stale_keys = pd.MultiIndex.from_tuples([(subject_id, session, run) for _, subject_id, session, run, _ in to_read])
+            cached_keys = pd.MultiIndex.from_arrays([cached["subject_id"].astype(str), cached["session"].astype(str), cached["run"].astype(int)])
+            cached = cached[~cached_keys.isin(stale_keys)]
+            events = pd.concat([cached.astype({"subject_id": str, "session": str, "trial_type": str}), new_events], ignore_index=True)
+        else:
+            events = new_events
+
+        events = _to_compact_dtypes(events)
+
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+            events.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, cache_path)
+            print(f"Saved {len(events)} events to {cache_path}")
+    else:
+        events = cached if cached is not None else _to_compact_dtypes(pd.DataFrame(columns=UNIT_KEYS + ["event_index"] + EVENT_COLUMNS + ["source_mtime"]))
+
+    # only keep the requested units (the cache can hold more subjects)
+    requested = pd.MultiIndex.from_tuples(units)
+    keys = pd.MultiIndex.from_arrays([events["subject_id"].astype(str), events["session"].astype(str), events["run"].astype(int)])
+    return events[keys.isin(requested)]
+
+
+def derive_timing_rows(events: pd.DataFrame, offset: bool = False) -> pd.DataFrame:
+    """
+    Applies the same transformation as util.create_custom_timing_files_sst(_offset)
+    to every run of the events table at once:
+
+    - the first (dummy) row of each run is removed
+    - offset=False: the first remaining onset is set to 0
+    - offset=True: all onsets are offset by the first remaining onset (rounded to 2 decimals)
+    - the trial_type column becomes the weight column (1)
+    """
+    events = events.sort_values(UNIT_KEYS + ["event_index"])
+
+    # remove first row (dummy)
+    events = events[events["event_index"] > 0].copy()
+
+    first_onset = events.groupby(UNIT_KEYS, observed=True, sort=False)["onset"].transform("first")
+
+    if offset:
+        events["onset"] = (events["onset"] - first_onset).round(2)
+    else:
+        # set first onset of each run to 0
+        events.loc[~events.duplicated(UNIT_KEYS), "onset"] = 0
+
+    events = events[events["trial_type"].isin(TRIAL_TYPES)]
+    events["weight"] = 1
+
+    return events
+
+
+def write_timing_files(events: pd.DataFrame, base_subjects_path: str, offset: bool = False,
+                       overwrite: bool = False, n_workers: int = 32) -> int:
+    """
+    Writes every EV file from the derived events with a single groupby over
+    (subject, session, run, trial_type). Runs with no events of a trial type get
+    an empty EV file, like the per-node functions. Runs whose EV files all exist
+    are skipped unless overwrite is True.
+
+    Returns the number of EV files written.
+    """
+    derived = derive_timing_rows(events, offset=offset)
+
+    groups = {key: group for key, group in derived.groupby(UNIT_KEYS + ["trial_type"], observed=True, sort=False)}
+
+    units = events[UNIT_KEYS].drop_duplicates().itertuples(index=False)
+
+    jobs = []
+    for subject_id, session, run in units:
+        output_paths = timing_file_paths(base_subjects_path, str(subject_id), str(session), int(run))
+
+        if not overwrite and all([os.path.exists(path) for path in output_paths]):
+            continue
+
+        for trial_type, output_path in zip(TRIAL_TYPES, output_paths):
+            jobs.append((groups.get((subject_id, session, run, trial_type)), output_path))
+
+    def write(job):
+        group, output_path = job
+        if group is None:
+            # no events of this trial type, FEAT still needs the (empty) file
+            open(output_path, "w").close()
+        else:
+            group[["onset", "duration", "weight"]].to_csv(output_path, sep="\t", index=False, header=False)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(write, jobs))
+
+    print(f"Wrote {len(jobs)} {'offset ' if offset else ''}timing files in {time.time() - start_time:.1f} seconds")
+
+    return len(jobs)
+
+
+def generate_timing_files(base_subjects_path: str, subject_ids: list, sessions: list, runs: list, offset: bool = False,
+                          overwrite: bool = False, cache_path: str = DEFAULT_CACHE_PATH, n_workers: int = 32) -> int:
+    """
+    Loads (or updates) the cached events table and writes the EV files for all
+    given subjects, sessions and runs.
+    """
+    events = load_events_table(base_subjects_path, subject_ids, sessions, runs, cache_path=cache_path, n_workers=n_workers)
+    return write_timing_files(events, base_subjects_path, offset=offset, overwrite=overwrite, n_workers=n_workers)
+
+
+parser = argparse.ArgumentParser(description="Generate SST custom timing files for a whole cohort")
+parser.add_argument("--subjects", type=str, required=True, help="Text file with one subject id per line")
+parser.add_argument("--base_subjects_path", type=str, default=BASE_SUBJECTS_DIR, help="Base directory containing all of the subjects")
+parser.add_argument("--sessions", type=str, nargs="+", default=["baselineYear1Arm1"], help="Sessions to generate timing files for")
+parser.add_argument("--runs", type=int, nargs="+", default=[1, 2], help="Runs to generate timing files for")
+parser.add_argument("--offset", action="store_true", help="Offset all onsets by the first onset (same as --offset-timing-files in main.py)")
+parser.add_argument("--overwrite", action="store_true", help="Rewrite timing files that already exist")
+parser.add_argument("--cache_path", type=str, default=DEFAULT_CACHE_PATH, help="Parquet events cache path")
+parser.add_argument("--n_workers", type=int, default=32, help="Number of threads reading and writing files")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    with open(args.subjects, "r") as file:
+        subject_ids = [name.strip() for name in file.readlines() if name.strip()]
+
+    print(f"loaded {len(subject_ids)} subjects from {args.subjects}")
+
+    start_time = time.time()
+
+    generate_timing_files(args.base_subjects_path, subject_ids, args.sessions, args.runs, offset=args.offset,
+                          overwrite=args.overwrite, cache_path=args.cache_path, n_workers=args.n_workers)
+
+    print(f"Took {time.time() - start_time:.1f} seconds")
@@ -7,6 +7,7 @@ def create_custom_timing_files_sst(base_subjects_path: str, subject_id: str, ses
     from os.path import join as opj
     import pandas as pd
     import os
+    from common.locking import single_flight
     
     subject_string = "sub-" + subject_id
     session_string = "ses-" + session
@@ -20,35 +21,36 @@ def create_custom_timing_files_sst(base_subjects_path: str, subject_id: str, ses
     
     output_paths = [opj(func_path, f"{subject_string}_{session_string}_task-sst_{run_string}_{stimulus_name}.tsv") for stimulus_name in stimulus_names]        
     
-    if all([os.path.exists(path) for path in output_paths]):
-        print(f"Custom timing files for {subject_string} {session_string} {run_string} already exist")
-        return output_paths
+    with single_flight(output_paths) as should_compute:
+        if not should_compute:
+            print(f"Custom timing files for {subject_string} {session_string} {run_string} already exist")
+            return output_paths
+            
+        events_tsv_path = opj(func_path, file_name)    
+            
+        if not os.path.exists(events_tsv_path):
+            print(f"File {events_tsv_path} does not exist")
+            raise FileNotFoundError(f"File {events_tsv_path} does not exist")
         
-    events_tsv_path = opj(func_path, file_name)    
+        events_tsv_df = pd.read_csv(events_tsv_path, sep="\t")
         
-    if not os.path.exists(events_tsv_path):
-        print(f"File {events_tsv_path} does not exist")
-        raise FileNotFoundError(f"File {events_tsv_path} does not exist")
-    
-    events_tsv_df = pd.read_csv(events_tsv_path, sep="\t")
-    
-    # remove first row (dummy)
-    events_tsv_df = events_tsv_df.iloc[1:]
-    
-    print(events_tsv_df.head())
-    
-    # set first onset to 0
-    events_tsv_df.iat[0, 0] = 0            
+        # remove first row (dummy)
+        events_tsv_df = events_tsv_df.iloc[1:]
         
-    for i, (name, trial_type) in enumerate(zip(stimulus_names, trial_types)):        
-        df = events_tsv_df[events_tsv_df["trial_type"] == trial_type]        
+        print(events_tsv_df.head())
         
-        # set all of third column to 1
-        df.loc[:, "trial_type"] = 1        
-        
-        output_path = output_paths[i]
-        
-        df.to_csv(output_path, sep="\t", index=False, header=False)
+        # set first onset to 0
+        events_tsv_df.iat[0, 0] = 0            
+            
+        for i, (name, trial_type) in enumerate(zip(stimulus_names, trial_types)):        
+            df = events_tsv_df[events_tsv_df["trial_type"] == trial_type]        
+            
+            # set all of third column to 1
+            df.loc[:, "trial_type"] = 1        
+            
+            output_path = output_paths[i]
+            
+            df.to_csv(output_path, sep="\t", index=False, header=False)
         
     
     print(f"Created custom timing files (not normalized by first offset) for {subject_string} {session_string} {run_string}")
@@ -60,6 +62,7 @@ def create_custom_timing_files_sst_offset(base_subjects_path: str, subject_id: s
     from os.path import join as opj
     import pandas as pd
     import os
+    from common.locking import single_flight
     
     subject_string = "sub-" + subject_id
     session_string = "ses-" + session
@@ -72,54 +75,219 @@ def create_custom_timing_files_sst_offset(base_subjects_path: str, subject_id: s
     
     output_paths = [opj(func_path, f"{subject_string}_{session_string}_task-sst_{run_string}_{stimulus_name}.tsv") for stimulus_name in stimulus_names]        
     
-    if all([os.path.exists(path) for path in output_paths]):
-        print(f"Custom timing files for {subject_string} {session_string} {run_string} already exist")
-        return output_paths
-        
-    events_tsv_path = opj(func_path, file_name)
+    with single_flight(output_paths) as should_compute:
+        if not should_compute:
+            print(f"Custom timing files for {subject_string} {session_string} {run_string} already exist")
+            return output_paths
+            
+        events_tsv_path = opj(func_path, file_name)
     
         
-    if not os.path.exists(events_tsv_path):
-        print(f"File {events_tsv_path} does not exist")
-        raise FileNotFoundError(f"File {events_tsv_path} does not exist")
+        if not os.path.exists(events_tsv_path):
+            print(f"File {events_tsv_path} does not exist")
+            raise FileNotFoundError(f"File {events_tsv_path} does not exist")
     
-    events_tsv_df = pd.read_csv(events_tsv_path, sep="\t")
+        events_tsv_df = pd.read_csv(events_tsv_path, sep="\t")
     
-    # remove first row (dummy)
-    events_tsv_df = events_tsv_df.iloc[1:]
+        # remove first row (dummy)
+        events_tsv_df = events_tsv_df.iloc[1:]
     
-    # offset set all onsets by first onset time
-    first_onset = events_tsv_df.iloc[0]["onset"]
-    events_tsv_df["onset"] = round(events_tsv_df["onset"] - first_onset, 2)
+        # offset set all onsets by first onset time
+        first_onset = events_tsv_df.iloc[0]["onset"]
+        events_tsv_df["onset"] = round(events_tsv_df["onset"] - first_onset, 2)
     
-    # corrGo at correct_go
-    corrGo = events_tsv_df[events_tsv_df["trial_type"] == "correct_go"]
+        # corrGo at correct_go
+        corrGo = events_tsv_df[events_tsv_df["trial_type"] == "correct_go"]
     
-    # incorrGo at incorrect_go
-    incorrGo = events_tsv_df[events_tsv_df["trial_type"] == "incorrect_go"]
+        # incorrGo at incorrect_go
+        incorrGo = events_tsv_df[events_tsv_df["trial_type"] == "incorrect_go"]
     
-    # corrStop at correct_stop
-    corrStop = events_tsv_df[(events_tsv_df["trial_type"] == "correct_stop")]
+        # corrStop at correct_stop
+        corrStop = events_tsv_df[(events_tsv_df["trial_type"] == "correct_stop")]
     
-    # incorrStop at incorrect_stop
-    incorrStop = events_tsv_df[(events_tsv_df["trial_type"] == "incorrect_stop")]
+        # incorrStop at incorrect_stop
+        incorrStop = events_tsv_df[(events_tsv_df["trial_type"] == "incorrect_stop")]
     
-    # set all of third column to 1
-    corrGo.loc[:, "trial_type"] = 1
-    incorrGo.loc[:, "trial_type"] = 1
-    corrStop.loc[:, "trial_type"] = 1
-    incorrStop.loc[:, "trial_type"] = 1        
+        # set all of third column to 1
+        corrGo.loc[:, "trial_type"] = 1
+        incorrGo.loc[:, "trial_type"] = 1
+        corrStop.loc[:, "trial_type"] = 1
+        incorrStop.loc[:, "trial_type"] = 1        
+    
+        # save all to respective csvs
+        for i, df in enumerate([corrGo, incorrGo, corrStop, incorrStop]):
+            df.to_csv(output_paths[i], sep="\t", index=False, header=False)
     
-    # save all to respective csvs
-    for i, df in enumerate([corrGo, incorrGo, corrStop, incorrStop]):
-        df.to_csv(output_paths[i], sep="\t", index=False, header=False)
     
     print(f"Created custom timing files for {subject_string} {session_string} {run_string}")
     
     return output_paths
 
+def derive_nonlinear_feat(feat_dir: str, highres_head: str, standard_head: str, standard_mask: str, warp_resolution: int = 10):
+    """
+    Creates the nonlinear (NL) FEAT directory from a finished linear (LN) FEAT run,
+    instead of running a complete second FEAT with regstandard_nonlinear_yn = 1.
+    
+    Motion correction, filtering and first-level stats do not depend on the registration,
+    so every file of the LN run except reg/ is symlinked into the NL run. reg/ is copied and
+    only the nonlinear step of FEAT's registration (same commands as FSL's mainfeatreg) is run:
+    FNIRT highres_head -> standard_head initialised with highres2standard.mat, then the
+    example_func -> standard warp. reg/example_func2standard.mat is the same affine in both runs.
+    
+    feat_dir (str): LN FEAT directory, ex: sub-X_ses-Y_task-sst_run-01LN.feat
+    highres_head (str): T1w image with skull (BET input)
+    standard_head (str): MNI template with skull, ex: MNI152_T1_2mm
+    standard_mask (str): MNI brain mask, ex: MNI152_T1_2mm_brain_mask_dil
+    
+    Returns the NL FEAT directory path, ex: sub-X_ses-Y_task-sst_run-01NL.feat
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    import shutil
+    from os.path import join as opj
+    from nipype.interfaces import fsl
+    from common.instrument import measure
+    from common.locking import single_flight
+    
+    if not feat_dir.rstrip("/").endswith("LN.feat"):
+        raise ValueError(f"Expected a linear (LN) FEAT directory, got {feat_dir}")
+    
+    feat_dir = feat_dir.rstrip("/")
+    nl_feat_dir = feat_dir[:-len("LN.feat")] + "NL.feat"
+    reg_dir = opj(nl_feat_dir, "reg")
+    
+    # last file written, marks the NL run as complete
+    example_func2standard_warp = opj(reg_dir, "example_func2standard_warp.nii.gz")
+    
+    with measure("derive_nonlinear_feat", feat_dir=feat_dir) as event, single_flight(example_func2standard_warp) as should_compute:
+        event["cache"] = "miss" if should_compute else "hit"
+        if not should_compute:
+            print(f"Nonlinear FEAT directory {nl_feat_dir} already exists")
+            return nl_feat_dir
+        
+        # mirror the LN run (real directories, symlinked files) so files written into
+        # the NL run later on (ex: registered zfstats) stay in the NL run
+        for root, dirs, files in os.walk(feat_dir):
+            rel_root = os.path.relpath(root, feat_dir)
+            
+            if rel_root == "reg" or rel_root.startswith("reg" + os.sep):
+                continue
+            
+            os.makedirs(opj(nl_feat_dir, rel_root), exist_ok=True)
+            
+            for file_name in files:
+                link_path = os.path.normpath(opj(nl_feat_dir, rel_root, file_name))
+                if not os.path.lexists(link_path):
+                    os.symlink(os.path.relpath(opj(root, file_name), os.path.dirname(link_path)), link_path)
+        
+        if os.path.exists(reg_dir):
+            shutil.rmtree(reg_dir)
+        shutil.copytree(opj(feat_dir, "reg"), reg_dir)
+        
+        reg_highres_head = opj(reg_dir, "highres_head" + (".nii.gz" if highres_head.endswith(".nii.gz") else ".nii"))
+        shutil.copy(highres_head, reg_highres_head)
+        
+        warp_res = (warp_resolution, warp_resolution, warp_resolution)
+        
+        print(f"Running FNIRT for {nl_feat_dir}")
+        
+        fsl.FNIRT(in_file=reg_highres_head, ref_file=standard_head, refmask_file=standard_mask,
+                  affine_file=opj(reg_dir, "highres2standard.mat"), config_file="T1_2_MNI152_2mm", warp_resolution=warp_res,
+                  fieldcoeff_file=opj(reg_dir, "highres2standard_warp.nii.gz"),
+                  warped_file=opj(reg_dir, "highres2standard_head.nii.gz"),
+                  jacobian_file=opj(reg_dir, "highres2highres_jac.nii.gz"),
+                  log_file=opj(reg_dir, "highres2standard.log"),
+                  output_type="NIFTI_GZ").run()
+        
+        fsl.ApplyWarp(in_file=opj(reg_dir, "highres.nii.gz"), ref_file=opj(reg_dir, "standard.nii.gz"),
+                      field_file=opj(reg_dir, "highres2standard_warp.nii.gz"),
+                      out_file=opj(reg_dir, "highres2standard.nii.gz"), output_type="NIFTI_GZ").run()
+        
+        tmp_warp = opj(reg_dir, "example_func2standard_warp_tmp.nii.gz")
+        fsl.ConvertWarp(reference=opj(reg_dir, "standard.nii.gz"), premat=opj(reg_dir, "example_func2highres.mat"),
+                        warp1=opj(reg_dir, "highres2standard_warp.nii.gz"), out_file=tmp_warp, output_type="NIFTI_GZ").run()
+        
+        fsl.ApplyWarp(in_file=opj(reg_dir, "example_func.nii.gz"), ref_file=opj(reg_dir, "standard.nii.gz"),
+                      field_file=tmp_warp, out_file=opj(reg_dir, "example_func2standard.nii.gz"), output_type="NIFTI_GZ").run()
+        
+        os.replace(tmp_warp, example_func2standard_warp)
+    
+    print(f"Created nonlinear FEAT directory {nl_feat_dir} from {feat_dir}")
+    
+    return nl_feat_dir
+
+def record_feat_completion(feat_dir: str, ledger_path: str, subject_id: str, session: str, task: str, run: int, is_nonlinear: bool, design_hashes: dict):
+    """
+    Verifies that a FEAT directory is complete and records the unit
+    (subject_id, session, task, run, LN/NL) in the completion ledger.
+    
+    Complete means: report.html, reg/example_func2standard.mat (and
+    reg/example_func2standard_warp.nii.gz for NL) and stats/zfstat1..N for
+    the N F-tests in the directory's design.fsf.
+    
+    Raises RuntimeError (so nipype reports the node as crashed) if anything is missing.
+    
+    design_hashes (dict): {"LN": hash, "NL": hash}
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    import re
+    from os.path import join as opj
+    from common.ledger import Ledger
+    
+    variant = "NL" if is_nonlinear else "LN"
+    
+    required_paths = [opj(feat_dir, "report.html"),
+                      opj(feat_dir, "reg", "example_func2standard.mat")]
+    
+    if is_nonlinear:
+        required_paths.append(opj(feat_dir, "reg", "example_func2standard_warp.nii.gz"))
+    
+    with open(opj(feat_dir, "design.fsf"), "r") as file:
+        n_ftests = int(re.search(r"set fmri\(nftests_real\) (\d+)", file.read()).group(1))
+    
+    required_paths += [opj(feat_dir, "stats", f"zfstat{i}.nii.gz") for i in range(1, n_ftests + 1)]
+    
+    missing_paths = [path for path in required_paths if not os.path.exists(path)]
+    
+    if missing_paths:
+        raise RuntimeError(f"FEAT directory {feat_dir} is incomplete, missing: {missing_paths}")
+    
+    Ledger(ledger_path).record("feat", (subject_id, session, task, run, variant), design_hashes[variant], feat_dir)
+    
+    print(f"Recorded {variant} FEAT run of sub-{subject_id} ses-{session} task-{task} run-{run:02d} as complete")
+    
+    return feat_dir
+
+def slim_feat_dir_node_func(feat_dir: str, policy: str, archive_dir: str, float32: bool, wait=None):
+    """
+    Slims a finished FEAT directory (see slim.py) and updates the datasink manifest.
+    
+    wait: unused, only orders this node after another one (ex: slim an LN run
+    after the NL run was derived from it)
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    from slim import slim_feat_dir
+    from common.instrument import measure
+    from common.manifest import update_manifest
+    
+    feat_dir = feat_dir.rstrip("/")
+    
+    with measure("slim", feat_dir=feat_dir):
+        slim_feat_dir(feat_dir, policy=policy, archive_dir=archive_dir, float32=float32)
+    
+    update_manifest(os.path.dirname(feat_dir), [os.path.basename(feat_dir)])
+    
+    return feat_dir
+
 if __name__ == "__main__":
     import os
+    import sys
+    
+    # shared modules (common/)
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    
     base_subjects_path = "/mnt/storage/SST"
     test_subject_id = "NDARINV003RTV85"
     test_session = "baselineYear1Arm1"  
@@ -1,12 +1,41 @@
+"""
+Group-level randomise over the registered zfstats of the FEAT datasink.
+
+The merge groups (task, session, run, contrast, FLIRT/FNIRT, ordered subjects)
+come from the datasink manifest (planner.py). The workflow iterates over the
+group names only: each group's files are looked up in the batch plan, registered
+(MapNode), merged into one 4D image (merge.py, subject order in a sidecar) and
+passed to randomise.
+
+--engine native runs the one-sample test in-process instead (common/permutation.py:
+sign flips in batches over the group's masked subjects x voxels matrix, kept in the
+group store workingdir/group_store (common/group_store.py), split across
+--native_procs processes, max-statistic FWE correction of the TFCE (common/tfce.py)
+as randomise -T, or of the t statistic with --no_tfce), its maps are
+written next to the randomise outputs (datasink/native/<registration>). --engine
+both runs the two side by side.
+
+--randomise_chunks N splits each randomise test into N seeded permutation chunk
+nodes (parallel.py), joined by a node merging their null distributions and p-maps,
+so that a few merge groups still keep all --n_procs busy.
+
+Usage:
+    python main.py [--plan] [--graph] [--contrasts 1 2] [--registrations flirt fnirt] [--engine fsl|native|both] [-y]
+
+--plan only prints the merge groups, without importing nipype or writing anything.
+"""
+import argparse
 import os
+import sys
+import time
 from os.path import join as opj
-import re
-from nipype.interfaces.utility import Function, IdentityInterface
-from nipype.interfaces.io import SelectFiles, DataFinder, DataSink
-from nipype.interfaces import fsl
-from nipype import Workflow, Node, MapNode, JoinNode
 
-import util
+RANDOMISE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# shared modules (common/)
+sys.path.append(os.path.dirname(RANDOMISE_DIR))
+
+import planner
 
 # base_feat_dir = '/mnt/Storage/temp1/' # where the input fMRI experiment data is held
 
@@ -19,299 +48,219 @@ base_feat_dir = opj(BASE_PREPROCESS_DIR, "datasink")
 working_dir = opj(BASE_RANDOMISE_DIR, "workingdir") # cache + report + exec graph output
 datasink_dir = opj(BASE_RANDOMISE_DIR, "datasink") # where output is store
 
-feat_dirs = os.listdir(base_feat_dir)
-
-# list of subject identifiers
-# subject_id_list = ['NDARINV00BD7VDC', 'NDARINV00CY2MDM', 'NDARINV00HEV6HB', 'NDARINV00LH735Y', 'NDARINV00R4TXET']
-
-import logging
-logger = logging.getLogger('nipype.workflow')
-
-subjects_ids_regex = re.compile(r'sub-([\w]+)')
-
-subject_id_list = []
-run_list = []
-task_list = []
-session_list = []
-contrast_list = [1, 2, 3, 4, 5, 6]
-# nonlinear_list = [False, True]
-
-unique_subjects = set()
-unique_runs = set()
-unique_tasks = set()
-unique_sessions = set()
-
-print("base feat directory contents: "+ str(feat_dirs))
-
-for feat_dir_name in feat_dirs:    
-    subject_id = util.get_subject_from_feat_dirname(feat_dir_name)            
-    run = util.get_run_from_feat_dirname(feat_dir_name)
-    task = util.get_task_from_feat_dirname(feat_dir_name)
-    session = util.get_session_from_feat_dirname(feat_dir_name)    
-    
-    if subject_id not in unique_subjects:
-        unique_subjects.add(subject_id)
-        subject_id_list.append(subject_id)
-    
-    if run not in unique_runs:
-        unique_runs.add(run)
-        run_list.append(run)
-    
-    if task not in unique_tasks:
-        unique_tasks.add(task)
-        task_list.append(task)
-    
-    if session not in unique_sessions:
-        unique_sessions.add(session)
-        session_list.append(session)
-        
-# FOR TESTING
-# subject_id_list = subject_id_list[:2]
-
-print("SUBJECT ID LIST", subject_id_list)
-print("RUN LIST", run_list)
-print("TASK LIST", task_list)
-print("CONTRAST LIST", contrast_list)
-print("SESSION LIST", session_list)
-
-print("Total iterables: ", len(subject_id_list) * len(run_list) * len(task_list) * len(contrast_list) * len(session_list))
-
-infosource = Node(IdentityInterface(fields=['subject_id', 'task_name', 'run', 'contrast_id']),
-                  name="infosource")
-infosource.iterables = [('subject_id', subject_id_list),
-                        ('task_name', task_list),
-                        ('run', run_list),
-                        ('contrast_id', contrast_list)]
-
-contrast_info_source = Node(IdentityInterface(fields=['contrast_id']), name="contrast_info_source")
-contrast_info_source.iterables = [('contrast_id', contrast_list)]
-
-run_node = Node(IdentityInterface(fields=['run', 'contrast_id']), name="run_node")
-run_node.iterables = [('run', run_list)]
-
-task_node = Node(IdentityInterface(fields=['task_name', 'contrast_id', 'run']), name="task_node")
-task_node.iterables = [('task_name', task_list)]
-
-session_node = Node(IdentityInterface(fields=['session_name', 'task_name', 'contrast_id', 'run']), name="session_node")
-session_node.iterables = [('session_name', session_list)]
-
-subject_node = Node(IdentityInterface(fields=['subject_id', 'task_name', 'contrast_id', 'run', 'session_name']), name="subject_node")
-subject_node.iterables = [('subject_id', subject_id_list)]
-
-# subject_and_task_node = Node(IdentityInterface(fields=['subject_id', 'task_name', 'contrast_id', 'run']), name="subject_and_task_node")
-# subject_and_task_node.iterables = [('subject_id', subject_id_list),
-#                                    ('task_name', task_list)]
-
-templates = {'zfstat': opj(
-                        # 'sub-{subject_id}', 
-                        #  'ses-{session_name}', 
-                        #  'func',
-                         'sub-{subject_id}_ses-{session_name}_task-{task_name}_run-{run:02d}LN.feat',
-                         'stats',
-                         'zfstat{contrast_id}.nii.gz'
-                         ),
-             'xfm': opj(
-                        # 'sub-{subject_id}', 
-                        #  'ses-{session_name}', 
-                        #  'func',
-                         'sub-{subject_id}_ses-{session_name}_task-{task_name}_run-{run:02d}LN.feat',
-                         'reg',
-                         'example_func2standard.mat'
-                         ),
-             'zfstat_nonlinear': opj(
-                        # 'sub-{subject_id}', 
-                        #  'ses-{session_name}', 
-                        #  'func',
-                         'sub-{subject_id}_ses-{session_name}_task-{task_name}_run-{run:02d}NL.feat',
-                         'stats',
-                         'zfstat{contrast_id}.nii.gz'
-                         ),
-             'xfm_nonlinear': opj(
-                        # 'sub-{subject_id}', 
-                        #  'ses-{session_name}', 
-                        #  'func',
-                         'sub-{subject_id}_ses-{session_name}_task-{task_name}_run-{run:02d}NL.feat',
-                         'reg',
-                         'example_func2standard.mat'
-                         ),
-            }
-
-all_possible_files = []
-for subject_id in subject_id_list:
-    for run in run_list:
-        for task in task_list:
-            for contrast in contrast_list:
-                for session in session_list:
-                    all_possible_files.append(templates['zfstat'].format(subject_id=subject_id, run=run, task_name=task, contrast_id=contrast, session_name=session))
-                    all_possible_files.append(templates['xfm'].format(subject_id=subject_id, run=run, task_name=task, contrast_id=contrast, session_name=session))
-                    all_possible_files.append(templates['zfstat_nonlinear'].format(subject_id=subject_id, run=run, task_name=task, contrast_id=contrast, session_name=session))
-                    all_possible_files.append(templates['xfm_nonlinear'].format(subject_id=subject_id, run=run, task_name=task, contrast_id=contrast, session_name=session))
-
-print(f"There are {len(all_possible_files)} possible files")
-
-existing_files = util.return_existing_files(all_possible_files)
-
-selectfiles = Node(SelectFiles(templates,
-                               base_directory=base_feat_dir,
-                               sort_filelist=True,
-                               raise_on_empty=False),
-                   name="selectfiles")
+# merge groups of the last run, read by the select_files nodes
+plan_path = opj(working_dir, "randomise_plan.json")
 
-MNI_template = '/usr/local/fsl/data/standard/MNI152_T1_2mm_brain.nii.gz'
+# masked subjects x voxels matrices of the registered zfstats (native engine)
+store_dir = opj(working_dir, "group_store")
 
-# in_file + in_matrix_file set in workflow.connect(), as they are determined at runtime from SelectFiles
-flirt = MapNode(fsl.FLIRT(reference=MNI_template, apply_xfm=True, padding_size=0, interp="trilinear", output_type='NIFTI_GZ'), name="flirt", iterfield=['in_file'])
+MNI_template = '/usr/local/fsl/data/standard/MNI152_T1_2mm_brain.nii.gz'
 
-fnirt = MapNode(fsl.FNIRT(ref_file=MNI_template, output_type='NIFTI_GZ'), name="fnirt", iterfield=['in_file'])
 
-# # outputs all files from flirt's to 'join' field
-def flatten_and_sort(**kwargs):    
+def build_workflow(groups: list, compress_merged: bool = False, engine: str = "fsl", n_perm: int = None, native_procs: int = 8, native_tfce: bool = True,
+                   randomise_chunks: int = 1):
+    """
+    Builds the randomise workflow: one branch per registration type, iterating over its merge groups.
+
+    engine: "fsl" (randomise), "native" (common/permutation.py) or "both"
+    n_perm: permutations of randomise and of the native engine (default: DEFAULT_N_PERM)
+    native_procs: processes of each native permutation node (reserved in the MultiProc scheduler)
+    native_tfce: native engine on the TFCE of the t statistic (as randomise's tfce=True), else voxelwise
+    randomise_chunks: permutation chunks (nodes) of each randomise test, 1: a single randomise node
+    """
+    from nipype.interfaces.utility import Function, IdentityInterface
+    from nipype.interfaces.io import DataSink
+    from nipype.interfaces import fsl
+    from nipype import Workflow, Node, MapNode, JoinNode
+
+    from merge import merge_node_func, store_node_func
+    from parallel import combine_node_func, randomise_chunk_node_func
+    from common.permutation import DEFAULT_N_PERM, permutation_node_func
+
+    if n_perm is None:
+        n_perm = DEFAULT_N_PERM
+
+    randomise_workflow = Workflow("randomise", working_dir)
+
+    for registration in planner.REGISTRATION_VARIANTS:
+        group_names = [group.name for group in groups if group.registration == registration]
+        if not group_names:
+            continue
+
+        group_source = Node(IdentityInterface(fields=["group_name"]), name=f"{registration}_group_source")
+        group_source.iterables = [("group_name", group_names)]
+
+        select_files = Node(Function(input_names=["plan_path", "group_name"], output_names=["subject_ids", "in_files", "affine_files"], function=planner.select_group_files), name=f"{registration}_select_files")
+        select_files.inputs.plan_path = plan_path
+
+        # in_file + in_matrix_file/affine_file are the group's files, subjects in order
+        if registration == "flirt":
+            register = MapNode(fsl.FLIRT(reference=MNI_template, apply_xfm=True, padding_size=0, interp="trilinear", output_type='NIFTI_GZ'), name="flirt", iterfield=['in_file', 'in_matrix_file'])
+            register_connections = [("in_files", "in_file"), ("affine_files", "in_matrix_file")]
+            registered_file = "out_file"
+        else:
+            register = MapNode(fsl.FNIRT(ref_file=MNI_template, output_type='NIFTI_GZ'), name="fnirt", iterfield=['in_file', 'affine_file'])
+            register_connections = [("in_files", "in_file"), ("affine_files", "affine_file")]
+            registered_file = "warped_file"
+
+        # one sink per branch, a shared one would iterate over the groups of both branches
+        datasink = Node(DataSink(base_directory=datasink_dir), name=f"{registration}_sinker")
+
+        randomise_workflow.connect([(group_source, select_files, [("group_name", "group_name")]),
+                                    (select_files, register, register_connections),
+                                    ])
+
+        if engine in ["fsl", "both"]:
+            # streams the registered volumes into one float32 4D image, subjects in order
+            merge = Node(Function(input_names=["in_files", "subject_ids", "out_name", "compress", "mask_file"], output_names=["merged_file", "subjects_file", "matrix_file"], function=merge_node_func), name=f"merge_{registration}")
+            merge.inputs.out_name = f"zfstat_{registration}_merged"
+            merge.inputs.compress = compress_merged
+
+            randomise_workflow.connect([(register, merge, [(registered_file, "in_files")]),
+                                        (select_files, merge, [("subject_ids", "subject_ids")]),
+                                        (merge, datasink, [("subjects_file", f"randomise.{registration}.@subjects_file")]),
+                                        ])
+
+        if engine in ["fsl", "both"] and randomise_chunks > 1:
+            chunk_source = Node(IdentityInterface(fields=["chunk"]), name=f"{registration}_chunk_source")
+            chunk_source.iterables = [("chunk", list(range(randomise_chunks)))]
+
+            randomise_chunk = Node(Function(input_names=["in_file", "mask_file", "out_name", "chunk", "n_perm", "n_chunks", "seed", "tfce"], output_names=["prefix"], function=randomise_chunk_node_func), name=f"randomise_{registration}")
+            randomise_chunk.inputs.mask_file = MNI_template
+            randomise_chunk.inputs.out_name = f"zfstat_{registration}"
+            randomise_chunk.inputs.n_perm = n_perm
+            randomise_chunk.inputs.n_chunks = randomise_chunks
+            randomise_chunk.inputs.seed = 0
+            randomise_chunk.inputs.tfce = True
+            # the chunk's outputs are found by their prefix, nipype would remove them as not referenced by an output
+            randomise_chunk.config = {"execution": {"remove_unnecessary_outputs": False}}
+
+            # one join per merge group, over its chunks
+            combine = JoinNode(Function(input_names=["prefixes", "mask_file", "out_name", "tfce"], output_names=["tstat_files", "p_files", "corrected_p_files"], function=combine_node_func),
+                               joinsource=chunk_source, joinfield=["prefixes"], name=f"combine_{registration}")
+            combine.inputs.mask_file = MNI_template
+            combine.inputs.out_name = f"zfstat_{registration}"
+            combine.inputs.tfce = True
+
+            randomise_workflow.connect([(merge, randomise_chunk, [("merged_file", "in_file")]),
+                                        (chunk_source, randomise_chunk, [("chunk", "chunk")]),
+                                        (randomise_chunk, combine, [("prefix", "prefixes")]),
+                                        (combine, datasink, [("tstat_files", f"randomise.{registration}.@tstat_files"),
+                                                             ("corrected_p_files", f"randomise.{registration}.@t_corrected_p_files"),
+                                                             ("p_files", f"randomise.{registration}.@t_p_files")]),
+                                        ])
+        elif engine in ["fsl", "both"]:
+            randomise = Node(fsl.Randomise(one_sample_group_mean=True, tfce=True, mask=MNI_template, num_perm=n_perm, output_type='NIFTI_GZ'), name=f"randomise_{registration}")
+
+            randomise_workflow.connect([(merge, randomise, [("merged_file", "in_file")]),
+                                        (randomise, datasink, [("tstat_files", f"randomise.{registration}.@tstat_files"),
+                                                               ("t_corrected_p_files", f"randomise.{registration}.@t_corrected_p_files"),
+                                                               ("t_p_files", f"randomise.{registration}.@t_p_files")]),
+                                        ])
+
+        if engine in ["native", "both"]:
+            # the group's registered files are extracted once into the group store, the permutations run on its matrix
+            store = Node(Function(input_names=["store_dir", "mask_file", "plan_path", "group_name", "in_files"], output_names=["matrix_file", "subject_ids", "generation"], function=store_node_func), name=f"store_{registration}")
+            store.inputs.store_dir = store_dir
+            store.inputs.mask_file = MNI_template
+            store.inputs.plan_path = plan_path
+
+            permute = Node(Function(input_names=["matrix_file", "mask_file", "out_name", "n_perm", "seed", "n_procs", "tfce", "subject_ids", "generation"], output_names=["tstat_files", "p_files", "corrected_p_files"], function=permutation_node_func), name=f"permute_{registration}", n_procs=native_procs)
+            permute.inputs.mask_file = MNI_template
+            permute.inputs.out_name = f"zfstat_{registration}"
+            permute.inputs.n_perm = n_perm
+            permute.inputs.n_procs = native_procs
+            permute.inputs.tfce = native_tfce
+
+            randomise_workflow.connect([(group_source, store, [("group_name", "group_name")]),
+                                        (register, store, [(registered_file, "in_files")]),
+                                        (store, permute, [("matrix_file", "matrix_file"), ("subject_ids", "subject_ids"), ("generation", "generation")]),
+                                        (permute, datasink, [("tstat_files", f"native.{registration}.@tstat_files"),
+                                                             ("corrected_p_files", f"native.{registration}.@t_corrected_p_files"),
+                                                             ("p_files", f"native.{registration}.@t_p_files")]),
+                                        ])
+
+    randomise_workflow.config["execution"]["crashdump_dir"] = opj(randomise_workflow.config["execution"]["crashdump_dir"], working_dir, "crash")
+
+    return randomise_workflow
+
+
+parser = argparse.ArgumentParser(description="Group-level randomise of the FEAT zfstats")
+parser.add_argument("--base_feat_dir", type=str, default=base_feat_dir, help="FEAT datasink directory")
+parser.add_argument("--plan", action="store_true", help="Only print the merge groups, without writing anything")
+parser.add_argument("--contrasts", type=int, nargs="+", default=None, help="Contrasts to run (default: all)")
+parser.add_argument("--registrations", type=str, nargs="+", default=None, choices=list(planner.REGISTRATION_VARIANTS), help="Registration types to run (default: all)")
+parser.add_argument("--compress_merged", action="store_true", help="Gzip the merged 4D images (default: uncompressed, read directly by randomise)")
+parser.add_argument("--engine", type=str, default="fsl", choices=["fsl", "native", "both"], help="Permutation engine: FSL randomise, native sign flips (common/permutation.py) or both")
+parser.add_argument("--n_perm", type=int, default=None, help="Permutations of randomise (chunked or not) and of the native engine (default: 5000, common.permutation.DEFAULT_N_PERM)")
+parser.add_argument("--randomise_chunks", type=int, default=1, help="Split each randomise test into this many seeded permutation chunk nodes")
+parser.add_argument("--native_procs", type=int, default=8, help="Processes of each native permutation node")
+parser.add_argument("--no_tfce", action="store_true", help="Native engine: voxelwise correction of the t statistic instead of TFCE")
+parser.add_argument("--graph", action="store_true", help="Write the workflow graph")
+parser.add_argument("--n_procs", type=int, default=32, help="Number of processes")
+parser.add_argument("-y", "--yes", action="store_true", help="Run the workflow without asking for confirmation")
+
+if __name__ == "__main__":
     import logging
-    
-    logger = logging.getLogger('nipype.workflow')  
-    double_wrapped_file_names = list(kwargs.values()) # [[[file1], [file2]]]
-    wrapped_file_names = double_wrapped_file_names[0] # each file name is 'wrapped' in array, ex: [['file1'], ['file2]]    
-    logger.info(double_wrapped_file_names)
-    logger.info(len(double_wrapped_file_names))
-    logger.info(wrapped_file_names)
-    logger.info(len(wrapped_file_names))
-    
-    sorted_file_names = sorted([wrapped_file_name[0] for wrapped_file_name in wrapped_file_names])    
-    logger.info("SORTED FILE NAMES")
-    logger.info(sorted_file_names)
-    return sorted_file_names
-
-
-join_flirt = JoinNode(Function(input_names=["join_in"], output_names="join_out", function=flatten_and_sort),
-                joinsource="subject_node", # join on subject_id, as we want to group by subject
-                joinfield="join_in",              
-                name="join_flirt")
-
-join_fnirt = JoinNode(Function(input_names=["join_in"], output_names="join_out", function=flatten_and_sort),
-                joinsource="subject_node", # join on subject_id, as we want to group by subject
-                joinfield="join_in",
-                name="join_fnirt")
-
-# Input: All files from 'join', which should be all copes registered to MNI space
-# 
-# We need to group files by contrast id, order by subject id, 
-# grouped_cope_names = [f'zfstats{contrast_id}_files' for contrast_id in contrast_list]
-# def group_copes_func(in_files_array):
-#     flattened = [in_files_array[0] for arr in in_files_array] # each path is wrapped in array for some reason    
-    
-#     print(flattened)
-    
-#     print(sorted(flattened))    
-#     # for contrast_id in contrast_list:
-#     #     if f"zfstat{contrast_id}" in   
-    
-#     return flattened, flattened, flattened, flattened, flattened, flattened
-       
-
-# group_copes = Node(Function(input_names=['in_files_array'], output_names=grouped_cope_names, function=group_copes_func), name='group_copes')
-# def merge_copes(in_files, contrast_id):
-#     from nipype.interfaces import fsl
-#     from pathlib import Path
-#     grouped_copes = list(filter(lambda file_name: f"zfstat{contrast_id}" in file_name, in_files))
-#     print(grouped_copes)
-    
-#     merge = fsl.Merge(dimension='t')        
-#     merge.inputs.in_files = grouped_copes
-#     res = merge.run()    
-    
-    
-
-# merge_copes = Node(Function(input_names=["in_files", "contrast_id"], output_names=["merged", "contrast_id"]), name='merge_copes')
-# merge_copes.iterables = [('contrast_id', contrast_list)]
-
-merge_flirt = Node(fsl.Merge(dimension='t'), name="merge_flirt")
-merge_fnirt = Node(fsl.Merge(dimension='t'), name="merge_fnirt")
-
-# randomise_fsl = fsl.Randomise(one_sample_group_mean=True, tfce=True, mask=MNI_template, output_type='NIFTI_GZ')
-
-# randomise_fsl.inputs.in_file = "/home/011/d/ds/dss210005/pipeline/randomise/workingdir/randomise/_contrast_id_1/_run_1/_task_name_sst/_session_name_baselineYear1Arm1/merge_flirt/zfstat1_flirt_merged.nii.gz"
-# print(f"randomise fsl command: {randomise_fsl.cmdline}")
-
-randomise_flirt = Node(fsl.Randomise(one_sample_group_mean=True, tfce=True, mask=MNI_template, output_type='NIFTI_GZ'), name="randomise_flirt")
-randomise_fnirt = Node(fsl.Randomise(one_sample_group_mean=True, tfce=True, mask=MNI_template, output_type='NIFTI_GZ'), name="randomise_fnirt")
-
-datasink = Node(DataSink(base_directory=datasink_dir), name="sinker")
-
-# datafinder = DataFinder()
-# datafinder.inputs.root_paths = feat_dir
-# datafinder.inputs.match_regex = r'.+/(?P<series_dir>.+(qT1|ep2d_fid_T1).+)/(?P<basename>.+)\.nii.gz'
-# result = datafinder.run() 
-# result.outputs.out_paths  
-
-# SelectFiles (like DataGrabber++) OR DataFinder (Python regex)
-# - SelectFiles: define paths beforehand and format variables into the path where things change
-# - DataFinder: more flexible
-# Iterate through subjects, runs, zfstats
-# for each zfstat, register (flirt) to MNI space
-# For randomise:
-#   - 2nd-level analysis (across runs within subject), 
-#   make 4D fMRI image for each cope across runs
-#   - Higher-level analysis (across subjects), 
-#   make 4D fMRI image for each cope across subjects
-randomise_workflow = Workflow("randomise", working_dir)
-# randomise_workflow.connect([(infosource, selectfiles, [('subject_id', 'subject_id'),
-#                                                        ('task_name', 'task_name'),
-#                                                        ('run', 'run'),
-#                                                        ('contrast_id', 'contrast_id')]),
-#                             (selectfiles, flirt, [('zfstat', 'in_file'),
-#                                                   ('xfm', 'in_matrix_file')]),
-#                             (flirt, join, [('out_file', 'join_in')]),
-#                             (join, merge, [('join_out', 'in_files')]),
-#                             (merge, randomise, [('merged_file', 'in_file')]),
-#                             (randomise, datasink, [("tstat_files", "randomise@tstat_files"),])])
-
-# using contrast_id as initial source
-# randomise_workflow.connect([(contrast_info_source, run_node, [('contrast_id', 'contrast_id')]),
-#                             (run_node, task_node, [('run', 'run'), ('contrast_id', 'contrast_id')]),
-#                             (task_node, session_node, [('task_name', 'task_name'), 
-#                                                        ('contrast_id', 'contrast_id'), 
-#                                                        ('run', 'run')]),
-#                             (session_node, subject_node, [('session_name', 'session_name'), 
-#                                                           ('task_name', 'task_name'), 
-#                                                           ('contrast_id', 'contrast_id'), 
-#                                                           ('run', 'run')]),                            
-#                             (subject_node, selectfiles, [('subject_id', 'subject_id'), 
-#                                                          ('session_name', 'session_name'),
-#                                                          ('task_name', 'task_name'), 
-#                                                          ('contrast_id', 'contrast_id'), 
-#                                                          ('run', 'run')]),
-#                             (selectfiles, flirt, [('zfstat', 'in_file'), ('xfm', 'in_matrix_file')]),
-#                             (selectfiles, fnirt, [('zfstat_nonlinear', 'in_file'), ('xfm_nonlinear', 'affine_file')]),                            
-#                             (flirt, join_flirt, [('out_file', 'join_in')]),   
-#                             (flirt, datasink, [('out_file', 'flirt')]),                         
-#                             (fnirt, join_fnirt, [('warped_file', 'join_in')]),
-#                             (fnirt, datasink, [('warped_file', 'fnirt')]),
-#                             (join_flirt, merge_flirt, [('join_out', 'in_files')]),
-#                             (join_fnirt, merge_fnirt, [('join_out', 'in_files')]),
-#                             (merge_flirt, randomise_flirt, [('merged_file', 'in_file')]),
-#                             (merge_fnirt, randomise_fnirt, [('merged_file', 'in_file')]),
-#                             (randomise_flirt, datasink, [("tstat_files", "randomise@flirt"),
-#                                                          ("t_corrected_p_files", "randomise@flirt")
-#                                                          ("t_p_files", "randomise@flirt")]),                                                    
-#                             (randomise_fnirt, datasink, [("tstat_files", "randomise@fnirt")
-#                                                          ("t_corrected_p_files", "randomise@fnirt")
-#                                                          ("t_p_files", "randomise@fnirt")])
-#                             ])
-
-randomise_workflow.write_graph(graph2use="colored", format="png", simple_form=True)
-# randomise_workflow.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")
-
-randomise_workflow.config["execution"]["crashdump_dir"] = opj(randomise_workflow.config["execution"]["crashdump_dir"], working_dir, "crash")
-
-# print(randomise_workflow.config["execution"])
-
-logger.info("Workflow graph written to %s" % randomise_workflow.base_dir)
-
-answer = input("Run workflow? (y/n)")
-if not (answer == 'y' or answer == 'Y'):
-    print("Exiting")
-    exit()
-
-
-# run = randomise_workflow.run(plugin="MultiProc", plugin_args={"n_procs": 4})
-run = randomise_workflow.run(plugin="MultiProc", plugin_args={"n_procs": 32})
\ No newline at end of file
+    logger = logging.getLogger('nipype.workflow')
+
+    args = parser.parse_args()
+
+    print("base feat directory:", args.base_feat_dir)
+
+    from common.manifest import refresh_manifest
+
+    # FEAT directories written since the manifest was saved are scanned (the preprocessing
+    # stage only updates it when slimming), --plan does not save it (writes to the datasink)
+    manifest = refresh_manifest(args.base_feat_dir, save=not args.plan)
+
+    groups = planner.plan_merge_groups(args.base_feat_dir, contrasts=args.contrasts, registrations=args.registrations, manifest=manifest)
+
+    print()
+    planner.print_groups(groups)
+
+    if args.plan:
+        print()
+        print(f"datasink: {datasink_dir}")
+        print(f"nipype cache: {opj(working_dir, 'randomise')}{'' if os.path.exists(opj(working_dir, 'randomise')) else ' (none yet)'}")
+        exit(0)
+
+    if not groups:
+        print("No merge groups, nothing to do")
+        exit(0)
+
+    planner.write_batch_plan(groups, plan_path)
+
+    randomise_workflow = build_workflow(groups, compress_merged=args.compress_merged, engine=args.engine, n_perm=args.n_perm, native_procs=args.native_procs, native_tfce=not args.no_tfce,
+                                        randomise_chunks=args.randomise_chunks)
+
+    if args.graph:
+        randomise_workflow.write_graph(graph2use="colored", format="png", simple_form=True)
+        # randomise_workflow.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")
+
+        logger.info("Workflow graph written to %s" % randomise_workflow.base_dir)
+
+    if not args.yes:
+        answer = input("Run workflow? (y/n)")
+        if not (answer == 'y' or answer == 'Y'):
+            print("Exiting")
+            exit()
+
+    # timing and memory events of the nodes, summary: python -m common.instrument <event log>,
+    # timeline: <event log>.html and .trace.json (common/timeline.py)
+    # (imported here, timeline imports numpy and pandas)
+    from common import instrument, timeline
+
+    event_log = instrument.start_run(opj(working_dir, "event_logs"), "randomise")
+
+    start_time = time.time()
+
+    run = None
+    try:
+        # run = randomise_workflow.run(plugin="MultiProc", plugin_args={"n_procs": 4})
+        run = randomise_workflow.run(plugin="MultiProc", plugin_args={"n_procs": args.n_procs, "status_callback": instrument.status_callback})
+    finally:
+        # also for a failed run, the execution graph only if the workflow finished
+        timeline.report_run(event_log, graph=run)
+
+    print(f"The workflow took {time.time() - start_time} seconds to complete.")
@@ -0,0 +1,89 @@
+"""
+Builds a group design from a subjects table (ex: subjects/tsv/pilot_anx_cases.tsv)
+and a formula (common/design.py), writes it as FSL design files for randomise
+(-d .mat -t .con -e .grp) and optionally fits it to a group of the group store,
+writing the t map of every contrast.
+
+The rows of the design follow the subject order of --subjects_file (the merged 4D
+image's _subjects.json sidecar, so the design matches randomise's input) or of the
+group store's --group; subjects without covariates are left out.
+
+Usage:
+    python make_design.py --tsv ../subjects/tsv/pilot_anx_cases.tsv --formula "1 + cbcl_scr_syn_anxdep_t" \
+        --contrast anx_pos=cbcl_scr_syn_anxdep_t --contrast anx_neg=-cbcl_scr_syn_anxdep_t --out_prefix designs/anx \
+        [--subjects_file zfstat_flirt_merged_subjects.json | --group zfstat1_task-sst_ses-baselineYear1Arm1_run-01_flirt] [--blocks site]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from os.path import join as opj
+
+RANDOMISE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# shared modules (common/)
+sys.path.append(os.path.dirname(RANDOMISE_DIR))
+
+from common.design import build_design, fit_glm, normalize_subject_id, parse_contrasts, read_subjects_table, write_fsl_design
+
+# group store of main.py
+store_dir = opj("/home/011/d/ds/dss210005/pipeline/randomise", "workingdir", "group_store")
+
+
+parser = argparse.ArgumentParser(description="Build a group design from a subjects table and a formula")
+parser.add_argument("--tsv", type=str, required=True, help="Subjects table (.tsv/.csv)")
+parser.add_argument("--id_column", type=str, default="src_subject_id", help="Subject id column of the table")
+parser.add_argument("--formula", type=str, required=True, help='Ex: "1 + cbcl_scr_syn_anxdep_t + C(sex)"')
+parser.add_argument("--contrast", type=str, action="append", required=True, help="[name=]expression over the design columns, repeatable (ex: anx_neg=-cbcl_scr_syn_anxdep_t)")
+parser.add_argument("--blocks", type=str, default=None, help="Column of the exchangeability blocks")
+parser.add_argument("--no_demean", action="store_true", help="Do not demean the numeric covariates")
+parser.add_argument("--out_prefix", type=str, required=True, help="Output prefix of the design files")
+parser.add_argument("--subjects_file", type=str, default=None, help="Subject order: _subjects.json sidecar of a merged image")
+parser.add_argument("--group", type=str, default=None, help="Subject order of a group store group, also fit the design to it")
+parser.add_argument("--store_dir", type=str, default=store_dir, help="Group store directory")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    start_time = time.time()
+
+    table = read_subjects_table(args.tsv, id_column=args.id_column)
+
+    store = None
+    subject_ids = None
+    if args.subjects_file is not None:
+        with open(args.subjects_file, "r") as file:
+            subject_ids = json.load(file)["subject_ids"]
+    elif args.group is not None:
+        from common.group_store import GroupStore
+
+        store = GroupStore(args.store_dir)
+        subject_ids = store.subject_ids(args.group)
+
+    design = build_design(table, args.formula, parse_contrasts(args.contrast), subject_ids=subject_ids, blocks=args.blocks, demean=not args.no_demean)
+
+    print(f"Design {design.formula}: {len(design.subject_ids)} subjects, columns {design.columns}")
+    for name, weights in zip(design.contrast_names, design.contrasts):
+        print(f"  {name}: {weights.tolist()}")
+
+    if subject_ids is not None and len(design.subject_ids) < len(subject_ids):
+        print(f"WARN: the design has {len(subject_ids) - len(design.subject_ids)} subjects less than the image, "
+              f"randomise needs the image of exactly {args.out_prefix}_subjects.txt")
+
+    for path in write_fsl_design(design, args.out_prefix).values():
+        print(f"Wrote {path}")
+
+    if store is not None:
+        import nibabel as nib
+
+        # the design's subject ids are without sub-, the store's as planned
+        stored_id = {normalize_subject_id(subject_id): subject_id for subject_id in subject_ids}
+        Y, _ = store.matrix(args.group, subject_ids=[stored_id[subject_id] for subject_id in design.subject_ids])
+        fit = fit_glm(Y, design)
+
+        for name, t in zip(design.contrast_names, fit["t"]):
+            path = f"{args.out_prefix}_{name}_tstat.nii.gz"
+            nib.save(nib.Nifti1Image(store.unmask(t), store.affine), path)
+            print(f"Wrote {path}")
+
+    print(f"Took {time.time() - start_time:.1f} seconds")
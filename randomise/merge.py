@@ -0,0 +1,283 @@
+"""
+In-process 4D merge of the registered zfstats of a merge group (replaces fslmerge -t).
+
+Each 3D volume is read once and streamed into the 4D output as float32, one
+volume in memory at a time: the header is written first and the volumes follow
+in subject order (a 4D NIfTI is the 3D volumes one after the other). Uncompressed
+(.nii) outputs skip the gzip cycle altogether and can be memory-mapped right away.
+Optionally the in-mask voxels are written as a subjects x voxels float32 matrix
+(.npy, memory-mappable) for the native permutation engine; the workflow keeps them
+in the appendable group store instead (store_node_func, common/group_store.py).
+
+The subjects are sorted by id (ties by path), their order is written to a JSON
+sidecar next to the output (<name>_subjects.json).
+
+Usage:
+    python merge.py --batch_plan workingdir/randomise_plan.json --group zfstat1_task-sst_ses-baselineYear1Arm1_run-01_flirt --out_dir DIR [--mask MASK] [--compress]
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import time
+from os.path import join as opj
+
+SIDECAR_SUFFIX = "_subjects.json"
+
+# ex: /.../sub-NDARINV003RTV85_ses-baselineYear1Arm1_task-sst_run-01LN.feat/stats/zfstat1.nii.gz
+SUBJECT_REGEX = re.compile(r"sub-([^_/]+)")
+
+
+def _strip_ext(path: str) -> str:
+    for ext in [".nii.gz", ".nii", ".npy"]:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def sidecar_path(out_file: str) -> str:
+    """
+    Returns the subject order sidecar path of a merged output.
+    """
+    return f"{_strip_ext(out_file)}{SIDECAR_SUFFIX}"
+
+
+def sort_inputs(in_files: list, subject_ids: list = None):
+    """
+    Returns (subject_ids, in_files) sorted by subject id, then path. Subject ids are
+    parsed from the paths (sub-<id>) if not given.
+    """
+    if subject_ids is None:
+        subject_ids = []
+        for in_file in in_files:
+            match = SUBJECT_REGEX.search(in_file)
+            if match is None:
+                raise ValueError(f"No subject id (sub-<id>) in {in_file}")
+            subject_ids.append(match.group(1))
+
+    if len(subject_ids) != len(in_files):
+        raise ValueError(f"{len(subject_ids)} subject ids for {len(in_files)} files")
+
+    pairs = sorted(zip(subject_ids, in_files))
+
+    return [subject_id for subject_id, _ in pairs], [in_file for _, in_file in pairs]
+
+
+def _load_volume(in_file: str, shape: tuple = None, affine=None):
+    import numpy as np
+    from common.nifti_io import load_nifti
+
+    img = load_nifti(in_file)
+
+    # FSL writes some 3D outputs as 4D with a single volume
+    volume_shape = img.shape[:3] if len(img.shape) == 4 and img.shape[3] == 1 else img.shape
+    if len(volume_shape) != 3:
+        raise ValueError(f"{in_file} is not a 3D volume (shape {img.shape})")
+
+    if shape is not None and volume_shape != shape:
+        raise ValueError(f"{in_file} has shape {volume_shape}, expected {shape}")
+
+    if affine is not None and not np.allclose(img.affine, affine, atol=1e-4):
+        raise ValueError(f"{in_file} is not in the same space as the first volume")
+
+    data = np.asarray(img.dataobj, dtype=np.float32).reshape(volume_shape, order="F")
+
+    return img, data
+
+
+def _write_sidecar(out_file: str, subject_ids: list, in_files: list, **extra):
+    with open(sidecar_path(out_file), "w") as file:
+        json.dump({"subject_ids": subject_ids, "in_files": in_files, **extra}, file, indent=1)
+
+
+def merge_volumes(in_files: list, out_file: str, subject_ids: list = None) -> str:
+    """
+    Merges 3D volumes into a 4D float32 NIfTI (gzipped if out_file ends with .nii.gz),
+    subjects sorted by id. Writes the subject order sidecar. Returns out_file.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    if not in_files:
+        raise ValueError("No files to merge")
+
+    subject_ids, in_files = sort_inputs(in_files, subject_ids)
+
+    first_img, first_data = _load_volume(in_files[0])
+    shape = first_data.shape
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape + (len(in_files),))
+    header.set_data_dtype(np.float32)
+    header.set_zooms(first_img.header.get_zooms()[:3] + (1.0,))
+    header.set_qform(first_img.affine, code=int(first_img.header["qform_code"]) or 1)
+    header.set_sform(first_img.affine, code=int(first_img.header["sform_code"]) or 1)
+    header.set_xyzt_units(*first_img.header.get_xyzt_units())
+    header["vox_offset"] = 352
+
+    compress = out_file.endswith(".gz")
+    tmp_path = f"{out_file}.tmp-{os.getpid()}"
+
+    try:
+        # compresslevel 1: the merged file is read once by randomise
+        with (gzip.open(tmp_path, "wb", compresslevel=1) if compress else open(tmp_path, "wb")) as file:
+            file.write(header.binaryblock)
+            file.write(b"\0" * (352 - len(header.binaryblock)))
+
+            file.write(first_data.tobytes(order="F"))
+            del first_data
+
+            for in_file in in_files[1:]:
+                _, data = _load_volume(in_file, shape, first_img.affine)
+                file.write(data.tobytes(order="F"))
+
+        os.replace(tmp_path, out_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _write_sidecar(out_file, subject_ids, in_files, shape=list(shape))
+
+    return out_file
+
+
+def merge_to_matrix(in_files: list, mask_file: str, out_file: str, subject_ids: list = None) -> str:
+    """
+    Writes the in-mask voxels (mask > 0, in C order of the volume) of each volume as
+    one row of a float32 subjects x voxels matrix (.npy), subjects sorted by id.
+    Writes the subject order sidecar. Returns out_file.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    if not in_files:
+        raise ValueError("No files to merge")
+
+    subject_ids, in_files = sort_inputs(in_files, subject_ids)
+
+    mask_img = nib.load(mask_file)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+
+    tmp_path = f"{_strip_ext(out_file)}.tmp-{os.getpid()}.npy"
+    try:
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(in_files), int(mask.sum())))
+
+        for i, in_file in enumerate(in_files):
+            _, data = _load_volume(in_file, mask.shape, mask_img.affine)
+            matrix[i] = data[mask]
+
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, out_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _write_sidecar(out_file, subject_ids, in_files, mask_file=mask_file, shape=list(mask.shape))
+
+    return out_file
+
+
+def load_matrix(matrix_file: str, mmap: bool = True):
+    """
+    Returns (subjects x voxels matrix, subject ids) of a matrix written by merge_to_matrix.
+    """
+    import numpy as np
+
+    with open(sidecar_path(matrix_file), "r") as file:
+        sidecar = json.load(file)
+
+    return np.load(matrix_file, mmap_mode="r" if mmap else None), sidecar["subject_ids"]
+
+
+def merge_node_func(in_files: list, subject_ids: list, out_name: str, compress: bool = False, mask_file: str = None):
+    """
+    Node function, merges a group into <out_name>.nii (.nii.gz if compress) in the
+    node directory, plus <out_name>.npy (subjects x in-mask voxels) if mask_file is given.
+    Returns (merged_file, subjects_file, matrix_file).
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    from merge import merge_volumes, merge_to_matrix, sidecar_path
+    from common.instrument import measure
+
+    with measure("merge", out_name=out_name, n_subjects=len(in_files)):
+        merged_file = merge_volumes(in_files, os.path.join(os.getcwd(), f"{out_name}.nii{'.gz' if compress else ''}"), subject_ids)
+
+        matrix_file = None
+        if mask_file is not None:
+            matrix_file = merge_to_matrix(in_files, mask_file, os.path.join(os.getcwd(), f"{out_name}.npy"), subject_ids)
+
+    return merged_file, sidecar_path(merged_file), matrix_file
+
+
+def store_node_func(store_dir: str, mask_file: str, plan_path: str, group_name: str, in_files: list):
+    """
+    Node function, adds the registered files of a merge group (in the group's subject order)
+    to the group store (common/group_store.py). Returns (matrix_file, subject_ids, generation): the
+    subjects x in-mask voxels matrix of exactly the group's subjects (the store's matrix, or a
+    selection of its rows in the node directory if the store also holds other subjects), the
+    subject of each row and the store generation of the group (changes when rows are appended or
+    replaced, so the nodes reading the matrix rerun).
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    import numpy as np
+    from common.group_store import GroupStore
+    from planner import REGISTRATION_VARIANTS, load_batch_plan
+
+    group = {group.name: group for group in load_batch_plan(plan_path)}[group_name]
+
+    store = GroupStore(store_dir, mask_file=mask_file)
+    store.append(group_name, in_files, group.subject_ids, sources=group.in_files, contrast=group.contrast, session=group.session,
+                 task=group.task, run=group.run, registration=group.registration, variant=REGISTRATION_VARIANTS[group.registration])
+
+    generation = store.generation(group_name)
+
+    subject_ids = store.subject_ids(group_name)
+    if sorted(subject_ids) == sorted(group.subject_ids):
+        return store.matrix_path(group_name), subject_ids, generation
+
+    matrix, subject_ids = store.matrix(group_name, subject_ids=group.subject_ids)
+    matrix_file = os.path.join(os.getcwd(), f"{group_name}.npy")
+    np.save(matrix_file, matrix)
+
+    return matrix_file, subject_ids, generation
+
+
+parser = argparse.ArgumentParser(description="Merge the registered zfstats of a merge group")
+parser.add_argument("--batch_plan", type=str, required=True, help="Batch plan written by planner.write_batch_plan")
+parser.add_argument("--group", type=str, nargs="+", required=True, help="Merge group name(s)")
+parser.add_argument("--out_dir", type=str, required=True, help="Output directory")
+parser.add_argument("--registered", action="store_true", help="Merge the files already registered by the roi stage (zfstatN_LN/NL.nii.gz)")
+parser.add_argument("--mask", type=str, default=None, help="Also write the subjects x in-mask voxels matrix (.npy)")
+parser.add_argument("--compress", action="store_true", help="Write .nii.gz instead of .nii")
+
+if __name__ == "__main__":
+    import sys
+
+    # shared modules (common/)
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+    from planner import load_batch_plan
+
+    args = parser.parse_args()
+
+    groups = {group.name: group for group in load_batch_plan(args.batch_plan)}
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    for name in args.group:
+        group = groups[name]
+        start_time = time.time()
+
+        in_files = group.registered_files if args.registered else group.in_files
+        if None in in_files:
+            raise FileNotFoundError(f"{in_files.count(None)} files of {name} are not registered yet")
+
+        out_file = merge_volumes(in_files, opj(args.out_dir, f"{name}.nii{'.gz' if args.compress else ''}"), group.subject_ids)
+        if args.mask is not None:
+            merge_to_matrix(in_files, args.mask, opj(args.out_dir, f"{name}.npy"), group.subject_ids)
+
+        print(f"Merged {len(in_files)} volumes into {out_file} in {time.time() - start_time:.1f} seconds")
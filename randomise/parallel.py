@@ -0,0 +1,217 @@
+"""
+Parallel randomise: one test split into seeded permutation chunks, the chunks'
+max-statistic null distributions and p-maps merged afterwards (as FSL's
+randomise_parallel + randomise_combine, built into the workflow).
+
+Chunk i runs randomise with --seed=seed + i on its share of the permutations, with
+the raw (unpermuted) statistic images (-R) and the null distribution of the maximum
+statistic (-N). Every chunk includes the unpermuted data as its first permutation,
+so n_chunks of the requested permutations are the identity, as randomise_parallel.
+If the permutations cover all 2^n_subjects sign flips, randomise enumerates them
+exhaustively and chunk 0 runs them alone.
+
+Merging, in chunk order (same result whatever order the chunks finish in):
+    uncorrected p = sum of the chunks' exceedance counts (p * permutations) / total permutations
+    corrected p = fraction of the concatenated max nulls reaching the raw statistic
+
+The chunks run as separate workflow nodes (main.py --randomise_chunks), or in a
+local process pool (run_parallel, this file's CLI).
+
+Usage:
+    python parallel.py --in_file zfstat1_..._flirt_merged.nii --mask MASK --out_prefix DIR/zfstat1_..._flirt [--n_perm 5000] [--n_chunks 16] [--n_procs 16]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_N_CHUNKS = 16
+
+# stat name -> candidate null distribution suffixes written by randomise -N
+NULL_SUFFIXES = {
+    "tfce": ["_perm_tfce_tstat{contrast}.txt"],
+    "vox": ["_perm_vox_tstat{contrast}.txt", "_perm_tstat{contrast}.txt"],
+}
+
+
+def chunk_sizes(n_perm: int, n_chunks: int) -> list:
+    """
+    Returns the permutations of each chunk (the first n_perm % n_chunks chunks run one more).
+    """
+    return [n_perm // n_chunks + (1 if chunk < n_perm % n_chunks else 0) for chunk in range(n_chunks)]
+
+
+def chunk_prefix(out_prefix: str, chunk: int) -> str:
+    return f"{out_prefix}_chunk{chunk:03d}"
+
+
+def run_chunk(in_file: str, mask_file: str, out_prefix: str, chunk: int, n_perm: int, n_chunks: int, seed: int = 0, tfce: bool = True) -> str:
+    """
+    Runs randomise (one-sample) on its chunk of the permutations. Returns the chunk's output prefix,
+    None if there is nothing left to run for the chunk (exhaustive permutations, run by chunk 0).
+    """
+    import nibabel as nib
+    from nipype.interfaces import fsl
+
+    n_subjects = nib.load(in_file).shape[3]
+
+    sizes = chunk_sizes(n_perm, n_chunks)
+    if n_subjects < 31 and 2 ** n_subjects <= n_perm:
+        # randomise enumerates the sign flips exhaustively, whatever the seed
+        sizes = [n_perm] + [0] * (n_chunks - 1)
+
+    if sizes[chunk] == 0:
+        return None
+
+    prefix = chunk_prefix(out_prefix, chunk)
+
+    # -N: null distribution of the max statistic, --uncorrp: the uncorrected p image combine_chunks reads
+    randomise = fsl.Randomise(in_file=in_file, mask=mask_file, base_name=prefix, num_perm=sizes[chunk], seed=seed + chunk,
+                              one_sample_group_mean=True, raw_stats_imgs=True, args="-N --uncorrp", output_type="NIFTI_GZ")
+    if tfce:
+        randomise.inputs.tfce = True
+    else:
+        randomise.inputs.vox_p_values = True
+
+    randomise.run()
+
+    return prefix
+
+
+def _null_file(prefix: str, stat_name: str, contrast_number: int) -> str:
+    candidates = [f"{prefix}{suffix.format(contrast=contrast_number)}" for suffix in NULL_SUFFIXES[stat_name]]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+
+    raise FileNotFoundError(f"No null distribution of {prefix}, expected one of {candidates}")
+
+
+def combine_chunks(prefixes: list, mask_file: str, out_prefix: str, stat_name: str = "tfce", contrast_number: int = 1) -> dict:
+    """
+    Merges the randomise outputs of the chunks into <out_prefix>_tstat1.nii.gz,
+    _<stat_name>_p_tstat1.nii.gz, _<stat_name>_corrp_tstat1.nii.gz (1 - p, as randomise)
+    and the merged null distribution _perm_<stat_name>_tstat1.txt. Returns {name: path}.
+    """
+    import nibabel as nib
+    import numpy as np
+    from common.permutation import corrected_p
+
+    prefixes = [prefix for prefix in prefixes if prefix is not None]
+    if not prefixes:
+        raise ValueError("No chunk outputs to combine")
+
+    # chunk order (<out_prefix>_chunkNNN), not completion or node directory order
+    prefixes = sorted(prefixes, key=os.path.basename)
+
+    mask_img = nib.load(mask_file)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+
+    def load(path):
+        return np.asanyarray(nib.load(path).dataobj, dtype=np.float64).reshape(mask.shape)
+
+    tstat_name = f"tstat{contrast_number}"
+    # raw statistic the nulls are of: tfce of the t statistic or the t statistic itself
+    raw_name = f"{stat_name}_{tstat_name}" if stat_name == "tfce" else tstat_name
+
+    max_nulls = []
+    counts = np.zeros(mask.shape)
+    for prefix in prefixes:
+        max_null = np.loadtxt(_null_file(prefix, stat_name, contrast_number), ndmin=1)
+        max_nulls.append(max_null)
+
+        # randomise writes 1 - p, p = exceedances / permutations of the chunk
+        counts += (1 - load(f"{prefix}_{stat_name}_p_{tstat_name}.nii.gz")) * len(max_null)
+
+    max_null = np.concatenate(max_nulls)
+    n_perm = len(max_null)
+
+    observed = load(f"{prefixes[0]}_{raw_name}.nii.gz")
+
+    p = np.zeros(mask.shape)
+    p[mask] = 1 - counts[mask] / n_perm
+
+    corrp = np.zeros(mask.shape)
+    corrp[mask] = 1 - corrected_p(observed[mask], max_null)
+
+    reference_img = nib.load(f"{prefixes[0]}_{tstat_name}.nii.gz")
+
+    paths = {tstat_name: f"{out_prefix}_{tstat_name}.nii.gz"}
+    nib.save(nib.Nifti1Image(np.asanyarray(reference_img.dataobj), reference_img.affine, reference_img.header), paths[tstat_name])
+
+    for name, values in [(f"{stat_name}_p_{tstat_name}", p), (f"{stat_name}_corrp_{tstat_name}", corrp)]:
+        paths[name] = f"{out_prefix}_{name}.nii.gz"
+        nib.save(nib.Nifti1Image(values.astype(np.float32), reference_img.affine), paths[name])
+
+    paths["null"] = f"{out_prefix}_perm_{stat_name}_{tstat_name}.txt"
+    np.savetxt(paths["null"], max_null, fmt="%.6g")
+
+    return paths
+
+
+def run_parallel(in_file: str, mask_file: str, out_prefix: str, n_perm: int = 5000, n_chunks: int = DEFAULT_N_CHUNKS, n_procs: int = DEFAULT_N_CHUNKS,
+                 seed: int = 0, tfce: bool = True) -> dict:
+    """
+    Local backend: runs the chunks of one test in a process pool and combines them. Returns combine_chunks' paths.
+    """
+    with ProcessPoolExecutor(max_workers=min(n_procs, n_chunks)) as executor:
+        futures = [executor.submit(run_chunk, in_file, mask_file, out_prefix, chunk, n_perm, n_chunks, seed, tfce) for chunk in range(n_chunks)]
+        prefixes = [future.result() for future in futures]
+
+    return combine_chunks(prefixes, mask_file, out_prefix, stat_name="tfce" if tfce else "vox")
+
+
+def randomise_chunk_node_func(in_file: str, mask_file: str, out_name: str, chunk: int, n_perm: int, n_chunks: int, seed: int = 0, tfce: bool = True):
+    """
+    Node function, runs one permutation chunk in the node directory. Returns its output prefix (None if empty).
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    from parallel import run_chunk
+    from common.instrument import measure
+
+    with measure("randomise_chunk", out_name=out_name, chunk=chunk):
+        return run_chunk(in_file, mask_file, os.path.join(os.getcwd(), out_name), chunk, n_perm, n_chunks, seed, tfce)
+
+
+def combine_node_func(prefixes: list, mask_file: str, out_name: str, tfce: bool = True):
+    """
+    Join node function, merges the chunks of one test in the node directory.
+    Returns (tstat_files, p_files, corrected_p_files).
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    from parallel import combine_chunks
+
+    stat_name = "tfce" if tfce else "vox"
+    paths = combine_chunks(prefixes, mask_file, os.path.join(os.getcwd(), out_name), stat_name=stat_name)
+
+    return [paths["tstat1"]], [paths[f"{stat_name}_p_tstat1"]], [paths[f"{stat_name}_corrp_tstat1"]]
+
+
+parser = argparse.ArgumentParser(description="Run one randomise test as seeded permutation chunks in a process pool")
+parser.add_argument("--in_file", type=str, required=True, help="Merged 4D image (merge.py)")
+parser.add_argument("--mask", type=str, required=True, help="Mask")
+parser.add_argument("--out_prefix", type=str, required=True, help="Output prefix (chunk outputs: <out_prefix>_chunkNNN*)")
+parser.add_argument("--n_perm", type=int, default=5000, help="Permutations in total")
+parser.add_argument("--n_chunks", type=int, default=DEFAULT_N_CHUNKS, help="Permutation chunks")
+parser.add_argument("--n_procs", type=int, default=DEFAULT_N_CHUNKS, help="Processes")
+parser.add_argument("--seed", type=int, default=0, help="Seed of chunk 0 (chunk i: seed + i)")
+parser.add_argument("--no_tfce", action="store_true", help="Voxelwise correction (-x) instead of TFCE (-T)")
+
+if __name__ == "__main__":
+    import sys
+
+    # shared modules (common/)
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_prefix)), exist_ok=True)
+
+    start_time = time.time()
+    paths = run_parallel(args.in_file, args.mask, args.out_prefix, args.n_perm, args.n_chunks, args.n_procs, args.seed, not args.no_tfce)
+
+    print(f"{args.n_chunks} chunks of {args.in_file} combined in {time.time() - start_time:.1f} seconds:")
+    for path in paths.values():
+        print(f"  {path}")
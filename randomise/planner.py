@@ -0,0 +1,187 @@
+"""
+Randomise planner: the merge groups of the group-level analysis, from the FEAT
+datasink manifest.
+
+One merge group per task, session, run, contrast and registration type (FLIRT on
+the LN FEAT runs, FNIRT on the NL FEAT runs), with the subjects ordered by id and
+the input zfstat and affine (example_func2standard.mat) of each subject. Only the
+files that exist are looked at (one filter over the manifest), instead of
+formatting paths for every subject x run x task x contrast x session and probing
+the file system for each.
+
+Usage:
+    groups = plan_merge_groups(datasink_dir)
+    write_batch_plan(groups, opj(working_dir, "randomise_plan.json"))
+"""
+import json
+import os
+from os.path import join as opj
+from typing import NamedTuple
+
+AFFINE_PATH = "reg/example_func2standard.mat"
+
+# registration type -> FEAT variant its inputs come from
+REGISTRATION_VARIANTS = {
+    "flirt": "LN",
+    "fnirt": "NL",
+}
+
+
+class MergeGroup(NamedTuple):
+    name: str
+    task: str
+    session: str
+    run: int
+    contrast: int
+    registration: str
+    subject_ids: list
+    in_files: list
+    affine_files: list
+    # registered zfstat written by the roi stage (zfstatN_LN/NL.nii.gz), None if not registered yet
+    registered_files: list
+
+
+def group_name(task: str, session: str, run: int, contrast: int, registration: str) -> str:
+    """
+    Ex: zfstat1_task-sst_ses-baselineYear1Arm1_run-01_flirt
+    """
+    return f"zfstat{contrast}_task-{task}_ses-{session}_run-{run:02d}_{registration}"
+
+
+def _zfstat_rows(manifest):
+    import pandas as pd
+
+    # match on the (few) distinct paths, not on every row
+    paths = manifest["path"].astype("category")
+    categories = pd.Series(paths.cat.categories.astype(str))
+
+    contrasts = categories.str.extract(r"^stats/zfstat(\d+)\.nii\.gz$")[0]
+    is_zfstat = contrasts.notna().to_numpy()[paths.cat.codes.to_numpy()]
+
+    zfstats = manifest[is_zfstat].copy()
+    zfstats["contrast"] = contrasts.to_numpy()[paths.cat.codes.to_numpy()[is_zfstat]].astype(int)
+
+    return zfstats
+
+
+def plan_merge_groups(datasink_dir: str, contrasts: list = None, sessions: list = None, tasks: list = None, runs: list = None,
+                      registrations: list = None, manifest=None, verbose: bool = True) -> list:
+    """
+    Returns the merge groups (sorted by name) of the FEAT datasink.
+
+    contrasts, sessions, tasks, runs: only plan these (default: all in the datasink)
+    registrations: subset of REGISTRATION_VARIANTS (default: all)
+    manifest: datasink manifest (DataFrame), refreshed with the new FEAT directories (built if missing) if not given
+
+    Subjects without an affine file are left out of the group.
+    """
+    if manifest is None:
+        from common.manifest import refresh_manifest
+
+        manifest = refresh_manifest(datasink_dir)
+
+    registrations = list(REGISTRATION_VARIANTS) if registrations is None else registrations
+    for registration in registrations:
+        if registration not in REGISTRATION_VARIANTS:
+            raise ValueError(f"Unknown registration {registration}, expected one of {list(REGISTRATION_VARIANTS)}")
+
+    feat_dirs = manifest["feat_dir"].astype(str)
+    paths = manifest["path"].astype(str)
+
+    with_affine = set(feat_dirs[paths == AFFINE_PATH])
+
+    zfstats = _zfstat_rows(manifest)
+    zfstats["feat_dir"] = zfstats["feat_dir"].astype(str)
+    for column in ["subject_id", "session", "task", "variant"]:
+        zfstats[column] = zfstats[column].astype(str)
+
+    for column, values in [("contrast", contrasts), ("session", sessions), ("task", tasks), ("run", runs)]:
+        if values is not None:
+            zfstats = zfstats[zfstats[column].isin(values)]
+
+    missing_affine = ~zfstats["feat_dir"].isin(with_affine)
+    if verbose and missing_affine.any():
+        print(f"WARN: {missing_affine.sum()} zfstats without {AFFINE_PATH} are left out ({zfstats[missing_affine]['feat_dir'].nunique()} FEAT directories)")
+    zfstats = zfstats[~missing_affine]
+
+    existing = set(zip(feat_dirs, paths))
+
+    groups = []
+    for registration in registrations:
+        variant = REGISTRATION_VARIANTS[registration]
+        rows = zfstats[zfstats["variant"] == variant].sort_values(["task", "session", "run", "contrast", "subject_id"])
+
+        for (task, session, run, contrast), group in rows.groupby(["task", "session", "run", "contrast"], sort=False):
+            feat_dir_paths = [opj(datasink_dir, feat_dir) for feat_dir in group["feat_dir"]]
+            registered_name = f"stats/zfstat{contrast}_{variant}.nii.gz"
+
+            groups.append(MergeGroup(
+                name=group_name(task, session, int(run), int(contrast), registration),
+                task=task,
+                session=session,
+                run=int(run),
+                contrast=int(contrast),
+                registration=registration,
+                subject_ids=list(group["subject_id"]),
+                in_files=[opj(feat_dir_path, path) for feat_dir_path, path in zip(feat_dir_paths, group["path"].astype(str))],
+                affine_files=[opj(feat_dir_path, AFFINE_PATH) for feat_dir_path in feat_dir_paths],
+                registered_files=[opj(feat_dir_path, registered_name) if (feat_dir, registered_name) in existing else None
+                                  for feat_dir_path, feat_dir in zip(feat_dir_paths, group["feat_dir"])],
+            ))
+
+    return sorted(groups, key=lambda group: group.name)
+
+
+def print_groups(groups: list):
+    """
+    Prints a summary of the merge groups.
+    """
+    for registration in REGISTRATION_VARIANTS:
+        registration_groups = [group for group in groups if group.registration == registration]
+        if not registration_groups:
+            continue
+
+        n_subjects = [len(group.subject_ids) for group in registration_groups]
+        n_registered = sum([len([path for path in group.registered_files if path is not None]) for group in registration_groups])
+
+        print(f"{registration.upper()}: {len(registration_groups)} merge groups, {min(n_subjects)}-{max(n_subjects)} subjects each, "
+              f"{sum(n_subjects)} inputs ({n_registered} already registered)")
+
+    for group in groups[:4]:
+        print(f"  {group.name}: {len(group.subject_ids)} subjects, ex: {group.in_files[:1]}")
+    if len(groups) > 4:
+        print("  ...")
+
+
+def write_batch_plan(groups: list, path: str):
+    """
+    Writes the merge groups as JSON (read by select_group_files and load_batch_plan).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        json.dump([group._asdict() for group in groups], file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def load_batch_plan(path: str) -> list:
+    """
+    Returns the merge groups of a batch plan written by write_batch_plan.
+    """
+    with open(path, "r") as file:
+        return [MergeGroup(**group) for group in json.load(file)]
+
+
+def select_group_files(plan_path: str, group_name: str):
+    """
+    Node function, returns (subject_ids, in_files, affine_files) of one merge group of a batch plan.
+    """
+    import json # dynamic imports because nipype executes functions in separate context
+
+    with open(plan_path, "r") as file:
+        groups = {group["name"]: group for group in json.load(file)}
+
+    group = groups[group_name]
+
+    return group["subject_ids"], group["in_files"], group["affine_files"]
@@ -0,0 +1,92 @@
+"""
+Storage of the ROI activation tables (make_csv_node_func): the averaged table
+(avg per ROI) and the voxel-level --no-avg table (roi_value, x/y/z per voxel).
+
+The default format is a Parquet dataset partitioned by session and image
+(<name>/session=.../image_name=.../*.parquet): the repeated strings (subject_id,
+zfstat_path) are dictionary encoded, ROI numbers, runs and coordinates are small
+integers and activations float32, so reading is a columnar scan that can skip
+partitions and columns. CSV is still available (output_format="csv").
+
+Usage:
+    save_path = write_activations(flattened_df, os.getcwd(), output_format="parquet")      # .../roi_activations (directory)
+    activations = read_activations_table(save_path, columns=["avg", "roi_num", "subject_id"], filters=[("session", "==", "baselineYear1Arm1")])
+"""
+import os
+import shutil
+
+import pandas as pd
+
+TABLE_NAME = "roi_activations"
+
+OUTPUT_FORMATS = ["parquet", "csv"]
+
+PARTITION_COLUMNS = ["session", "image_name"]
+
+# compact dtypes of the columns (only those present are converted)
+DTYPES = {
+    "subject_id": "category",
+    "session": "category",
+    "image_name": "category",
+    "zfstat_path": "category",
+    "roi_num": "int8",
+    "run": "int8",
+    "is_nonlinear": "bool",
+    "avg": "float32",
+    "roi_value": "float32",
+    "x_coord": "int16",
+    "y_coord": "int16",
+    "z_coord": "int16",
+}
+
+
+def compact(activations: pd.DataFrame) -> pd.DataFrame:
+    return activations.astype({column: dtype for column, dtype in DTYPES.items() if column in activations.columns})
+
+
+def write_activations(activations: pd.DataFrame, out_dir: str, output_format: str = "parquet", name: str = TABLE_NAME) -> str:
+    """
+    Writes the activation table to out_dir as <name>.csv or the Parquet dataset <name>/
+    (replaced as a whole, never a partial dataset). Returns its path.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format {output_format}, expected one of {OUTPUT_FORMATS}")
+
+    if output_format == "csv":
+        save_path = os.path.join(out_dir, f"{name}.csv")
+        activations.to_csv(save_path, index=False)
+        return save_path
+
+    save_path = os.path.join(out_dir, name)
+    tmp_path = f"{save_path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    compact(activations).to_parquet(tmp_path, engine="pyarrow", partition_cols=PARTITION_COLUMNS, compression="zstd", index=False)
+
+    shutil.rmtree(save_path, ignore_errors=True)
+    os.replace(tmp_path, save_path)
+
+    return save_path
+
+
+def read_activations_table(path: str, columns: list = None, filters: list = None) -> pd.DataFrame:
+    """
+    Returns an activation table written by write_activations (Parquet dataset directory or .csv).
+    columns: only these columns; filters: pyarrow filters, ex: [("session", "==", "baselineYear1Arm1")]
+    (partition filters skip the other partitions' files)
+    """
+    if os.path.isdir(path):
+        activations = pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters)
+        # partition columns come back as categories of strings
+        return activations.astype({column: "category" for column in PARTITION_COLUMNS if column in activations.columns})
+
+    activations = pd.read_csv(path, usecols=columns)
+    for column, operator, value in filters or []:
+        if operator == "==":
+            activations = activations[activations[column] == value]
+        elif operator == "in":
+            activations = activations[activations[column].isin(value)]
+        else:
+            raise ValueError(f"Unsupported csv filter operator {operator}, expected == or in")
+
+    return compact(activations)
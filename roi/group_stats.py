@@ -0,0 +1,181 @@
+"""
+ROI group statistics from the extracted ROI activations (roi_activations table of
+main.py, Parquet dataset or csv: one row per ROI x image x run x subject), without voxelwise randomise.
+
+For each registration (LN/NL) and session, the runs of a subject are averaged and
+the subjects make a subjects x (image x ROI) matrix (6 images x 11 ROIs = 66
+tests). Each test of a design (one-sample mean, and the contrasts of a covariate
+design, common/design.py) is a sign-flip permutation test of all 66 columns at
+once (common/permutation.py): the permutations are batched matrix products, and
+the FWE corrected p of a test is against the maximum t over the 66 ROI x image
+tests of each permutation.
+
+Results (one row per registration x session x test x image x ROI):
+    registration, session, test, image_name, roi_num, n_subjects, effect, t, dof, p, p_fwe, n_perm
+
+Usage:
+    python group_stats.py --table roi_activations --out_file roi_group_stats.csv [--n_perm 5000] \
+        [--tsv ../subjects/tsv/pilot_anx_cases.tsv --formula "1 + cbcl_scr_syn_anxdep_t" --contrast anx_pos=cbcl_scr_syn_anxdep_t]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# shared modules (common/)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from activation_table import read_activations_table
+from common.design import Design, build_design, parse_contrasts, read_subjects_table
+from common.permutation import permutation_test
+
+DEFAULT_N_PERM = 5000
+
+# name of the one-sample test (mean activation different from 0)
+MEAN_TEST = "mean"
+
+RESULT_COLUMNS = ["registration", "session", "test", "image_name", "roi_num", "n_subjects", "effect", "t", "dof", "p", "p_fwe", "n_perm"]
+
+
+def read_activations(table_path: str) -> pd.DataFrame:
+    """
+    Returns the ROI activations (make_csv_node_func's table, averaged ROIs) with the runs of each
+    subject averaged: registration, session, subject_id, image_name, roi_num, avg, n_runs.
+    """
+    columns = ["avg", "roi_num", "subject_id", "run", "image_name", "is_nonlinear", "session"]
+    try:
+        activations = read_activations_table(table_path, columns=columns)
+    except (KeyError, ValueError) as error:
+        raise ValueError(f"{table_path} is not an averaged ROI table (made with --no-avg?), expected columns {columns}") from error
+
+    activations = activations.astype({"subject_id": str, "image_name": str, "session": str, "avg": "float64"})
+
+    activations["registration"] = np.where(activations["is_nonlinear"].astype(str) == "True", "NL", "LN")
+
+    keys = ["registration", "session", "subject_id", "image_name", "roi_num"]
+    return activations.groupby(keys, sort=True, observed=True)["avg"].agg(avg="mean", n_runs="size").reset_index()
+
+
+def activation_matrix(activations: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the subjects x (image_name, roi_num) matrix of one registration and session.
+    Subjects without all images and ROIs are left out.
+    """
+    matrix = activations.pivot(index="subject_id", columns=["image_name", "roi_num"], values="avg").sort_index(axis=1)
+
+    incomplete = matrix.isna().any(axis=1)
+    if incomplete.any():
+        print(f"WARN: {incomplete.sum()} subjects without all {matrix.shape[1]} image x ROI activations are left out")
+
+    return matrix[~incomplete]
+
+
+def one_sample_design(subject_ids: list) -> Design:
+    return Design(X=np.ones((len(subject_ids), 1)), columns=["intercept"], contrasts=np.ones((1, 1)), contrast_names=[MEAN_TEST],
+                  groups=np.ones(len(subject_ids), dtype=int), subject_ids=list(subject_ids), formula="1")
+
+
+def test_matrix(matrix: pd.DataFrame, design: Design, n_perm: int = DEFAULT_N_PERM, seed: int = 0) -> pd.DataFrame:
+    """
+    Returns the results of every contrast of design on every column of matrix (rows: design.subject_ids).
+    """
+    Y = matrix.loc[design.subject_ids].to_numpy(dtype=np.float32)
+    pinv_X = np.linalg.pinv(design.X)
+
+    results = []
+    for name, contrast in zip(design.contrast_names, design.contrasts):
+        result = permutation_test(Y, design.X, contrast, n_perm=n_perm, seed=seed)
+
+        results.append(pd.DataFrame({
+            "test": name,
+            "image_name": matrix.columns.get_level_values("image_name"),
+            "roi_num": matrix.columns.get_level_values("roi_num"),
+            "n_subjects": len(design.subject_ids),
+            "effect": contrast @ pinv_X @ Y,
+            "t": result["t"],
+            "dof": len(design.subject_ids) - np.linalg.matrix_rank(design.X),
+            "p": result["p"],
+            "p_fwe": result["corrp"],
+            "n_perm": result["n_perm"],
+        }))
+
+    return pd.concat(results, ignore_index=True)
+
+
+def group_stats(activations: pd.DataFrame, subjects_table: pd.DataFrame = None, formula: str = None, contrasts=None,
+                n_perm: int = DEFAULT_N_PERM, seed: int = 0) -> pd.DataFrame:
+    """
+    Returns the results table (RESULT_COLUMNS) of the one-sample test and, given a subjects table
+    (common.design.read_subjects_table), a formula and contrasts, of the covariate design,
+    for every registration and session of the activations (read_activations).
+    """
+    results = []
+    for (registration, session), split in activations.groupby(["registration", "session"], sort=True):
+        print(f"{registration} {session}:")
+        matrix = activation_matrix(split)
+        if len(matrix) < 2:
+            print(f"WARN: {len(matrix)} subjects, no tests for {registration} {session}")
+            continue
+
+        designs = [one_sample_design(matrix.index)]
+        if formula is not None:
+            designs.append(build_design(subjects_table, formula, contrasts, subject_ids=list(matrix.index)))
+
+        for design in designs:
+            split_results = test_matrix(matrix, design, n_perm=n_perm, seed=seed)
+            split_results.insert(0, "session", session)
+            split_results.insert(0, "registration", registration)
+            results.append(split_results)
+
+            print(f"  {design.formula}: {len(design.subject_ids)} subjects, {len(split_results)} tests, "
+                  f"{(split_results['p_fwe'] < 0.05).sum()} with p_fwe < 0.05")
+
+    if not results:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+
+    return pd.concat(results, ignore_index=True)[RESULT_COLUMNS]
+
+
+def group_stats_node_func(table_path: str, n_perm: int = 5000, seed: int = 0):
+    """
+    Node function, one-sample ROI group statistics of the ROI table. Returns the results csv (node directory).
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    from group_stats import group_stats, read_activations
+
+    save_path = os.path.join(os.getcwd(), "roi_group_stats.csv")
+    group_stats(read_activations(table_path), n_perm=n_perm, seed=seed).to_csv(save_path, index=False)
+
+    return save_path
+
+
+parser = argparse.ArgumentParser(description="ROI group statistics (permutation tests, FWE over the ROI x image tests) from the ROI activations table")
+parser.add_argument("--table", type=str, required=True, help="ROI activations table (main.py's roi_activations dataset directory or .csv)")
+parser.add_argument("--out_file", type=str, required=True, help="Results csv")
+parser.add_argument("--n_perm", type=int, default=DEFAULT_N_PERM, help="Permutations per test")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the sign flips")
+parser.add_argument("--tsv", type=str, default=None, help="Subjects table of a covariate design (.tsv/.csv)")
+parser.add_argument("--id_column", type=str, default="src_subject_id", help="Subject id column of the subjects table")
+parser.add_argument("--formula", type=str, default=None, help='Covariate design, ex: "1 + cbcl_scr_syn_anxdep_t"')
+parser.add_argument("--contrast", type=str, action="append", default=[], help="[name=]expression of the covariate design, repeatable")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if (args.formula is None) != (args.tsv is None) or (args.formula is not None and not args.contrast):
+        parser.error("a covariate design needs --tsv, --formula and at least one --contrast")
+
+    start_time = time.time()
+
+    subjects_table = read_subjects_table(args.tsv, id_column=args.id_column) if args.tsv is not None else None
+    results = group_stats(read_activations(args.table), subjects_table, args.formula, parse_contrasts(args.contrast),
+                          n_perm=args.n_perm, seed=args.seed)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_file)), exist_ok=True)
+    results.to_csv(args.out_file, index=False)
+
+    print(f"Wrote {len(results)} results to {args.out_file} in {time.time() - start_time:.1f} seconds")
@@ -1,59 +1,275 @@
 import os
 import time
-import nipype.interfaces.fsl as fsl
-from nipype import Node, Workflow, MapNode, IdentityInterface, JoinNode
-from nipype.interfaces.utility import Function
-from nipype.interfaces.io import DataSink
 import utils
 import constants
 from os.path import join as opj
 
-itersource = Node(interface=IdentityInterface(fields=['zfstat_path', 'affine_file', "subject_id", "run", "image_name", "session"]),
-                  name="itersource")
-itersource.synchronize = True # To avoid all permutations of the lists being run
+# shared modules (common/), also needed by the Function nodes in the worker processes
+os.sys.path.append(constants.PIPELINE_BASE_DIR)
 
-# rois = range(1, 12) # 11 ROIs, numbered 1-11
+# nipype is only imported when the workflow is built, --plan only lists the inputs and outputs
 
-# rois_itersource = Node(interface=IdentityInterface(fields=['roi_num']), name="rois_itersource")
-# rois_itersource.iterables = [("roi_num", rois)]
+roi_extract_overwrite = False
 
-# custom_flirt_node = Node(Function(input_names=['in_file', 'in_matrix_file'], output_names=['out_file', ]), name="custom_flirt")
 
-# dummy_fnirt_node = Node(Function(input_names=['in_file', 'affine_file', 'mni_template', 'subject_id', 'run', 'image_name'], output_names=["warped_file"], function=utils.dummy_fnirt), name="dummy_fnirt")
-# dummy_fnirt_node.inputs.mni_template = constants.MNI_TEMPLATE_SKULL
+def plan_registrations(zfstat_paths: list, nonlinear_iterables: list, force_run_iterables: list):
+    """
+    Prints how many registrations (FLIRT/FNIRT) would run and how many outputs
+    (zfstatN_LN/NL.nii.gz next to the zfstat) already exist and would be reused.
+    """
+    for i, is_nonlinear in enumerate(nonlinear_iterables):
+        name = "NL" if is_nonlinear else "LN"
+        out_paths = [zfstat_path.replace(".nii.gz", f"_{name}.nii.gz") for zfstat_path in zfstat_paths]
+        n_cached = 0 if force_run_iterables[i] else sum([os.path.exists(out_path) for out_path in out_paths])
 
-# fnirt_node = Node(fsl.FNIRT(ref_file=constants.MNI_TEMPLATE, output_type='NIFTI_GZ'), name="fnirt")
+        print(f"{'FNIRT' if is_nonlinear else 'FLIRT'}: {len(out_paths)} registrations, {n_cached} already done, {len(out_paths) - n_cached} to run")
+        print(f"expected outputs: {out_paths[:2]}{' ...' if len(out_paths) > 2 else ''}")
 
 
-# print("WARN: no affine file is being used for custom_fnirt_node for testing purposes")
-# custom_fnirt_node = Node(Function(input_names=['in_file', 'affine_file', 'mni_template', 'force_run', 'no_affine'], output_names=["warped_file"], function=utils.custom_fnirt), name="custom_fnirt")
-# custom_fnirt_node.inputs.mni_template = constants.MNI_TEMPLATE_SKULL
+def aggregate_table_path(datasink_dir: str, save_dirname: str, output_format: str) -> str:
+    """
+    Returns the path of the ROI table in the datasink (as DataSink copies make_csv_node_func's output).
+    """
+    return opj(datasink_dir, save_dirname, "roi_activations.csv" if output_format == "csv" else "roi_activations")
 
-registration_node = Node(Function(input_names=['nonlinear', 'in_file', 'affine_file', 'mni_template', 'force_run', 'no_affine'], output_names=["out_file", "nonlinear"], function=utils.registration_node_func), name="registration")
-registration_node.synchronize = True
 
-# roi_extract_node = Node(Function(input_names=['input_nifti', 'roi_num', 'mask_file_path'], output_names=["roi_values", "zfstat_path", "roi_num"], function=utils.roi_extract_node_func), name="roi_extract", overwrite=True)
-# roi_extract_node.inputs.mask_file_path = constants.MASK_FILE_PATH
+def plan_incremental(zfstat_paths: list, nonlinear_iterables: list, aggregate_path: str):
+    """
+    Returns the units (subject, session, run, image, LN/NL) of the zfstats that are not in the
+    aggregate ROI table yet or whose zfstat changed (common/incremental.py), as a list of dicts.
+    """
+    import pandas as pd
+    from common.incremental import ROI_UNIT_COLUMNS, plan_units
 
-# avg_node = Node(Function(input_names=['roi_values', "zfstat_path", 'roi_num'], output_names=["dict"], function=utils.average_roi_values_node_func), name="avg")
+    candidates = pd.DataFrame([{
+        "subject_id": utils.get_subject_id_from_zfstat_path(zfstat_path),
+        "session": utils.get_session_from_zfstat_path(zfstat_path),
+        "run": utils.get_run_from_zfstat_path(zfstat_path),
+        "image_name": utils.get_image_name_from_zfstat_path(zfstat_path),
+        "is_nonlinear": is_nonlinear,
+        "source": zfstat_path,
+    } for zfstat_path in zfstat_paths for is_nonlinear in nonlinear_iterables], columns=ROI_UNIT_COLUMNS + ["source"])
 
-# first_join_node = JoinNode(Function(input_names=["dict"], output_names=["dict"], function=utils.join), name="first_join", joinsource="rois_itersource", joinfield=["dict"])
+    return plan_units(candidates, aggregate_path, ROI_UNIT_COLUMNS).to_dict("records")
 
-roi_extract_overwrite = False
 
-# roi extract function that also creates dicts with all of the metadata needed
-roi_extract_all_node = Node(Function(input_names=['input_nifti', 'mask_file_path', 'is_test_run', 'no_avg'], output_names=["roi_dicts"], function=utils.roi_extract_all_node_func), name="roi_extract_all", overwrite=roi_extract_overwrite)
-roi_extract_all_node.inputs.mask_file_path = constants.MASK_FILE_PATH
+def run_stream(zfstat_paths: list, affine_files: list, registration_iterables: list, is_test_run: bool, is_no_avg: bool,
+               save_path: str, scratch_dir: str, n_register: int, n_extract: int) -> list:
+    """
+    Streaming mode (--stream): registers and extracts every zfstat x registration in two process pools
+    (common/streaming.py) instead of the workflow, the rows are written to the ROI table save_path
+    (dataset directory or .csv) as they come. Returns the failed units.
+    """
+    from activation_table import PARTITION_COLUMNS, compact
+    from common.streaming import ShardWriter, stream
+
+    # (nonlinear, force_run, mni_template) of each registration, synchronized as the registration node's iterables
+    registrations = list(zip(*[values for _, values in registration_iterables]))
+
+    units = [{
+        "zfstat_path": zfstat_path,
+        "affine_file": affine_file,
+        "nonlinear": nonlinear,
+        "force_run": force_run,
+        "mni_template": mni_template,
+        "scratch_dir": scratch_dir,
+        "mask_file_path": constants.MASK_FILE_PATH,
+        "is_test_run": is_test_run,
+        "no_avg": is_no_avg,
+        "subject_id": utils.get_subject_id_from_zfstat_path(zfstat_path),
+        "run": utils.get_run_from_zfstat_path(zfstat_path),
+        "image_name": utils.get_image_name_from_zfstat_path(zfstat_path),
+        "session": utils.get_session_from_zfstat_path(zfstat_path),
+    } for zfstat_path, affine_file in zip(zfstat_paths, affine_files) for nonlinear, force_run, mni_template in registrations]
+
+    is_csv = save_path.endswith(".csv")
+    writer = ShardWriter(save_path, partition_cols=None if is_csv else PARTITION_COLUMNS, transform=None if is_csv else compact)
+
+    failures = stream(units, utils.stream_register_func, utils.stream_extract_func, lambda unit, rows: writer.add(rows),
+                      n_producers=n_register, n_consumers=n_extract)
+    writer.close()
+
+    return failures
+
+
+def build_workflow(workingdir: str, datasink_dir: str, zfstat_paths: list, affine_files: list, registration_iterables: list,
+                   is_test_run: bool, is_no_avg: bool, save_dirname: str, group_stats_n_perm: int = None,
+                   output_format: str = "parquet", array_store_dir: str = None, incremental_units: list = None):
+    """
+    Builds the ROI extraction workflow, writing the ROI table as output_format ("parquet" or "csv",
+    activation_table.py). With group_stats_n_perm, also the one-sample ROI
+    group statistics of the table (group_stats.py) with that many permutations.
+    With array_store_dir, the voxel values of every ROI are written to the array store
+    (common/array_store.py) by the extraction nodes instead of a table.
+    With incremental_units (units to compute, common/incremental.py), the table of the zfstats
+    given is merged into the aggregate table of the datasink instead of replacing it.
+    """
+    from nipype import Node, Workflow, MapNode, IdentityInterface, JoinNode
+    from nipype.interfaces.utility import Function
+    from nipype.interfaces.io import DataSink
+
+    itersource = Node(interface=IdentityInterface(fields=['zfstat_path', 'affine_file', "subject_id", "run", "image_name", "session"]),
+                      name="itersource")
+    itersource.synchronize = True # To avoid all permutations of the lists being run
+
+    # rois = range(1, 12) # 11 ROIs, numbered 1-11
+
+    # rois_itersource = Node(interface=IdentityInterface(fields=['roi_num']), name="rois_itersource")
+    # rois_itersource.iterables = [("roi_num", rois)]
+
+    # custom_flirt_node = Node(Function(input_names=['in_file', 'in_matrix_file'], output_names=['out_file', ]), name="custom_flirt")
+
+    # dummy_fnirt_node = Node(Function(input_names=['in_file', 'affine_file', 'mni_template', 'subject_id', 'run', 'image_name'], output_names=["warped_file"], function=utils.dummy_fnirt), name="dummy_fnirt")
+    # dummy_fnirt_node.inputs.mni_template = constants.MNI_TEMPLATE_SKULL
+
+    # fnirt_node = Node(fsl.FNIRT(ref_file=constants.MNI_TEMPLATE, output_type='NIFTI_GZ'), name="fnirt")
+
+
+    # print("WARN: no affine file is being used for custom_fnirt_node for testing purposes")
+    # custom_fnirt_node = Node(Function(input_names=['in_file', 'affine_file', 'mni_template', 'force_run', 'no_affine'], output_names=["warped_file"], function=utils.custom_fnirt), name="custom_fnirt")
+    # custom_fnirt_node.inputs.mni_template = constants.MNI_TEMPLATE_SKULL
+
+    registration_node = Node(Function(input_names=['nonlinear', 'in_file', 'affine_file', 'mni_template', 'force_run', 'no_affine'], output_names=["out_file", "nonlinear"], function=utils.registration_node_func), name="registration")
+    registration_node.synchronize = True
+
+    # roi_extract_node = Node(Function(input_names=['input_nifti', 'roi_num', 'mask_file_path'], output_names=["roi_values", "zfstat_path", "roi_num"], function=utils.roi_extract_node_func), name="roi_extract", overwrite=True)
+    # roi_extract_node.inputs.mask_file_path = constants.MASK_FILE_PATH
+
+    # avg_node = Node(Function(input_names=['roi_values', "zfstat_path", 'roi_num'], output_names=["dict"], function=utils.average_roi_values_node_func), name="avg")
+
+    # first_join_node = JoinNode(Function(input_names=["dict"], output_names=["dict"], function=utils.join), name="first_join", joinsource="rois_itersource", joinfield=["dict"])
+
+    # roi extract function that also creates dicts with all of the metadata needed
+    roi_extract_all_node = Node(Function(input_names=['input_nifti', 'mask_file_path', 'is_test_run', 'no_avg'], output_names=["roi_dicts"], function=utils.roi_extract_all_node_func), name="roi_extract_all", overwrite=roi_extract_overwrite)
+    roi_extract_all_node.inputs.mask_file_path = constants.MASK_FILE_PATH
+
+    avg_all_node = Node(Function(input_names=['roi_dicts'], output_names=["avg_dicts"], function=utils.average_each_roi_values_node_func), name="avg_all")
+
+    add_metadata_node = Node(Function(input_names=["dicts", "subject_id", "run", "image_name", "is_nonlinear", "session"], output_names=["dicts_with_metadata"], function=utils.add_metadata_node_func), name="add_metadata")
+
+    join_all_node = JoinNode(Function(input_names=["joined_dicts"], output_names=["flattened"], function=utils.join_main), name="join_all", joinsource="itersource", joinfield=["joined_dicts"])
+
+    make_csv_node = Node(Function(input_names=["flattened", "output_format"], output_names=["save_path"], function=utils.make_csv_node_func), name="make_csv")
+    make_csv_node.inputs.output_format = output_format
+
+    datasink = Node(DataSink(), name="datasink")
+
+    roi_extract_all_node.inputs.no_avg = is_no_avg
+    roi_extract_all_node.inputs.is_test_run = is_test_run
+
+    registration_node.iterables = registration_iterables
+
+    datasink.inputs.base_directory = datasink_dir
+
+    subject_ids = [utils.get_subject_id_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
+    runs = [utils.get_run_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
+    image_names = [utils.get_image_name_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
+    sessions = [utils.get_session_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
+
+    # set iterables
+    itersource.iterables = [("zfstat_path", zfstat_paths), ("affine_file", affine_files), ("subject_id", subject_ids), ("run", runs), ("image_name", image_names), ("session", sessions)]
+
+    roi_extract_workflow = Workflow(name="roi_extract_workflow", base_dir=workingdir)
+
+    ###### Connect nodes
+
+    # Use a 'dummy' fnirt node if the '--no-fnirt' argument is passed (for easier testing without fnirt)
+    # if "--no-fnirt" in os.sys.argv:
+    #     roi_extract_workflow.connect([(itersource, dummy_fnirt_node, [("affine_file", "affine_file"),
+    #                                                                 ("zfstat_path", "in_file"),
+    #                                                                 ("subject_id", "subject_id"),
+    #                                                                 ("run", "run"),
+    #                                                                 ("image_name", "image_name")]),
+    #                                     (dummy_fnirt_node, roi_extract_all_node, [("warped_file", "input_nifti")]),
+    #                                     # (dummy_fnirt_node, datasink, [("warped_file", "fnirt.@warped")]),
+    #     ])
+    # else:
+    #     roi_extract_workflow.connect([(itersource, custom_fnirt_node, [("affine_file", "affine_file"),
+    #                                                                 ("zfstat_path", "in_file"),
+    #                                                                 ("subject_id", "subject_id"),
+    #                                                                 ("run", "run"),
+    #                                                                 ("image_name", "image_name")]),
+    #                                     (custom_fnirt_node, roi_extract_all_node, [("warped_file", "input_nifti")]),
+    #                                     # (custom_fnirt_node, datasink, [("warped_file", "fnirt.@warped")]),
+    #     ])
+
+    if array_store_dir is not None:
+        from common.array_store import store_index_node_func
+
+        roi_store_node = Node(Function(input_names=["input_nifti", "store_dir", "mask_file_path", "subject_id", "run", "image_name", "session", "is_nonlinear"],
+                                       output_names=["key"], function=utils.roi_store_node_func), name="roi_store")
+        roi_store_node.inputs.store_dir = array_store_dir
+        roi_store_node.inputs.mask_file_path = constants.MASK_FILE_PATH
+
+        store_index_node = JoinNode(Function(input_names=["keys", "store_dir"], output_names=["store_dir", "index_path"], function=store_index_node_func),
+                                    name="store_index", joinsource="itersource", joinfield=["keys"])
+        store_index_node.inputs.store_dir = array_store_dir
+
+        roi_extract_workflow.connect([(itersource, registration_node, [("affine_file", "affine_file"),
+                                                                        ("zfstat_path", "in_file"),]),
+                                      (registration_node, roi_store_node, [("out_file", "input_nifti"),
+                                                                           ("nonlinear", "is_nonlinear")]),
+                                      (itersource, roi_store_node, [("subject_id", "subject_id"),
+                                                                    ("run", "run"),
+                                                                    ("image_name", "image_name"),
+                                                                    ("session", "session")]),
+                                      (roi_store_node, store_index_node, [("key", "keys")]),
+            ])
+
+        roi_extract_workflow.config["execution"]["crashdump_dir"] = opj(workingdir, "crash")
+
+        return roi_extract_workflow
+
+    if is_no_avg:
+        roi_extract_workflow.connect([
+            (roi_extract_all_node, add_metadata_node, [("roi_dicts", "dicts")])
+            ])
+    else:
+        roi_extract_workflow.connect([
+            (roi_extract_all_node, avg_all_node, [("roi_dicts", "roi_dicts")]),
+            (avg_all_node, add_metadata_node, [("avg_dicts", "avg_dicts")])
+            ])
+
+    # connect all nodes
+    roi_extract_workflow.connect([(itersource, registration_node, [("affine_file", "affine_file"),
+                                                                    ("zfstat_path", "in_file"),]),
+                                        (registration_node, roi_extract_all_node, [("out_file", "input_nifti")]),
+                                        (registration_node, add_metadata_node, [("nonlinear", "is_nonlinear")]),
+                                    (itersource, add_metadata_node, [("subject_id", "subject_id"),
+                                                                    ("run", "run"),
+                                                                    ("image_name", "image_name"),
+                                                                    ("session", "session")]),
+                                    (add_metadata_node, join_all_node, [("dicts_with_metadata", "joined_dicts")]),
+                                    (join_all_node, make_csv_node, [("flattened", "flattened")]),
+        ])
+
+    # node and output of the complete ROI table
+    table_node, table_field = make_csv_node, "save_path"
+
+    if incremental_units is not None:
+        merge_table_node = Node(Function(input_names=["table_path", "aggregate_path", "units"], output_names=["aggregate_path"], function=utils.merge_table_node_func), name="merge_table")
+        merge_table_node.inputs.aggregate_path = aggregate_table_path(datasink_dir, save_dirname, output_format)
+        merge_table_node.inputs.units = incremental_units
 
-avg_all_node = Node(Function(input_names=['roi_dicts'], output_names=["avg_dicts"], function=utils.average_each_roi_values_node_func), name="avg_all")
+        roi_extract_workflow.connect(make_csv_node, "save_path", merge_table_node, "table_path")
+        table_node, table_field = merge_table_node, "aggregate_path"
+    else:
+        roi_extract_workflow.connect(make_csv_node, "save_path", datasink, save_dirname)
 
-add_metadata_node = Node(Function(input_names=["dicts", "subject_id", "run", "image_name", "is_nonlinear", "session"], output_names=["dicts_with_metadata"], function=utils.add_metadata_node_func), name="add_metadata")
+    if group_stats_n_perm is not None:
+        import group_stats
 
-join_all_node = JoinNode(Function(input_names=["joined_dicts"], output_names=["flattened"], function=utils.join_main), name="join_all", joinsource="itersource", joinfield=["joined_dicts"])
+        group_stats_node = Node(Function(input_names=["table_path", "n_perm"], output_names=["save_path"], function=group_stats.group_stats_node_func), name="group_stats")
+        group_stats_node.inputs.n_perm = group_stats_n_perm
+
+        roi_extract_workflow.connect([(table_node, group_stats_node, [(table_field, "table_path")]),
+                                      (group_stats_node, datasink, [("save_path", f"{save_dirname}.@group_stats")]),
+            ])
 
-make_csv_node = Node(Function(input_names=["flattened"], output_names=["save_path"], function=utils.make_csv_node_func), name="make_csv")
+    # set crash directory
+    roi_extract_workflow.config["execution"]["crashdump_dir"] = opj(workingdir, "crash")
 
-datasink = Node(DataSink(), name="datasink")
+    return roi_extract_workflow
 
 if __name__ == "__main__":
     print(f"pipeline base dir: {constants.PIPELINE_BASE_DIR}")    
@@ -62,6 +278,9 @@ if __name__ == "__main__":
     print(f"mask file path: {constants.MASK_FILE_PATH}")
     print(f"roi_extract_overwrite: {roi_extract_overwrite}")    
     
+    # only print what would be run and what already exists, nothing is built or written
+    is_plan = "--plan" in os.sys.argv
+    
     # run with only a few paths
     is_test_run = "--test" in os.sys.argv        
     
@@ -73,7 +292,6 @@ if __name__ == "__main__":
     
     # do not average the ROIs, keep x,y,z values for each voxel
     is_no_avg = "--no-avg" in os.sys.argv      
-    roi_extract_all_node.inputs.no_avg = is_no_avg        
     print(f"is_no_avg: {is_no_avg}")
     
     nonlinear_iterables = []
@@ -86,9 +304,9 @@ if __name__ == "__main__":
         force_run_iterables = [is_force_run]
         mni_template_iterables = [constants.MNI_TEMPLATE]    
     
-    registration_node.iterables = [("nonlinear", nonlinear_iterables), 
-                                   ("force_run", force_run_iterables), 
-                                   ("mni_template", mni_template_iterables)]
+    registration_iterables = [("nonlinear", nonlinear_iterables), 
+                              ("force_run", force_run_iterables), 
+                              ("mni_template", mni_template_iterables)]
     
     if "--fnirt" in os.sys.argv:
         nonlinear_iterables.append(True)
@@ -106,14 +324,10 @@ if __name__ == "__main__":
     
     # set working dir and datasink base directory, pulled from constants.py for non-tests
     workingdir = constants.WORKING_DIR if not is_test_run else opj(constants.ROI_BASE_DIR, "testworkingdir")
-    datasink.inputs.base_directory = constants.ROI_DATASINK if not is_test_run else opj(constants.ROI_BASE_DIR, "testdatasink")
+    datasink_dir = constants.ROI_DATASINK if not is_test_run else opj(constants.ROI_BASE_DIR, "testdatasink")
         
     print(f"working dir: {workingdir}")
-    print(f"datasink base directory: {datasink.inputs.base_directory}")    
-    
-    roi_extract_all_node.inputs.is_test_run = is_test_run
-    
-    roi_extract_workflow = Workflow(name="roi_extract_workflow", base_dir=workingdir)
+    print(f"datasink base directory: {datasink_dir}")    
     
     feat_reg_type = "both"
     
@@ -130,7 +344,7 @@ if __name__ == "__main__":
     print(f"Sample affine files: {affine_files[:2]}")
     total_num_feat_dirs = len(os.listdir(constants.INPUT_FEAT_DATASINK))
     print(f"Total number of NL FEAT directories: {total_num_feat_dirs}")
-    print(f"Missing zfstat paths: {total_num_feat_dirs * 6 - len(zfstat_paths)}/{total_num_feat_dirs * 6} ({(total_num_feat_dirs * 6 - len(zfstat_paths)) / (total_num_feat_dirs * 6) * 100}%)")
+    print(f"Missing zfstat paths: {total_num_feat_dirs * 6 - len(zfstat_paths)}/{total_num_feat_dirs * 6} ({(total_num_feat_dirs * 6 - len(zfstat_paths)) / max(total_num_feat_dirs * 6, 1) * 100}%)")
     
     ################################################################
     # For testing, use only first few zfstat paths and affine files
@@ -144,78 +358,95 @@ if __name__ == "__main__":
         if test_n < 10:
             print(f"zfstat_paths: {zfstat_paths}")  
     
-    subject_ids = [utils.get_subject_id_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
-    runs = [utils.get_run_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
-    image_names = [utils.get_image_name_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
-    sessions = [utils.get_session_from_zfstat_path(zfstat_path) for zfstat_path in zfstat_paths]
-    
-    # set iterables
-    itersource.iterables = [("zfstat_path", zfstat_paths), ("affine_file", affine_files), ("subject_id", subject_ids), ("run", runs), ("image_name", image_names), ("session", sessions)]        
-    
-    ###### Connect nodes
-    
-    # Use a 'dummy' fnirt node if the '--no-fnirt' argument is passed (for easier testing without fnirt)
-    # if "--no-fnirt" in os.sys.argv:
-    #     roi_extract_workflow.connect([(itersource, dummy_fnirt_node, [("affine_file", "affine_file"),
-    #                                                                 ("zfstat_path", "in_file"),
-    #                                                                 ("subject_id", "subject_id"),
-    #                                                                 ("run", "run"),
-    #                                                                 ("image_name", "image_name")]),                                                                        
-    #                                     (dummy_fnirt_node, roi_extract_all_node, [("warped_file", "input_nifti")]),
-    #                                     # (dummy_fnirt_node, datasink, [("warped_file", "fnirt.@warped")]),
-    #     ])
-    # else:
-    #     roi_extract_workflow.connect([(itersource, custom_fnirt_node, [("affine_file", "affine_file"),
-    #                                                                 ("zfstat_path", "in_file"),
-    #                                                                 ("subject_id", "subject_id"),
-    #                                                                 ("run", "run"),
-    #                                                                 ("image_name", "image_name")]),                                                                        
-    #                                     (custom_fnirt_node, roi_extract_all_node, [("warped_file", "input_nifti")]),
-    #                                     # (custom_fnirt_node, datasink, [("warped_file", "fnirt.@warped")]),
-    #     ])                   
-    
-    
-    if is_no_avg:
-        roi_extract_workflow.connect([
-            (roi_extract_all_node, add_metadata_node, [("roi_dicts", "dicts")])
-            ])
-    else:
-        roi_extract_workflow.connect([
-            (roi_extract_all_node, avg_all_node, [("roi_dicts", "roi_dicts")]),
-            (avg_all_node, add_metadata_node, [("avg_dicts", "avg_dicts")])
-            ])
-    
     save_dirname = "roi_csv"
     
     if "--save-dirname" in os.sys.argv:
         save_dirname = os.sys.argv[os.sys.argv.index("--save-dirname") + 1]
         print(f"save_dirname: {save_dirname}")                
     
-    # connect all nodes
-    roi_extract_workflow.connect([(itersource, registration_node, [("affine_file", "affine_file"),
-                                                                    ("zfstat_path", "in_file"),]),                                                                        
-                                        (registration_node, roi_extract_all_node, [("out_file", "input_nifti")]),
-                                        (registration_node, add_metadata_node, [("nonlinear", "is_nonlinear")]),                                        
-                                    (itersource, add_metadata_node, [("subject_id", "subject_id"),
-                                                                    ("run", "run"),
-                                                                    ("image_name", "image_name"),
-                                                                    ("session", "session")]),
-                                    (add_metadata_node, join_all_node, [("dicts_with_metadata", "joined_dicts")]),
-                                    (join_all_node, make_csv_node, [("flattened", "flattened")]),
-                                    (make_csv_node, datasink, [("save_path", save_dirname)]), 
-        ])              
-                                 
-    
-    crash_dir = opj(workingdir, "crash")
+    # ROI table as a partitioned Parquet dataset, or "--csv" for roi_activations.csv
+    output_format = "csv" if "--csv" in os.sys.argv else "parquet"
+    print(f"output_format: {output_format}")
+
+    # ROI group statistics of the table, "--group-stats [n_perm]"
+    group_stats_n_perm = None
+    if "--group-stats" in os.sys.argv:
+        next_args = os.sys.argv[os.sys.argv.index("--group-stats") + 1:]
+        group_stats_n_perm = int(next_args[0]) if next_args and next_args[0].isdigit() else 5000
+        print(f"group_stats_n_perm: {group_stats_n_perm}")
+
+    # voxel values of the ROIs into the array store instead of a table, "--array-store"
+    array_store_dir = opj(datasink_dir, "roi_array_store") if "--array-store" in os.sys.argv else None
+    if array_store_dir is not None:
+        print(f"array_store_dir: {array_store_dir}")
+        if group_stats_n_perm is not None:
+            print("WARN: --group-stats needs the ROI table, ignored with --array-store")
+            group_stats_n_perm = None
+
+    # only compute the zfstats missing from (or changed since) the ROI table of the datasink and merge them into it, "--incremental"
+    incremental_units = None
+    if "--incremental" in os.sys.argv:
+        if array_store_dir is not None:
+            print("WARN: the array store already skips stored images, --incremental only applies to the ROI table")
+        else:
+            incremental_units = plan_incremental(zfstat_paths, nonlinear_iterables, aggregate_table_path(datasink_dir, save_dirname, output_format))
+
+            sources = set([unit["source"] for unit in incremental_units])
+            keep = [i for i, zfstat_path in enumerate(zfstat_paths) if zfstat_path in sources]
+            zfstat_paths = [zfstat_paths[i] for i in keep]
+            affine_files = [affine_files[i] for i in keep]
+            print(f"incremental: {len(zfstat_paths)} zfstats to extract")
+
+            if not zfstat_paths and not is_plan:
+                print("Nothing to compute, the ROI table is up to date")
+                exit(0)
+
+    # copy the zfstats and affine files to local scratch ahead of the nodes, registrations written back in the background, "--stage"
+    is_stage = "--stage" in os.sys.argv
+
+    # registration -> extraction in two process pools instead of the workflow, "--stream [n_register] [n_extract]"
+    stream_workers = None
+    if "--stream" in os.sys.argv:
+        next_args = os.sys.argv[os.sys.argv.index("--stream") + 1:]
+        numbers = [int(arg) for arg in next_args[:2] if arg.isdigit()]
+        stream_workers = (numbers + [40, 16][len(numbers):])[:2]
+        print(f"stream_workers (registration, extraction): {stream_workers}")
+        if array_store_dir is not None:
+            print("WARN: --stream writes the ROI table, ignored with --array-store")
+            stream_workers = None
+
+    if is_plan:
+        print()
+        print("PLAN")
+        print("--------------------")
+        plan_registrations(zfstat_paths, nonlinear_iterables, force_run_iterables)
+        if array_store_dir is not None:
+            print(f"ROI array store: {array_store_dir}")
+        else:
+            print(f"ROI table ({output_format}): {opj(datasink_dir, save_dirname)}")
+        if incremental_units is not None:
+            print(f"incremental: {len(incremental_units)} units merged into {aggregate_table_path(datasink_dir, save_dirname, output_format)}")
+        if group_stats_n_perm is not None:
+            print(f"ROI group stats: {opj(datasink_dir, save_dirname, 'roi_group_stats.csv')} ({group_stats_n_perm} permutations)")
+        if is_stage:
+            from common.staging import DEFAULT_STAGING_DIR, staging_dir
+            print(f"staging: {len(zfstat_paths) + len(set(affine_files))} inputs to {staging_dir() or DEFAULT_STAGING_DIR}")
+        if stream_workers is not None:
+            print(f"streaming: {len(zfstat_paths) * len(nonlinear_iterables)} registrations -> extractions, {stream_workers[0]} + {stream_workers[1]} workers, scratch {opj(workingdir, 'stream')}")
+        print(f"nipype cache: {opj(workingdir, 'roi_extract_workflow')}{'' if os.path.exists(opj(workingdir, 'roi_extract_workflow')) else ' (none yet)'}")
+        exit(0)
     
-    # set crash directory
-    roi_extract_workflow.config["execution"]["crashdump_dir"] = crash_dir
+    if stream_workers is None:
+        roi_extract_workflow = build_workflow(workingdir, datasink_dir, zfstat_paths, affine_files, registration_iterables,
+                                              is_test_run, is_no_avg, save_dirname, group_stats_n_perm, output_format, array_store_dir,
+                                              incremental_units)
 
-    # write graphs 
-    if "--exec-graph" in os.sys.argv or is_test_run:
-        roi_extract_workflow.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")    
+        # write graphs (only if asked for)
+        if "--exec-graph" in os.sys.argv or is_test_run:
+            roi_extract_workflow.write_graph(graph2use="exec", dotfilename="exec_graph.dot", format="png")    
         
-    roi_extract_workflow.write_graph(graph2use="colored", format="png")
+        if "--graph" in os.sys.argv:
+            roi_extract_workflow.write_graph(graph2use="colored", format="png")
     
 
     # if '-y' argument is passed, run the workflow without asking for confirmation
@@ -228,10 +459,56 @@ if __name__ == "__main__":
         print("Exiting...")
         exit(0)
         
+    from common import instrument, timeline
+    
+    # timing and memory events of the nodes, summary: python -m common.instrument <event log>,
+    # timeline: <event log>.html and .trace.json (common/timeline.py)
+    event_log = instrument.start_run(opj(workingdir, "event_logs"), "roi")
+    
     start_time = time.time()    
     
-    run = roi_extract_workflow.run(plugin="MultiProc", plugin_args={"n_procs": 56})
+    prefetcher = None
+    if is_stage:
+        from common.staging import Prefetcher
+        
+        # in the order of the itersource iterables, each zfstat with its affine file
+        prefetcher = Prefetcher()
+        prefetcher.start([path for zfstat_path, affine_file in zip(zfstat_paths, affine_files) for path in [zfstat_path, affine_file]])
+    
+    run = None
+    try:
+        if stream_workers is not None:
+            aggregate_path = aggregate_table_path(datasink_dir, save_dirname, output_format)
+            # incremental: the table of this run is merged into the aggregate afterwards
+            table_path = aggregate_path if incremental_units is None else opj(workingdir, "stream", os.path.basename(aggregate_path))
+            
+            failures = run_stream(zfstat_paths, affine_files, registration_iterables, is_test_run, is_no_avg,
+                                  table_path, opj(workingdir, "stream"), *stream_workers)
+            
+            if incremental_units is not None:
+                # failed units stay to compute in the next run
+                failed = set([(unit["zfstat_path"], unit["nonlinear"]) for unit, _ in failures])
+                units = [unit for unit in incremental_units if (unit["source"], unit["is_nonlinear"]) not in failed]
+                table_path = utils.merge_table_node_func(table_path, aggregate_path, units)
+            
+            if group_stats_n_perm is not None:
+                import group_stats
+                
+                stats_path = opj(datasink_dir, save_dirname, "roi_group_stats.csv")
+                group_stats.group_stats(group_stats.read_activations(table_path), n_perm=group_stats_n_perm).to_csv(stats_path, index=False)
+                print(f"ROI group stats: {stats_path}")
+            
+            if failures:
+                print(f"WARN: {len(failures)} registrations/extractions failed, ex: {failures[0][0]['zfstat_path']}: {failures[0][1]!r}")
+        else:
+            run = roi_extract_workflow.run(plugin="MultiProc", plugin_args={"n_procs": 56, "status_callback": instrument.status_callback})
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        
+        # also for a failed run, the execution graph only if the workflow finished
+        timeline.report_run(event_log, graph=run)
     
     end_time = time.time()
     
-    print(f"Time taken: {end_time - start_time} seconds, or {(end_time - start_time) / 60} minutes, or {(end_time - start_time) / 3600} hours")
\ No newline at end of file
+    print(f"Time taken: {end_time - start_time} seconds, or {(end_time - start_time) / 60} minutes, or {(end_time - start_time) / 3600} hours")
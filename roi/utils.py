@@ -1,5 +1,3 @@
-import nilearn.image
-from requests import get
 import constants
 
 def get_latest_feat_dir(feat_datasink: str) -> str:
@@ -161,11 +159,15 @@ def roi_extract_all_node_func(input_nifti: str, mask_file_path: str, is_test_run
     Extracts all the ROIs from the input nifti file.
     """
     from nilearn.image import load_img
+    from common.instrument import measure
+    from common.nifti_io import load_nifti
+    from common.staging import staged
     import numpy as np
     import logging            
     
-    # Load the nifti file
-    data = load_img(input_nifti).get_fdata()
+    # Load the nifti file (shared NIfTI reader, local decompressed cache if NIFTI_CACHE_DIR is set)
+    with measure("roi_extract_read", input_nifti=input_nifti):
+        data = load_nifti(staged(input_nifti)).get_fdata()
     
     # Load the mask file
     mask_data = load_img(mask_file_path).get_fdata()
@@ -245,11 +247,15 @@ def roi_extract_node_func(input_nifti: str, roi_num: int, mask_file_path: str, i
     Extracts the ROI from the input nifti file.
     """
     from nilearn.image import load_img
+    from common.instrument import measure
+    from common.nifti_io import load_nifti
+    from common.staging import staged
     import numpy as np
     import logging
             
-    # Load the nifti file
-    data = load_img(input_nifti).get_fdata()
+    # Load the nifti file (shared NIfTI reader, local decompressed cache if NIFTI_CACHE_DIR is set)
+    with measure("roi_extract_read", input_nifti=input_nifti, roi_num=roi_num):
+        data = load_nifti(staged(input_nifti)).get_fdata()
     
     # Load the mask file
     mask_data = load_img(mask_file_path).get_fdata()
@@ -325,22 +331,26 @@ def join_main(joined_dicts: list):
     
     return flattened
 
-def make_csv_node_func(flattened: list):
-    """ Make a CSV file for the average ROI activations.
+def make_csv_node_func(flattened: list, output_format: str = "parquet"):
+    """ Make the table of the average ROI activations (or the voxel-level --no-avg table).
     
-    Format of CSV:
+    Format of the table:
         roi, subid, image, run, activation
         
     Example Row:
         1, NDARINV00CY2MDM, corGo, 1, 0.38347
+    
+    output_format "parquet": roi_activations/ dataset partitioned by session and image (activation_table.py),
+    "csv": roi_activations.csv
 
 
     Args:
         flattened (list): list of { "avg": float, "zfstat_path": str, "roi_num": int, "subject_id": str, "run": int, "image_name": str }
     """
-    import regex as re
+    # dynamic imports because nipype executes functions in separate context
     import pandas as pd
     import os
+    from activation_table import write_activations
         
     # # omit zfstat path
     # for dict in flattened:
@@ -349,13 +359,55 @@ def make_csv_node_func(flattened: list):
     # create dataframe
     df = pd.DataFrame(flattened)
         
-    # save dataframe to csv
-    save_path = os.path.join(os.getcwd(), "roi_activations.csv")
-    df.to_csv(save_path, index=False)
+    # save dataframe as parquet dataset or csv
+    save_path = write_activations(df, os.getcwd(), output_format=output_format)
     
     return save_path           
         
 
+def merge_table_node_func(table_path: str, aggregate_path: str, units: list):
+    """
+    Merges the ROI table of this run (make_csv_node_func) into the aggregate ROI table (incremental mode):
+    the rows of the units computed in this run replace or extend the aggregate. Returns the aggregate path.
+    
+    units: computed units, dicts of subject_id, session, run, image_name, is_nonlinear, source, source_mtime
+    """
+    # dynamic imports because nipype executes functions in separate context
+    import os
+    import pandas as pd
+    from activation_table import PARTITION_COLUMNS, compact, read_activations_table
+    from common.incremental import ROI_UNIT_COLUMNS, merge_rows
+    
+    rows = compact(read_activations_table(table_path))
+    partition_cols = None if aggregate_path.endswith(".csv") else PARTITION_COLUMNS
+    
+    os.makedirs(os.path.dirname(aggregate_path), exist_ok=True)
+    
+    return merge_rows(aggregate_path, rows, pd.DataFrame(units), ROI_UNIT_COLUMNS, partition_cols=partition_cols)
+
+def roi_store_node_func(input_nifti: str, store_dir: str, mask_file_path: str, subject_id: str, run: int, image_name: str, session: str, is_nonlinear: bool):
+    """
+    Writes the voxel values of all the ROIs of the input nifti file to the array store
+    (instead of one dict per voxel). Returns its key in the store.
+    """
+    # dynamic imports because nipype executes functions in separate context
+    from common.array_store import ArrayStore
+    from common.instrument import measure
+    
+    registration = "NL" if is_nonlinear else "LN"
+    
+    # Ex: sub-NDARINV00CY2MDM_ses-baselineYear1Arm1_run-01_corGo_LN
+    key = f"sub-{subject_id}_ses-{session}_run-{run:02}_{image_name}_{registration}"
+    
+    with measure("roi_store", subject_id=subject_id, session=session, run=run, image_name=image_name, is_nonlinear=is_nonlinear) as event:
+        store = ArrayStore(store_dir, atlas_file=mask_file_path)
+        written = store.write(key, input_nifti, subject_id=subject_id, session=session, run=run, image_name=image_name, registration=registration)
+        event["cache"] = "miss" if written else "hit"
+    
+    print(f"ROI_STORE: {input_nifti} -> {key}{'' if written else ' already stored. Skipping.'}")
+    
+    return key
+
 def dummy_fnirt(in_file: str, affine_file: str, mni_template: str, subject_id: str, run:int, image_name: str) -> str:
     """
     Dummy implementation of FNIRT.
@@ -423,7 +475,9 @@ def registration_node_func(nonlinear: bool, in_file: str, affine_file: str, mni_
     """
     import os
     import time
-    import shutil
+    from common.instrument import measure
+    from common.locking import single_flight
+    from common.staging import staged, write_back
      
      # Ex: zfstat1.nii.gz
     in_file_name = os.path.basename(in_file)    
@@ -438,50 +492,121 @@ def registration_node_func(nonlinear: bool, in_file: str, affine_file: str, mni_
     
     out_feat_path = os.path.join(os.path.dirname(in_file), out_name)
     
-    if os.path.exists(out_feat_path) and not force_run:
+    # only one process registers this file, the others wait and reuse its output
+    # timing event of the registration, a cache hit if its output already exists
+    with measure(node_name.lower(), in_file=in_file) as event, single_flight(out_feat_path, force=force_run) as should_compute:
+        event["cache"] = "miss" if should_compute else "hit"
+        
+        if not should_compute:
             print(f"{node_name}_NODE: {in_file} -> {out_name} already exists. Skipping.")
             return out_feat_path, nonlinear
-    
-    def get_interface():
-        if nonlinear:
-            from nipype.interfaces.fsl import FNIRT
-            # Run FNIRT    
+        
+        # registered by an earlier node, still being written back from the staging directory
+        if staged(out_feat_path) != out_feat_path:
+            print(f"{node_name}_NODE: {in_file} -> {out_name} already staged for write back. Skipping.")
+            event["cache"] = "hit"
+            return out_feat_path, nonlinear
+        
+        # local copies of the inputs if they were staged (--stage), else the inputs themselves
+        in_file_local = staged(in_file)
+        affine_file_local = staged(affine_file)
+    
+        def get_interface():
+            if nonlinear:
+                from nipype.interfaces.fsl import FNIRT
+                # Run FNIRT    
 
-            if no_affine:
-                return FNIRT(ref_file=mni_template, in_file=in_file, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")
+                if no_affine:
+                    return FNIRT(ref_file=mni_template, in_file=in_file_local, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")
+                else:
+                    return FNIRT(ref_file=mni_template, in_file=in_file_local, affine_file=affine_file_local, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")    
             else:
-                return FNIRT(ref_file=mni_template, in_file=in_file, affine_file=affine_file, output_type='NIFTI_GZ', warped_file=out_name, config_file="T1_2_MNI152_2mm")    
-        else:
-            from nipype.interfaces.fsl import FLIRT
+                from nipype.interfaces.fsl import FLIRT
 
-            if not "brain" in mni_template:
-                raise ValueError("MNI template must be a brain template for FLIRT.")                
+                if not "brain" in mni_template:
+                    raise ValueError("MNI template must be a brain template for FLIRT.")                
 
-            return FLIRT(in_file=in_file, out_file=out_name, reference=mni_template, apply_xfm=True, in_matrix_file=affine_file, save_log=True, out_log="flirt-log.txt", padding_size=0, interp="trilinear", output_type='NIFTI_GZ')
+                return FLIRT(in_file=in_file_local, out_file=out_name, reference=mni_template, apply_xfm=True, in_matrix_file=affine_file_local, save_log=True, out_log="flirt-log.txt", padding_size=0, interp="trilinear", output_type='NIFTI_GZ')
     
-    interface = get_interface()
+        interface = get_interface()
     
-    start_time = time.time()
+        start_time = time.time()
     
-    result = interface.run()    
+        result = interface.run()    
     
-    stdout = result.runtime.stdout
+        stdout = result.runtime.stdout
     
-    print(f"{node_name}_NODE: {in_file} -> {out_name} stdout: {stdout}")
+        print(f"{node_name}_NODE: {in_file} -> {out_name} stdout: {stdout}")
     
-    end_time = time.time()                
+        end_time = time.time()                
     
-    print(f"{node_name}_NODE: {in_file} -> {out_name} took {end_time - start_time} seconds, {(end_time - start_time) / 60} minutes.")
+        print(f"{node_name}_NODE: {in_file} -> {out_name} took {end_time - start_time} seconds, {(end_time - start_time) / 60} minutes.")
     
-    out_path = os.path.join(os.getcwd(), out_name)
+        out_path = os.path.join(os.getcwd(), out_name)
     
-    # copy the fnirt file to the location where the input file is (FEAT directory)
-    dest = shutil.copy(out_path, out_feat_path)
+        # copy the fnirt file to the location where the input file is (FEAT directory),
+        # through a temporary file so readers never see a partial copy (in the background with --stage)
+        dest = write_back(out_path, out_feat_path)
+    
+        print(f"{node_name}_NODE: Copied {out_path} to {dest}")
     
-    print(f"{node_name}_NODE: Copied {out_path} to {dest}")
     
     return out_feat_path, nonlinear            
         
+def stream_register_func(unit: dict) -> dict:
+    """
+    Streaming mode (--stream) producer: registers the zfstat of unit (registration_node_func) in a
+    scratch directory of its own. Returns the file to extract: the local registration output if it
+    was registered now (no read back from the FEAT directory), else the existing registered file.
+    
+    unit: zfstat_path, affine_file, nonlinear, mni_template, force_run, scratch_dir (+ the extraction's keys)
+    """
+    import os
+    import tempfile
+    
+    os.makedirs(unit["scratch_dir"], exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="register-", dir=unit["scratch_dir"])
+    
+    # FLIRT/FNIRT write their outputs to the working directory
+    os.chdir(work_dir)
+    out_feat_path, _ = registration_node_func(unit["nonlinear"], unit["zfstat_path"], unit["affine_file"], unit["mni_template"], unit["force_run"])
+    
+    local_path = os.path.join(work_dir, os.path.basename(out_feat_path))
+    
+    return {
+        "in_file": local_path if os.path.exists(local_path) else out_feat_path,
+        "out_feat_path": out_feat_path,
+        "work_dir": work_dir,
+    }
+
+def stream_extract_func(unit: dict, registered: dict):
+    """
+    Streaming mode (--stream) consumer: the rows of the ROI table of the registered zfstat
+    (roi_extract_all_node_func, average_each_roi_values_node_func, add_metadata_node_func).
+    Removes the producer's scratch directory.
+    
+    unit: mask_file_path, is_test_run, no_avg, subject_id, run, image_name, session, nonlinear
+    """
+    import shutil
+    import pandas as pd
+    from common.instrument import measure
+    
+    with measure("stream_extract", subject_id=unit["subject_id"], session=unit["session"], run=unit["run"], image_name=unit["image_name"],
+                 is_nonlinear=unit["nonlinear"]):
+        roi_dicts = roi_extract_all_node_func(registered["in_file"], unit["mask_file_path"], unit["is_test_run"], unit["no_avg"])
+        
+        # the table has the path of the registered file in the FEAT directory, not of the local copy
+        for roi_dict in roi_dicts:
+            roi_dict["zfstat_path"] = registered["out_feat_path"]
+        
+        if not unit["no_avg"]:
+            roi_dicts = average_each_roi_values_node_func(roi_dicts)
+        
+        dicts = add_metadata_node_func(roi_dicts, unit["subject_id"], unit["run"], unit["image_name"], unit["session"], unit["nonlinear"])
+    
+    shutil.rmtree(registered["work_dir"], ignore_errors=True)
+    
+    return pd.DataFrame(dicts)
 
 def get_subject_id_from_zfstat_path(zfstat_path: str) -> str:
     """